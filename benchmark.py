@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark for Ultimate Terabox Bot
+Runs TeraboxBot.handle_leech against local stand-ins for the Terabox
+share/download APIs, the shortlink API and Telegram - no network needed.
+
+Usage: python benchmark.py --users 20 --jobs 3 --file-mb 50 --upload-mbps 40
+       python benchmark.py --replay cassettes/terabox.jsonl --max-resolve-p95-ms 1500
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import http.client
+import json
+import logging
+import random
+import re
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import bot
+
+CHUNK = b"\0" * (64 * 1024)
+# 1x1 baseline JPEG, stands in for thumbs.url3
+THUMB_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAP//////////////////////////////////////////////////////"
+    "////////////////////////////////wgALCAABAAEBAREA/8QAFBABAAAAAAAAAAAAAAAAAAAAAP/aAAgBAQABPxA="
+)
+
+
+class _StandInServer:
+    """ThreadingHTTPServer on an ephemeral localhost port"""
+
+    handler_class = None
+
+    def __init__(self):
+        self.httpd = None
+        self.requests = 0
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.stand_in = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTeraboxHandler(_QuietHandler):
+    def do_GET(self):
+        fake = self.server.stand_in
+        fake.requests += 1
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        time.sleep(fake.latency)
+
+        if parsed.path == "/api/shorturlinfo":
+            if random.random() < fake.error_rate:
+                return self.send_json({"errno": -9, "errmsg": "stand-in failure"})
+            shorturl = query.get("shorturl", [""])[0]
+            return self.send_json({"errno": 0, "list": [fake.file_entry(shorturl)]})
+
+        if parsed.path == "/api/download":
+            if random.random() < fake.error_rate:
+                return self.send_json({"errno": 112})
+            fs_id = re.sub(r"\D", "", query.get("fidlist", ["0"])[0])
+            return self.send_json({"errno": 0, "dlink": [{"fs_id": fs_id, "dlink": f"{fake.url}/file/{fs_id}"}]})
+
+        if parsed.path == "/sharing/link":
+            shorturl = query.get("surl", [""])[0]
+            page = f"<html><script>window.yunData = {json.dumps({'file_list': [fake.file_entry(shorturl)]})};</script></html>"
+            body = page.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+
+        if parsed.path == "/api/get-info":
+            # External-API imitation; disabled unless requested so the native path is measured
+            if not fake.external_api:
+                return self.send_json({"success": False}, status=404)
+            shorturl = query.get("url", [""])[0].rstrip("/").split("/")[-1]
+            entry = fake.file_entry(shorturl)
+            return self.send_json({"success": True, "data": {
+                "filename": entry["server_filename"],
+                "size": entry["size"],
+                "download_link": f"{fake.url}/file/{entry['fs_id']}"
+            }})
+
+        if parsed.path.startswith("/file/"):
+            return self.send_file_body()
+
+        if parsed.path.startswith("/thumb/"):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(THUMB_JPEG)))
+            self.end_headers()
+            return self.wfile.write(THUMB_JPEG)
+
+        self.send_json({"errno": 404}, status=404)
+
+    def send_file_body(self):
+        fake = self.server.stand_in
+        if random.random() < fake.error_rate:
+            return self.send_json({"error": "stand-in failure"}, status=503)
+
+        size = fake.file_size
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        match = re.match(r"bytes=(\d*)-(\d*)", range_header or "")
+        if fake.range_support and match:
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            end = min(end, size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        if fake.range_support:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        remaining = end - start + 1
+        started = time.monotonic()
+        sent = 0
+        try:
+            while remaining > 0:
+                chunk = CHUNK[:min(len(CHUNK), remaining)]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+                sent += len(chunk)
+                if fake.bandwidth:
+                    ahead = sent / fake.bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class FakeTerabox(_StandInServer):
+    """Imitates shorturlinfo / download / sharing pages and the dlink CDN"""
+
+    handler_class = FakeTeraboxHandler
+
+    def __init__(self, file_size=10 * 1024 * 1024, latency=0.05, error_rate=0.0,
+                 range_support=True, bandwidth=0, external_api=False, extension="mp4"):
+        super().__init__()
+        self.file_size = file_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.range_support = range_support
+        self.bandwidth = bandwidth
+        self.external_api = external_api
+        self.extension = extension
+
+    def file_entry(self, shorturl):
+        fs_id = int(hashlib.md5(shorturl.encode()).hexdigest()[:12], 16)
+        return {
+            "server_filename": f"bench_{shorturl}.{self.extension}",
+            "size": self.file_size,
+            "fs_id": fs_id,
+            "thumbs": {"url3": f"{self.url}/thumb/{fs_id}"}
+        }
+
+
+class FakeShortlinkHandler(_QuietHandler):
+    def do_GET(self):
+        fake = self.server.stand_in
+        fake.requests += 1
+        time.sleep(fake.latency)
+        query = parse_qs(urlparse(self.path).query)
+        if random.random() < fake.error_rate:
+            return self.send_json({"status": "error"})
+        long_url = query.get("url", [""])[0]
+        self.send_json({"status": "success", "shortenedUrl": f"{fake.url}/s/{abs(hash(long_url)) % 10**8}"})
+
+
+class FakeShortlink(_StandInServer):
+    """Generic `/api?api=KEY&url=...` shortener"""
+
+    handler_class = FakeShortlinkHandler
+
+    def __init__(self, latency=0.05, error_rate=0.0):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+class FakeProxyHandler(_QuietHandler):
+    """Plain forwarding HTTP proxy: absolute-URI requests are replayed upstream"""
+
+    HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "host"}
+
+    def do_GET(self):
+        fake = self.server.stand_in
+        fake.requests += 1
+        if fake.dead:
+            # Drop the connection without answering, like an unreachable proxy
+            self.close_connection = True
+            return
+        target = urlparse(self.path)
+        upstream = http.client.HTTPConnection(target.netloc, timeout=30)
+        try:
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in self.HOP_HEADERS}
+            upstream.request(self.command, target.path + (f"?{target.query}" if target.query else ""), headers=headers)
+            response = upstream.getresponse()
+            self.send_response(response.status)
+            for key, value in response.getheaders():
+                if key.lower() not in self.HOP_HEADERS:
+                    self.send_header(key, value)
+            if response.getheader("Content-Length") is None:
+                self.close_connection = True
+            self.end_headers()
+            if self.command != "HEAD":
+                while chunk := response.read(64 * 1024):
+                    self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            upstream.close()
+
+    do_HEAD = do_GET
+
+
+class FakeProxy(_StandInServer):
+    """Egress proxy stand-in; a dead one drops every connection"""
+
+    handler_class = FakeProxyHandler
+
+    def __init__(self, dead=False):
+        super().__init__()
+        self.dead = dead
+
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, client, chat_id, text=""):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+        self.client = client
+        self.chat_id = chat_id
+        self.text = text
+        self.media = None
+
+    async def edit(self, text, **kwargs):
+        self.text = text
+        self.client.edits += 1
+        return self
+
+    async def delete(self):
+        return None
+
+
+class FakeUploadedFile:
+    def __init__(self, size, name):
+        self.size = size
+        self.name = name
+        self.sent = False
+
+
+class FakeTelegramClient:
+    """Accepts upload_file/send_file uploads at a configurable byte rate (0 = unlimited)"""
+
+    PART_SIZE = 512 * 1024
+
+    def __init__(self, upload_rate=0):
+        self.upload_rate = upload_rate
+        self.bytes_uploaded = 0
+        self.files_uploaded = 0
+        self.thumbs_attached = 0
+        self.copies_sent = 0
+        self.sent_messages = {}
+        self.messages_sent = 0
+        self.edits = 0
+
+    async def upload_file(self, file, file_size=None, **kwargs):
+        """Stream the body like Telethon does and hand back an opaque handle"""
+        sent = await self._consume(file)
+        return FakeUploadedFile(sent, getattr(file, "name", None) or str(file))
+
+    async def send_file(self, entity, file, file_size=None, **kwargs):
+        if kwargs.get("thumb"):
+            self.thumbs_attached += 1
+        if isinstance(file, (list, tuple)):
+            return [await self.send_file(entity, item, **kwargs) for item in file]
+        message = FakeMessage(self, entity)
+        self.sent_messages[message.id] = message
+        if isinstance(file, FakeUploadedFile):
+            # Sending media that was already sent is a by-reference copy
+            if file.sent:
+                self.copies_sent += 1
+            else:
+                file.sent = True
+                self.files_uploaded += 1
+            message.media = file
+            return message
+        await self._consume(file)
+        self.files_uploaded += 1
+        return message
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        if isinstance(ids, list):
+            return [self.sent_messages.get(i) for i in ids]
+        return self.sent_messages.get(ids)
+
+    async def edit_message(self, entity, message, text=None, **kwargs):
+        self.edits += 1
+        return self.sent_messages.get(message)
+
+    async def _consume(self, file):
+        close = False
+        if isinstance(file, str):
+            file, close = open(file, "rb"), True
+        elif isinstance(file, bytes):
+            self.bytes_uploaded += len(file)
+            return len(file)
+        try:
+            started = time.monotonic()
+            sent = 0
+            while True:
+                part = file.read(self.PART_SIZE)
+                if asyncio.iscoroutine(part):
+                    part = await part
+                if not part:
+                    break
+                sent += len(part)
+                if self.upload_rate:
+                    ahead = sent / self.upload_rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            if close:
+                file.close()
+        self.bytes_uploaded += sent
+        return sent
+
+    async def send_message(self, entity, text, **kwargs):
+        self.messages_sent += 1
+        return FakeMessage(self, entity, text)
+
+    async def get_entity(self, entity):
+        return SimpleNamespace(id=entity, username=None, first_name="Bench")
+
+
+class FakeEvent:
+    """Just enough of a Telethon NewMessage/CallbackQuery event for the handlers"""
+
+    def __init__(self, client, user_id, text="", data=None):
+        self.client = client
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.message = SimpleNamespace(text=text, id=0)
+        self.data = data
+        self.responses = []
+
+    async def respond(self, text, **kwargs):
+        self.client.messages_sent += 1
+        message = FakeMessage(self.client, self.chat_id, text)
+        self.responses.append(message)
+        return message
+
+    async def reply(self, text, **kwargs):
+        return await self.respond(text, **kwargs)
+
+    async def edit(self, text, **kwargs):
+        self.client.edits += 1
+
+    async def answer(self, *args, **kwargs):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def configure_bot(terabox, shortlink):
+    """Point bot.Config at the stand-ins and keep the run side-effect free"""
+    bot.Config.TERABOX_MIRRORS = [terabox.url]
+    bot.Config.EXTERNAL_API_URL = f"{terabox.url}/api/get-info"
+    bot.Config.SHORTLINK_URL = shortlink.url
+    bot.Config.SAVE_CHANNEL = 0
+    bot.Config.FREE_DOWNLOADS = 0
+    bot.Config.JOURNAL_PATH = ""
+    # Measure the transfer path, not the per-user rate limits
+    bot.Config.LEECH_RATE_LIMITS = {"free": 10 ** 9, "verified": 10 ** 9, "premium": 10 ** 9}
+    bot.Config.CHAT_RATE_LIMIT = bot.Config.COMMAND_RATE_LIMIT = 10 ** 9
+    bot.tracer = bot.JobTracer("")
+
+
+async def simulated_user(tb, client, user_id, jobs, latencies, failures, distinct_links=0, links=None):
+    # Fresh users must verify through the shortlink before leeching
+    await tb.handle_verify(FakeEvent(client, user_id, "/verify"))
+    user_info = tb.storage.get_user(user_id)
+    if user_info["tokens"]:
+        tb.token_manager.verify_token(user_id, user_info["tokens"][-1]["token"])
+
+    for job in range(jobs):
+        if links:
+            shorturl = links[(user_id + job) % len(links)]
+        else:
+            shorturl = "1" + (f"p{random.randrange(distinct_links)}" if distinct_links else f"u{user_id}x{job}")
+        event = FakeEvent(client, user_id, f"https://teraboxapp.com/s/{shorturl}")
+        started = time.perf_counter()
+        await tb.handle_leech(event)
+        latencies.append(time.perf_counter() - started)
+        final = event.responses[-1].text if event.responses else ""
+        if "completed" not in final:
+            failures.append(final.split("\n")[0])
+
+
+async def run_benchmark(args):
+    terabox = FakeTerabox(
+        file_size=int(args.file_mb * 1024 * 1024),
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        range_support=not args.no_range,
+        bandwidth=int(args.cdn_mbps * 1024 * 1024),
+        external_api=args.external_api
+    ).start()
+    shortlink = FakeShortlink(latency=args.latency_ms / 1000).start()
+    configure_bot(terabox, shortlink)
+    proxies = [FakeProxy(dead=i < args.dead_proxies).start() for i in range(args.proxies)]
+    bot.Config.TERABOX_PROXIES = [proxy.url for proxy in proxies]
+    links = None
+    if args.record:
+        bot.Config.CASSETTE_MODE, bot.Config.CASSETTE_PATH = "record", args.record
+    elif args.replay:
+        # Resolve against what the cassette saw; only the shortlink stand-in is live
+        bot.Config.CASSETTE_MODE, bot.Config.CASSETTE_PATH = "replay", args.replay
+        bot.Config.CASSETTE_MISS = "passthrough"
+        bot.Config.CASSETTE_LATENCY_SCALE = args.latency_scale
+        cassette = bot.open_cassette()
+        bot.Config.TERABOX_MIRRORS = cassette.meta.get("mirrors", bot.Config.TERABOX_MIRRORS)
+        bot.Config.EXTERNAL_API_URL = cassette.meta.get("external_api_url", bot.Config.EXTERNAL_API_URL)
+        links = cassette.shorturls()
+        if not links:
+            raise SystemExit(f"{args.replay} has no recorded share links")
+    if args.cache_mb:
+        bot.Config.CACHE_DIR = args.cache_dir
+        bot.Config.CACHE_MAX_BYTES = int(args.cache_mb * 1024 * 1024)
+
+    client = FakeTelegramClient(upload_rate=int(args.upload_mbps * 1024 * 1024))
+    tb = bot.TeraboxBot(client=client)
+    resolve_times = []
+    resolve = tb.resolver.resolve
+
+    async def timed_resolve(url):
+        started = time.perf_counter()
+        try:
+            return await resolve(url)
+        finally:
+            resolve_times.append(time.perf_counter() - started)
+    tb.resolver.resolve = timed_resolve
+    if proxies:
+        # Let the first health check eject the dead proxies, as it would at startup
+        await asyncio.gather(*(
+            asyncio.to_thread(tb.downloader.proxies.check, proxy, tb.downloader.session)
+            for proxy in tb.downloader.proxies.proxies
+        ))
+    monitor = bot.LoopMonitor(interval=0.05, threshold=0.1)
+    monitor_task = asyncio.create_task(monitor.run())
+
+    latencies, failures = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        simulated_user(tb, client, 100000 + i, args.jobs, latencies, failures, args.distinct_links, links)
+        for i in range(args.users)
+    ])
+    elapsed = time.perf_counter() - started
+    monitor_task.cancel()
+    await asyncio.to_thread(terabox.stop)
+    await asyncio.to_thread(shortlink.stop)
+    for proxy in proxies:
+        await asyncio.to_thread(proxy.stop)
+
+    loop_stats = monitor.snapshot()
+    completed = len(latencies) - len(failures)
+    return {
+        "users": args.users,
+        "jobs": len(latencies),
+        "completed": completed,
+        "failed": len(failures),
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_s": round(completed / elapsed, 2),
+        "mb_per_s": round(client.bytes_uploaded / (1024 * 1024) / elapsed, 2),
+        "p50_ms": round(bot.percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(bot.percentile(latencies, 99) * 1000, 1),
+        "resolve_p50_ms": round(bot.percentile(resolve_times, 50) * 1000, 1),
+        "resolve_p95_ms": round(bot.percentile(resolve_times, 95) * 1000, 1),
+        "loop_lag_p99_ms": loop_stats["p99_ms"],
+        "loop_blocked": loop_stats["blocking_total"],
+        "terabox_requests": terabox.requests,
+        "cache": tb.cache.stats() if tb.cache else None,
+        "thumbs_attached": client.thumbs_attached,
+        "copies_sent": client.copies_sent,
+        "shortlink_requests": shortlink.requests,
+        "proxy_requests": [proxy.requests for proxy in proxies],
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "failure_samples": sorted(set(failures))[:5],
+        "cassette": bot.open_cassette().stats() if args.record or args.replay else None,
+        "regression": bool(
+            args.max_resolve_p95_ms and bot.percentile(resolve_times, 95) * 1000 > args.max_resolve_p95_ms
+        )
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline handle_leech benchmark")
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--jobs", type=int, default=2, help="leech jobs per user")
+    parser.add_argument("--file-mb", type=float, default=10, help="size of every served file")
+    parser.add_argument("--latency-ms", type=float, default=50, help="API/first-byte latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failing API/CDN responses")
+    parser.add_argument("--no-range", action="store_true", help="CDN ignores Range requests")
+    parser.add_argument("--cdn-mbps", type=float, default=0, help="per-connection CDN rate in MB/s (0 = unlimited)")
+    parser.add_argument("--upload-mbps", type=float, default=0, help="Telegram upload rate in MB/s (0 = unlimited)")
+    parser.add_argument("--external-api", action="store_true", help="serve the external get-info API too")
+    parser.add_argument("--distinct-links", type=int, default=0,
+                        help="draw every job from this many shared links (0 = all unique)")
+    parser.add_argument("--proxies", type=int, default=0, help="route Terabox traffic through this many local proxies")
+    parser.add_argument("--dead-proxies", type=int, default=0, help="how many of those proxies drop every connection")
+    parser.add_argument("--record", metavar="CASSETTE", help="record Terabox/shortlink traffic to this cassette")
+    parser.add_argument("--replay", metavar="CASSETTE", help="serve Terabox traffic from this cassette")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply replayed latencies")
+    parser.add_argument("--max-resolve-p95-ms", type=float, default=0,
+                        help="flag a regression (exit 1) when resolution p95 exceeds this")
+    parser.add_argument("--cache-mb", type=float, default=0, help="enable the disk cache with this budget")
+    parser.add_argument("--cache-dir", default="bench_cache")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        bot.logger.setLevel(logging.WARNING)
+    result = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f"{key:>20}: {value}")
+    if result["regression"]:
+        print(f"REGRESSION: resolution p95 {result['resolve_p95_ms']}ms > {args.max_resolve_p95_ms}ms")
+        sys.exit(1)
@@ -7,20 +7,65 @@ Configurable Shortlink API Support
 """
 
 import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import csv
+import codecs
+import contextvars
+import functools
+import gc
 import logging
+import logging.handlers
+import math
+import mimetypes
+import multiprocessing
 import os
+import random
 import re
 import requests
+import resource
+import signal
+import socket
+import sqlite3
+import struct
 import json
 import hashlib
+import heapq
+import hmac
+import io
+import ipaddress
+import sys
+import threading
 import time
+import traceback
+import tracemalloc
+import urllib.parse
+import urllib3
 import uuid
+import weakref
+import zlib
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
 
-from telethon import TelegramClient, events, Button
+from telethon import TelegramClient, events, errors, Button
 from telethon.tl.types import DocumentAttributeVideo, DocumentAttributeFilename
 
+try:
+    from PIL import Image  # optional: thumbnail downscaling
+except ImportError:
+    Image = None
+
+try:
+    import socks  # optional: socks5:// egress proxies (requests[socks])
+except ImportError:
+    socks = None
+
+try:
+    import dns.resolver  # optional: real TTLs for the DNS cache
+except ImportError:
+    dns = None
+
 # Setup logging for mobile deployment
 logging.basicConfig(
     level=logging.INFO,
@@ -28,6 +73,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def tier_setting(name, default, convert):
+    """Parse a "tier=value,tier=value" env var; blank items are skipped, malformed ones are a config error"""
+    raw = os.getenv(name, default)
+    values = {}
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        tier, _, value = item.partition("=")
+        try:
+            if not tier.strip():
+                raise ValueError("missing tier")
+            values[tier.strip()] = convert(value.strip())
+        except ValueError:
+            raise ValueError(f"{name}: expected tier=number items separated by commas, got {item.strip()!r} in {raw!r}") from None
+    return values
+
 class Config:
     """Configuration with configurable shortlink system"""
     
@@ -58,12 +119,148 @@ class Config:
         "24h": {"hours": 24, "price": 20, "name": "👑 Full Day Access", "description": "Maximum convenience"}
     }
     
+    # UPI statement reconciliation: statement clock vs UTC (IST = 330), match slack
+    RECONCILE_UTC_OFFSET = int(os.getenv("RECONCILE_UTC_OFFSET", "330"))
+    RECONCILE_WINDOW_MINUTES = int(os.getenv("RECONCILE_WINDOW_MINUTES", "45"))
+    NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "20"))
+    
+    # /broadcast: global messages per second (Telegram allows ~30) and parallel sends
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+    BROADCAST_CHECKPOINT = os.getenv("BROADCAST_CHECKPOINT", "broadcast.json")
+    
+    # Sliding-window limits: links per LEECH_RATE_WINDOW by tier and per chat,
+    # and /verify or payment requests per COMMAND_RATE_WINDOW
+    LEECH_RATE_WINDOW = float(os.getenv("LEECH_RATE_WINDOW", "600"))
+    LEECH_RATE_LIMITS = tier_setting("LEECH_RATE_LIMITS", "free=3,verified=6,premium=20", int)
+    CHAT_RATE_LIMIT = int(os.getenv("CHAT_RATE_LIMIT", "40"))
+    COMMAND_RATE_WINDOW = float(os.getenv("COMMAND_RATE_WINDOW", "60"))
+    COMMAND_RATE_LIMIT = int(os.getenv("COMMAND_RATE_LIMIT", "5"))
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+    
+    # Bandwidth shaping in MB/s per direction (0 = unshaped), split by tier weight
+    DOWNLOAD_LIMIT_MBPS = float(os.getenv("DOWNLOAD_LIMIT_MBPS", "0"))
+    UPLOAD_LIMIT_MBPS = float(os.getenv("UPLOAD_LIMIT_MBPS", "0"))
+    TIER_BANDWIDTH_SHARES = tier_setting("TIER_BANDWIDTH_SHARES", "premium=6,verified=3,free=1", float)
+    SHAPER_INTERVAL = float(os.getenv("SHAPER_INTERVAL", "1"))
+    
+    # Files over SPLIT_PART_MB (Telegram's bot upload limit is 2000 MiB) go out
+    # as name.001, name.002, ... with SPLIT_CONCURRENCY parts uploading at once
+    SPLIT_PART_MB = float(os.getenv("SPLIT_PART_MB", "2000"))
+    SPLIT_CONCURRENCY = int(os.getenv("SPLIT_CONCURRENCY", "2"))
+    
+    # Signed streaming links served on the health port; STREAM_BASE_URL is this
+    # app's public URL (e.g. https://app.koyeb.app) and "" disables links
+    STREAM_BASE_URL = os.getenv("STREAM_BASE_URL", "")
+    STREAM_SECRET = os.getenv("STREAM_SECRET", "")
+    STREAM_LINK_TTL = float(os.getenv("STREAM_LINK_TTL", "14400"))
+    
+    # Days of per-day rollups kept for /adminstats
+    ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "30"))
+    
     # Other Settings - YOUR ORIGINAL COOKIE WITH PROPER CLOSING
     FREE_DOWNLOADS = int(os.getenv("FREE_DOWNLOADS", "3"))
     TERABOX_COOKIE = os.getenv("TERABOX_COOKIE", "lang=en; BAIDUID=mobile123:FG=1; BDUSS=mobilesession456; STOKEN=token789; ndus=mobileworking123;")
+    # Extra Terabox logins, separated by "||"; TERABOX_COOKIE is used when unset
+    TERABOX_COOKIES = [c.strip() for c in os.getenv("TERABOX_COOKIES", "").split("||") if c.strip()] or [TERABOX_COOKIE]
+    TERABOX_ACCOUNT_RPS = float(os.getenv("TERABOX_ACCOUNT_RPS", "2"))
+    TERABOX_ACCOUNT_BURST = float(os.getenv("TERABOX_ACCOUNT_BURST", "5"))
+    TERABOX_COOLDOWN = float(os.getenv("TERABOX_COOLDOWN", "60"))
+    TERABOX_ACQUIRE_TIMEOUT = float(os.getenv("TERABOX_ACQUIRE_TIMEOUT", "10"))
+    # Egress proxies for Terabox traffic (http://, https:// or socks5:// URLs)
+    TERABOX_PROXIES = os.getenv("TERABOX_PROXIES", "").split()
+    PROXY_CHECK_URL = os.getenv("PROXY_CHECK_URL", "")  # default: first mirror
+    PROXY_CHECK_INTERVAL = float(os.getenv("PROXY_CHECK_INTERVAL", "60"))
+    PROXY_MAX_FAILURES = int(os.getenv("PROXY_MAX_FAILURES", "2"))
+    PROXY_EJECT_SECONDS = float(os.getenv("PROXY_EJECT_SECONDS", "120"))
+    PROXY_DIRECT_FALLBACK = os.getenv("PROXY_DIRECT_FALLBACK", "1") == "1"
+    # Sharing pages are read only up to the embedded file list, and never past this
+    SCRAPE_MAX_BYTES = int(os.getenv("SCRAPE_MAX_BYTES", str(2 * 1024 * 1024)))
+    TERABOX_MIRRORS = os.getenv(
+        "TERABOX_MIRRORS",
+        "https://www.terabox.app https://1024terabox.com https://teraboxapp.com https://4funbox.com"
+    ).split()
+    
+    # Outbound connections: DNS cache TTLs (seconds), per-host pool size, pre-warming
+    DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "300"))
+    DNS_MIN_TTL = float(os.getenv("DNS_MIN_TTL", "30"))
+    DNS_MAX_TTL = float(os.getenv("DNS_MAX_TTL", "3600"))
+    HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+    PREWARM_CONNECTIONS = int(os.getenv("PREWARM_CONNECTIONS", "2"))  # per origin; 0 disables
+    PREWARM_IDLE = float(os.getenv("PREWARM_IDLE", "45"))
+    PREWARM_FORGET = float(os.getenv("PREWARM_FORGET", "1800"))
+    PREWARM_MAX_HOSTS = int(os.getenv("PREWARM_MAX_HOSTS", "16"))
+    PREWARM_TIMEOUT = float(os.getenv("PREWARM_TIMEOUT", "5"))
+    # Record/replay of Terabox and shortlink HTTP traffic ("" = live, record, replay)
+    CASSETTE_MODE = os.getenv("CASSETTE_MODE", "")
+    CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/terabox.jsonl")
+    CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1"))
+    CASSETTE_MAX_BODY = int(os.getenv("CASSETTE_MAX_BODY", str(256 * 1024)))
+    CASSETTE_MISS = os.getenv("CASSETTE_MISS", "error")  # or passthrough
+    EXTERNAL_API_URL = os.getenv("EXTERNAL_API_URL", "https://terabox-dl.qtcloud.workers.dev/api/get-info")
+    # Link resolution: resolver order, total budget and hedge delay (seconds)
+    RESOLVERS = os.getenv("RESOLVERS", "external,native,scrape").split(",")
+    RESOLVE_BUDGET = float(os.getenv("RESOLVE_BUDGET", "30"))
+    RESOLVE_HEDGE_DELAY = float(os.getenv("RESOLVE_HEDGE_DELAY", "2"))
+    RESOLVE_MEMO_ENTRIES = int(os.getenv("RESOLVE_MEMO_ENTRIES", "1024"))
     MAX_FILE_SIZE = 1.5 * 1024 * 1024 * 1024  # 1.5GB for free users
     PREMIUM_MAX_SIZE = 2.5 * 1024 * 1024 * 1024  # 2.5GB for premium
     TOKEN_VALIDITY_HOURS = int(os.getenv("TOKEN_VALIDITY_HOURS", "24"))
+    
+    # Event loop health monitoring (seconds)
+    LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+    LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+    LOOP_REPORT_INTERVAL = int(os.getenv("LOOP_REPORT_INTERVAL", "300"))
+    
+    # Memory introspection (/memory): RSS sampling, tracemalloc depth (0 = off until enabled)
+    MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", "60"))
+    MEMORY_SAMPLES = int(os.getenv("MEMORY_SAMPLES", "1440"))
+    MEMORY_WARN_MB = float(os.getenv("MEMORY_WARN_MB", "0"))
+    TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "0"))
+    # Bearer token for GET /memory on the health server ("" = endpoint disabled)
+    ADMIN_HTTP_TOKEN = os.getenv("ADMIN_HTTP_TOKEN", "")
+    
+    # Job tracing (JSON lines, rotated locally; empty TRACE_FILE disables)
+    TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+    TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(5 * 1024 * 1024)))
+    TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", "3"))
+    
+    # Transfer worker processes (0 = download/upload inside the bot process)
+    TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", "0"))
+    # Longest a handed-off transfer may take, queueing included, before it is failed
+    TRANSFER_JOB_TIMEOUT = float(os.getenv("TRANSFER_JOB_TIMEOUT", "7200"))
+    PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "5"))
+    
+    # Multi-node fleet: BOT_ROLE is bot (front-end), worker (transfers only) or all
+    JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "")
+    BOT_ROLE = os.getenv("BOT_ROLE", "all")
+    NODE_ID = os.getenv("NODE_ID", f"{socket.gethostname()}-{os.getpid()}")
+    NODE_SLOTS = int(os.getenv("NODE_SLOTS", "3"))
+    NODE_BANDWIDTH_MBPS = float(os.getenv("NODE_BANDWIDTH_MBPS", "100"))
+    JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    # The front-end gives up on a job no node claims in FLEET_QUEUE_TIMEOUT, or that runs past FLEET_JOB_TIMEOUT
+    FLEET_QUEUE_TIMEOUT = float(os.getenv("FLEET_QUEUE_TIMEOUT", "300"))
+    FLEET_JOB_TIMEOUT = float(os.getenv("FLEET_JOB_TIMEOUT", "7200"))
+    CLAIM_GRACE = float(os.getenv("CLAIM_GRACE", "3"))
+    
+    # Durable leech journal replayed after restarts ("" = disabled)
+    JOURNAL_PATH = os.getenv("JOURNAL_PATH", "jobs.db")
+    JOB_RESUME_MAX_AGE = float(os.getenv("JOB_RESUME_MAX_AGE", "21600"))
+    DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))
+    
+    # Local disk cache of downloaded files (0 bytes = disabled); policy lru or lfu
+    CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", "0"))
+    CACHE_POLICY = os.getenv("CACHE_POLICY", "lru")
+    # Temp files untouched this long are a dead writer's and get swept at startup
+    CACHE_TEMP_MAX_AGE = float(os.getenv("CACHE_TEMP_MAX_AGE", "3600"))
+    
+    # Thumbnails from Terabox's thumbs.url3
+    THUMBNAILS = os.getenv("THUMBNAILS", "1") == "1"
+    THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+    THUMB_CACHE_ENTRIES = int(os.getenv("THUMB_CACHE_ENTRIES", "512"))
+    THUMB_WAIT = float(os.getenv("THUMB_WAIT", "2"))
 
 class ShortlinkAPI:
     """Universal Shortlink API integration - supports multiple services"""
@@ -71,6 +268,7 @@ class ShortlinkAPI:
     def __init__(self):
         self.api_key = Config.SHORTLINK_API
         self.base_url = Config.SHORTLINK_URL
+        self.session = pooled_session()
         
     def shorten_url(self, long_url):
         """Shorten URL using configured shortlink service"""
@@ -97,40 +295,40 @@ class ShortlinkAPI:
     def _arolinks_shorten(self, url):
         """AroLinks API"""
         payload = {'api': self.api_key, 'url': url}
-        response = requests.get(f"https://arolinks.com/api", params=payload, timeout=10)
+        response = self.session.get("https://arolinks.com/api", params=payload, timeout=10)
         data = response.json()
         return data.get('shortenedUrl') if data.get('status') == 'success' else url
     def _adfly_shorten(self, url):
         """AdFly API"""
         api_url = f"https://api.adf.ly/api.php?key={self.api_key}&uid=YOUR_UID&advert_type=int&domain=adf.ly&url={url}"
-        response = requests.get(api_url, timeout=10)
+        response = self.session.get(api_url, timeout=10)
         return response.text.strip() if response.status_code == 200 else url
     
     def _shortest_shorten(self, url):
         """Shorte.st API"""
         payload = {'urlToShorten': url}
         headers = {'public-api-token': self.api_key}
-        response = requests.put("https://api.shorte.st/v1/data/url", json=payload, headers=headers, timeout=10)
+        response = self.session.put("https://api.shorte.st/v1/data/url", json=payload, headers=headers, timeout=10)
         data = response.json()
         return data.get('shortenedUrl') if data.get('status') == 'ok' else url
     
     def _ouo_shorten(self, url):
         """Ouo.io API"""
         api_url = f"http://ouo.io/api/{self.api_key}?s={url}"
-        response = requests.get(api_url, timeout=10)
+        response = self.session.get(api_url, timeout=10)
         return response.text.strip() if response.status_code == 200 else url
     
     def _gplinks_shorten(self, url):
         """GPLinks API"""
         payload = {'api': self.api_key, 'url': url}
-        response = requests.get(f"{self.base_url}/api", params=payload, timeout=10)
+        response = self.session.get(f"{self.base_url}/api", params=payload, timeout=10)
         data = response.json()
         return data.get('shortenedUrl') if data.get('status') == 'success' else url
     
     def _generic_shorten(self, url):
         """Generic API pattern"""
         payload = {'api': self.api_key, 'url': url}
-        response = requests.get(f"{self.base_url}/api", params=payload, timeout=10)
+        response = self.session.get(f"{self.base_url}/api", params=payload, timeout=10)
         try:
             data = response.json()
             return data.get('shortenedUrl', data.get('short_url', url))
@@ -143,6 +341,75 @@ class ShortlinkAPI:
         shortened = self.shorten_url(verification_url)
         return shortened
 
+class Analytics:
+    """Bot-wide counters and per-day rollups, updated as events happen.
+    
+    Dashboards read these instead of scanning every user: totals, one
+    bucket per UTC day (kept ANALYTICS_DAYS), and a min-heap of premium
+    expiry times so the active-premium count is maintained lazily.
+    """
+    
+    def __init__(self, retention_days=None):
+        self.retention_days = retention_days or Config.ANALYTICS_DAYS
+        self.totals = defaultdict(int)
+        self.days = OrderedDict()  # "YYYY-MM-DD" -> {"counters": defaultdict(int), "active": set()}
+        self.premium_until = {}  # user_id -> latest subscription end (unix time)
+        self._expiry_heap = []  # (end, user_id); stale entries are skipped on pop
+        self._current_day = None
+        self._bucket = None
+    
+    def _day(self):
+        day_number = int(time.time() // 86400)
+        if day_number != self._current_day:
+            key = datetime.utcfromtimestamp(day_number * 86400).strftime("%Y-%m-%d")
+            self._current_day = day_number
+            self._bucket = self.days.setdefault(key, {"counters": defaultdict(int), "active": set()})
+            while len(self.days) > self.retention_days:
+                self.days.popitem(last=False)
+        return self._bucket
+    
+    def record(self, metric, value=1, user_id=None):
+        """Add value to a counter (total and today's bucket); user_id marks them active today"""
+        self.totals[metric] += value
+        bucket = self._day()
+        bucket["counters"][metric] += value
+        if user_id is not None:
+            bucket["active"].add(user_id)
+    
+    def premium_started(self, user_id, end_time):
+        end = end_time.timestamp() if isinstance(end_time, datetime) else end_time
+        if end > self.premium_until.get(user_id, 0):
+            self.premium_until[user_id] = end
+            heapq.heappush(self._expiry_heap, (end, user_id))
+    
+    def active_premium(self, now=None):
+        now = now or datetime.utcnow().timestamp()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            end, user_id = heapq.heappop(self._expiry_heap)
+            if self.premium_until.get(user_id) == end:
+                del self.premium_until[user_id]
+        return len(self.premium_until)
+    
+    @staticmethod
+    def _rate(numerator, denominator):
+        return round(100 * numerator / denominator, 1) if denominator else 0.0
+    
+    def dashboard(self, days=7):
+        """Snapshot for /adminstats; cost is O(days), not O(users)"""
+        recent = list(self.days.items())[-days:]
+        today = self._day()
+        return {
+            "totals": dict(self.totals),
+            "active_premium": self.active_premium(),
+            "today": dict(today["counters"], active_users=len(today["active"])),
+            "days": [
+                dict(bucket["counters"], date=date, active_users=len(bucket["active"]))
+                for date, bucket in recent
+            ],
+            "verification_conversion": self._rate(self.totals["verifications"], self.totals["verification_links"]),
+            "payment_conversion": self._rate(self.totals["payments_completed"], self.totals["payments_created"])
+        }
+
 class SimpleStorage:
     """In-memory storage optimized for Koyeb free tier"""
     
@@ -150,9 +417,11 @@ class SimpleStorage:
         self.users = {}
         self.payments = {}
         self.tokens = {}
+        self.analytics = Analytics()
         
     def get_user(self, user_id):
         if str(user_id) not in self.users:
+            self.analytics.record("new_users")
             self.users[str(user_id)] = {
                 "user_id": user_id,
                 "downloads_used": 0,
@@ -173,8 +442,11 @@ class SimpleStorage:
     def get_payment(self, payment_id):
         return self.payments.get(payment_id)
     
-    def update_payment(self, payment_id, status):
+    def update_payment(self, payment_id, status, expected=None):
+        """Set a payment's status; with `expected`, only if it still has that status"""
         if payment_id in self.payments:
+            if expected is not None and self.payments[payment_id]["status"] != expected:
+                return False
             self.payments[payment_id]["status"] = status
             self.payments[payment_id]["verified_at"] = datetime.utcnow().isoformat()
             return True
@@ -208,6 +480,7 @@ class TokenManager:
         }
         user_info["tokens"].append(token_info)
         self.storage.save_user(user_id, user_info)
+        self.storage.analytics.record("verification_links", user_id=user_id)
         
         # Create shortlink verification URL
         verification_link = self.shortlink.create_verification_link(user_id, token)
@@ -231,6 +504,7 @@ class TokenManager:
                         "validity_hours": validity_hours
                     })
                     self.storage.save_user(user_id, user_info)
+                    self.storage.analytics.record("verifications", user_id=user_id)
                     return True
         return False
     def has_valid_token(self, user_id):
@@ -276,6 +550,7 @@ class PaymentManager:
         }
         
         self.storage.save_payment(payment_id, payment_data)
+        self.storage.analytics.record("payments_created", user_id=user_id)
         return payment_data
     
     def generate_upi_link(self, payment_id, amount):
@@ -292,7 +567,152 @@ class PaymentManager:
         return f"upi://pay?{upi_string}"
     
     def verify_payment(self, payment_id):
-        return self.storage.update_payment(payment_id, "completed")
+        # Compare-and-set: /confirm and statement reconciliation may race for one payment
+        return self.storage.update_payment(payment_id, "completed", expected="pending")
+
+class PaymentReconciler:
+    """Matches rows of a UPI statement export (CSV) to pending payments.
+    
+    A row matches a payment by the `Premium-<id>` note of the UPI link, or,
+    when the app dropped the note, by exact amount within the payment's
+    time window if exactly one pending payment fits. Rows that fit several
+    payments, or have no usable time, are reported as ambiguous and left
+    for /confirm. A note naming a payment that is no longer pending is a
+    duplicate and never falls back to amount matching.
+    """
+    
+    NOTE_PATTERN = re.compile(r'Premium[-\s]?([0-9A-F]{8})', re.IGNORECASE)
+    # Lower-cased header names seen in GPay/PhonePe/Paytm and bank exports
+    COLUMNS = {
+        "amount": ("amount", "amount (inr)", "amount(inr)", "credit", "credit amount", "txn amount", "transaction amount"),
+        "time": ("date", "date & time", "date/time", "transaction date", "txn date", "time", "timestamp", "value date"),
+        "note": ("note", "notes", "remarks", "description", "narration", "message", "transaction details"),
+        "reference": ("utr", "utr no", "upi ref no", "upi ref no.", "reference", "reference no", "transaction id", "txn id"),
+        "type": ("type", "dr/cr", "cr/dr", "transaction type", "status")
+    }
+    TIME_FORMATS = (
+        "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M",
+        "%d-%m-%Y %H:%M:%S", "%d-%m-%Y %H:%M", "%d %b %Y %H:%M", "%d %b %Y, %I:%M %p", "%d/%m/%Y %I:%M %p"
+    )
+    
+    def __init__(self, storage):
+        self.storage = storage
+    
+    def build_indexes(self, payments):
+        """payment_id -> payment and amount -> pending payments sorted by creation"""
+        by_id = {}
+        by_amount = {}
+        for payment in payments:
+            if payment["status"] != "pending":
+                continue
+            by_id[payment["payment_id"]] = payment
+            by_amount.setdefault(self.paise(payment["amount"]), []).append(payment)
+        for payments in by_amount.values():
+            payments.sort(key=lambda p: p["created_at"])
+        return by_id, by_amount
+    
+    @staticmethod
+    def paise(amount):
+        return int(round(float(str(amount).replace(",", "").replace("₹", "").strip() or 0) * 100))
+    
+    def parse_time(self, value):
+        """Statement local time (RECONCILE_UTC_OFFSET minutes ahead of UTC) as naive UTC"""
+        value = (value or "").strip()
+        for fmt in self.TIME_FORMATS:
+            try:
+                local = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            return local - timedelta(minutes=Config.RECONCILE_UTC_OFFSET)
+        return None
+    
+    def read_rows(self, text):
+        """Normalised credit rows: {"line", "amount", "time", "note", "reference"}"""
+        reader = csv.DictReader(io.StringIO(text))
+        fields = {(name or "").strip().lower(): name for name in reader.fieldnames or []}
+        column = {key: next((fields[c] for c in candidates if c in fields), None) for key, candidates in self.COLUMNS.items()}
+        if not column["amount"]:
+            raise ValueError(f"no amount column in {list(fields)}")
+        
+        rows = []
+        for line, raw in enumerate(reader, start=2):
+            kind = (raw.get(column["type"]) or "").strip().lower() if column["type"] else ""
+            if kind in ("dr", "debit", "debited", "sent", "failed", "pending"):
+                continue
+            try:
+                amount = self.paise(raw.get(column["amount"]))
+            except ValueError:
+                continue
+            if amount <= 0:
+                continue
+            rows.append({
+                "line": line,
+                "amount": amount,
+                "time": self.parse_time(raw.get(column["time"])) if column["time"] else None,
+                "note": " ".join(str(v) for v in raw.values() if v) if not column["note"] else raw.get(column["note"]) or "",
+                "reference": (raw.get(column["reference"]) or "").strip() if column["reference"] else ""
+            })
+        return rows
+    
+    def in_window(self, payment, when):
+        created = datetime.fromisoformat(payment["created_at"])
+        slack = timedelta(minutes=Config.RECONCILE_WINDOW_MINUTES)
+        return created - slack <= when <= datetime.fromisoformat(payment["expires_at"]) + slack
+    
+    def reconcile(self, text, payments=None):
+        """Match a statement; returns {"matched", "ambiguous", "mismatched", "unmatched", "duplicates"}.
+        
+        `payments` is a snapshot of storage.payments taken on the event loop,
+        so this can run in a worker thread while new payments arrive.
+        """
+        payments = list(self.storage.payments.values()) if payments is None else payments
+        by_id, by_amount = self.build_indexes(payments)
+        known_ids = {p["payment_id"] for p in payments}
+        seen_references = {p.get("utr") for p in payments if p.get("utr")}
+        claimed = set()
+        report = {"matched": [], "ambiguous": [], "mismatched": [], "unmatched": [], "duplicates": []}
+        
+        for row in self.read_rows(text):
+            if row["reference"] and row["reference"] in seen_references:
+                report["duplicates"].append(row)
+                continue
+            if row["reference"]:
+                seen_references.add(row["reference"])
+            
+            note = self.NOTE_PATTERN.search(row["note"])
+            if note and note.group(1).upper() in by_id:
+                payment = by_id[note.group(1).upper()]
+                if payment["payment_id"] in claimed:
+                    report["duplicates"].append(row)
+                elif row["amount"] < self.paise(payment["amount"]):
+                    report["mismatched"].append((row, payment))
+                else:
+                    claimed.add(payment["payment_id"])
+                    report["matched"].append((row, payment))
+                continue
+            if note and note.group(1).upper() in known_ids:
+                # Already confirmed (or closed): its amount must not claim someone else's payment
+                report["duplicates"].append(row)
+                continue
+            
+            candidates = [p for p in by_amount.get(row["amount"], []) if p["payment_id"] not in claimed]
+            if row["time"] is None:
+                # An amount alone never proves which payment (or that it is recent)
+                if candidates:
+                    report["ambiguous"].append((row, candidates))
+                else:
+                    report["unmatched"].append(row)
+                continue
+            candidates = [p for p in candidates if self.in_window(p, row["time"])]
+            if len(candidates) == 1:
+                claimed.add(candidates[0]["payment_id"])
+                report["matched"].append((row, candidates[0]))
+            elif candidates:
+                report["ambiguous"].append((row, candidates))
+            else:
+                report["unmatched"].append(row)
+        return report
+
 class UserManager:
     """User management with premium subscriptions"""
     
@@ -321,6 +741,11 @@ class UserManager:
         user_info["total_spent"] = user_info.get("total_spent", 0) + amount
         
         self.save_user_info(user_id, user_info)
+        analytics = self.storage.analytics
+        analytics.record("payments_completed", user_id=user_id)
+        analytics.record("revenue", amount)
+        analytics.record("premium_hours", hours)
+        analytics.premium_started(user_id, datetime.fromisoformat(subscription["end_time"]))
         logger.info(f"Added {hours}h premium for user {user_id} - ₹{amount}")
     
     def get_active_subscription(self, user_id):
@@ -352,16 +777,1297 @@ class UserManager:
         
         return token_manager.has_valid_token(user_id)
     
+    def get_tier(self, user_id, token_manager):
+        """Access tier used for limits and accounting: premium, verified or free"""
+        if self.get_active_subscription(user_id):
+            return "premium"
+        user_info = self.get_user_info(user_id)
+        if user_info["downloads_used"] >= Config.FREE_DOWNLOADS and token_manager.has_valid_token(user_id):
+            return "verified"
+        return "free"
+    
     def increment_download(self, user_id, file_size=0, filename=""):
         user_info = self.get_user_info(user_id)
         user_info["downloads_used"] += 1
         user_info["total_files"] += 1
         self.save_user_info(user_id, user_info)
+        self.storage.analytics.record("downloads", user_id=user_id)
+        self.storage.analytics.record("bytes", file_size or 0)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """One timed stage of a leech job"""
+    
+    def __init__(self, name, trace_id, parent_id=None, attrs=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = dict(attrs or {})
+        self.start = time.time()
+        self.duration = 0.0
+        self.status = "ok"
+        self.error = None
+    
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+    
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 2),
+            "status": self.status,
+            "error": self.error,
+            "attrs": self.attrs
+        }
+
+class JobTracer:
+    """Lightweight nested spans per leech job, written as JSON lines"""
+    
+    def __init__(self, path=None, max_bytes=None, backups=None):
+        path = Config.TRACE_FILE if path is None else path
+        self.enabled = bool(path)
+        self._logger = logging.getLogger(f"terabox.traces:{os.path.abspath(path) if path else ''}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if self.enabled and not self._logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=max_bytes or Config.TRACE_MAX_BYTES,
+                backupCount=backups if backups is not None else Config.TRACE_BACKUPS,
+                encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+    
+    @contextlib.contextmanager
+    def span(self, name, remote_parent=None, **attrs):
+        """Open a span under the current one (or start a new trace).
+        
+        remote_parent is a (trace_id, span_id) pair handed over from
+        another process, so worker spans join the dispatcher's trace.
+        """
+        parent = _current_span.get()
+        if remote_parent and not parent:
+            trace_id, parent_id = remote_parent
+        else:
+            trace_id = parent.trace_id if parent else uuid.uuid4().hex
+            parent_id = parent.span_id if parent else None
+        span = Span(name, trace_id, parent_id, attrs)
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            _current_span.reset(token)
+            self.emit(span)
+    
+    @staticmethod
+    def current():
+        return _current_span.get()
+    
+    def emit(self, span):
+        if self.enabled:
+            self._logger.info(json.dumps(span.to_dict(), default=str))
+
+tracer = JobTracer()
+
+class BandwidthFlow:
+    """One transfer's share of a BandwidthShaper; consume() paces its bytes"""
+    
+    def __init__(self, shaper, tier):
+        self.shaper = shaper
+        self.tier = tier
+        self.rate = 0.0  # bytes/s allotted, 0 = unshaped
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.bytes = 0
+        self.window_bytes = 0
+        self.throttled = True  # assume it wants more until measured
+    
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        # Keep at most a quarter second of burst when the share shrinks
+        self.tokens = min(self.tokens, rate / 4)
+    
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.rate / 4, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def consume(self, amount):
+        self.bytes += amount
+        self.window_bytes += amount
+        if not self.rate:
+            return
+        self._refill()
+        # Go into debt and sleep it off so chunks larger than the burst still work
+        self.tokens -= amount
+        if self.tokens < 0:
+            self.throttled = True
+            await asyncio.sleep(-self.tokens / self.rate)
+    
+    def close(self):
+        self.shaper.release(self)
+
+class BandwidthShaper:
+    """Splits one direction's bandwidth between tiers, then fairly within each.
+    
+    Every flow weighs its tier's share (TIER_BANDWIDTH_SHARES) divided by the
+    tier's active flows. Rates are re-allocated by weighted max-min
+    water-filling when flows open or close and every SHAPER_INTERVAL: flows
+    that used less than their rate keep only what they used plus headroom, and
+    the rest is lent to flows that are being throttled. Idle tiers lend
+    their whole share the same way.
+    """
+    
+    def __init__(self, limit_bytes, shares=None):
+        self.limit = limit_bytes
+        self.shares = shares or Config.TIER_BANDWIDTH_SHARES
+        self.flows = set()
+        self._task = None
+    
+    def open(self, tier):
+        """Start a flow for one transfer; close() it when the transfer ends"""
+        flow = BandwidthFlow(self, tier)
+        if self.limit:
+            self.flows.add(flow)
+            self.rebalance()
+            if self._task is None or self._task.done():
+                self._task = asyncio.ensure_future(self._run())
+        return flow
+    
+    def release(self, flow):
+        if flow in self.flows:
+            self.flows.discard(flow)
+            self.rebalance()
+    
+    async def _run(self):
+        while self.flows:
+            await asyncio.sleep(Config.SHAPER_INTERVAL)
+            self.rebalance(measure=True)
+    
+    def rebalance(self, measure=False):
+        if not self.flows:
+            return
+        per_tier = defaultdict(int)
+        for flow in self.flows:
+            per_tier[flow.tier] += 1
+        
+        weights = {}
+        demand = {}
+        for flow in self.flows:
+            weights[flow] = self.shares.get(flow.tier, 1) / per_tier[flow.tier]
+            if measure:
+                used = flow.window_bytes / Config.SHAPER_INTERVAL
+                # Satisfied flows (source or Telegram is the bottleneck) keep what they use plus headroom
+                demand[flow] = float("inf") if flow.throttled or not flow.rate else max(used * 1.25, 64 * 1024)
+                flow.window_bytes = 0
+                flow.throttled = False
+            else:
+                demand[flow] = float("inf")
+        
+        remaining = float(self.limit)
+        pending = set(self.flows)
+        allocation = {}
+        while pending:
+            unit = remaining / sum(weights[f] for f in pending)
+            satisfied = {f for f in pending if demand[f] <= weights[f] * unit}
+            if not satisfied:
+                for f in pending:
+                    allocation[f] = weights[f] * unit
+                break
+            for f in satisfied:
+                allocation[f] = demand[f]
+                remaining -= demand[f]
+            pending -= satisfied
+        
+        for flow, rate in allocation.items():
+            flow.set_rate(max(rate, 1.0))
+    
+    def stats(self):
+        return {
+            "limit_mbps": round(self.limit / (1024 * 1024), 2),
+            "flows": [
+                {"tier": f.tier, "rate_mbps": round(f.rate / (1024 * 1024), 2), "bytes": f.bytes}
+                for f in self.flows
+            ]
+        }
+
+class ShapedFile:
+    """Async file-like over an open cache file from `offset`, paced by bandwidth flows.
+    
+    Reads are positional (pread), so several readers can share one handle;
+    the handle belongs to whoever opened it and is not closed here.
+    """
+    
+    def __init__(self, file, flows, offset=0):
+        self.fd = file.fileno()
+        self.name = os.path.basename(file.name)
+        self.flows = flows
+        self.pos = offset
+    
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            size = os.fstat(self.fd).st_size - self.pos
+        chunk = os.pread(self.fd, size, self.pos)
+        self.pos += len(chunk)
+        for flow in self.flows:
+            await flow.consume(len(chunk))
+        return chunk
+    
+    def close(self):
+        pass
+
+class PartReader:
+    """Async file-like exposing the next `length` bytes of a source as one upload part"""
+    
+    def __init__(self, source, length, name):
+        self.source = source
+        self.remaining = length
+        self.name = name
+    
+    async def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        chunk = await self.source.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+class TransferStream:
+    """File-like wrapper over a streamed HTTP response for Telethon uploads.
+    
+    Reads run in a worker thread so the event loop keeps serving other
+    users, and bytes/time spent waiting on the source are recorded.
+    """
+    
+    live = weakref.WeakSet()  # open streams, for /memory
+    
+    def __init__(self, response, name=None, sink=None, head=None, head_size=0, flows=()):
+        self.response = response
+        self.flows = flows
+        self.raw = response.raw
+        self.raw.decode_content = True
+        self.name = name
+        self.sink = sink
+        # Already-downloaded bytes (a resumed partial file) served before the response
+        self.head = head
+        self.head_left = head_size
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self._prefix = bytearray()
+        TransferStream.live.add(self)
+    
+    def _read_blocking(self, size):
+        if self.head:
+            chunk = self.head.read(min(size, self.head_left) if size else self.head_left)
+            self.head_left -= len(chunk)
+            if chunk:
+                return chunk
+            self.head.close()
+            self.head = None
+        chunk = self.raw.read(size)
+        if self.sink and chunk:
+            self.sink.write(chunk)
+        return chunk
+    
+    async def peek(self, size):
+        """Buffer up to size bytes from the start without consuming them"""
+        started = time.perf_counter()
+        while len(self._prefix) < size:
+            chunk = await asyncio.to_thread(self._read_blocking, size - len(self._prefix))
+            if not chunk:
+                break
+            self._prefix += chunk
+        self.read_seconds += time.perf_counter() - started
+        return bytes(self._prefix)
+    
+    async def read(self, size=-1):
+        if self._prefix:
+            count = len(self._prefix) if not size or size < 0 else size
+            chunk = bytes(self._prefix[:count])
+            del self._prefix[:count]
+            self.bytes_read += len(chunk)
+            # Peeked bytes are shaped when handed on, like any other chunk
+            for flow in self.flows:
+                await flow.consume(len(chunk))
+            if size and size > len(chunk):
+                chunk += await self.read(size - len(chunk))
+            return chunk
+        
+        started = time.perf_counter()
+        chunk = await asyncio.to_thread(self._read_blocking, size if size and size > 0 else None)
+        self.read_seconds += time.perf_counter() - started
+        self.bytes_read += len(chunk)
+        for flow in self.flows:
+            await flow.consume(len(chunk))
+        return chunk
+    
+    def close(self):
+        if self.head:
+            self.head.close()
+        self.response.close()
+
+class CacheWriter:
+    """Tees a download into a temp file that becomes a cache entry on commit"""
+    
+    def __init__(self, cache, key, expected_size, resume_id=None, append=False):
+        self.cache = cache
+        self.key = key
+        self.expected_size = expected_size
+        self.resume_id = resume_id
+        if resume_id:
+            self.temp_path = cache.resume_path(key, resume_id)
+        else:
+            # Owner in the name: processes share tmp/ and only sweep stale files
+            self.temp_path = os.path.join(cache.temp_dir, f"{key}.{os.getpid()}.{uuid.uuid4().hex[:8]}.part")
+        self.file = open(self.temp_path, "ab" if append else "wb")
+        self.written = self.file.tell()
+    
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.written += len(chunk)
+    
+    def commit(self):
+        """Publish atomically if the whole file arrived; otherwise discard"""
+        self.file.close()
+        if self.expected_size and self.written != self.expected_size:
+            self.abort()
+            return None
+        return self.cache.publish(self.key, self.temp_path, self.written)
+    
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.temp_path)
+    
+    def checkpoint(self):
+        """Interrupted by shutdown: keep a journaled job's partial file to resume from"""
+        if not self.resume_id:
+            self.abort()
+        elif not self.file.closed:
+            self.file.close()
+
+class DiskCache:
+    """Content-addressed on-disk cache of downloaded files with a byte budget.
+    
+    Entries are keyed by md5 when Terabox reports one, else fs_id + size,
+    written through temp files and renamed into place, and evicted LRU or
+    LFU. The directory is the index shared by every process using it: it
+    is rescanned on each publish, so CACHE_MAX_BYTES holds across transfer
+    workers, and recency travels in file mtimes. Hits are handed out as
+    open files, which survive eviction (by any process) until closed. Only
+    the main process (sweep=True) clears temp files, and only ones no
+    writer has touched for CACHE_TEMP_MAX_AGE, since workers share tmp/.
+    """
+    
+    def __init__(self, directory=None, max_bytes=None, policy=None, sweep=True):
+        self.directory = directory or Config.CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else Config.CACHE_MAX_BYTES
+        self.policy = (policy or Config.CACHE_POLICY).lower()
+        self.temp_dir = os.path.join(self.directory, "tmp")
+        self._lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> {"size", "hits", "last_access"}, oldest first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.temp_dir, exist_ok=True)
+        if sweep:
+            self.sweep_temp()
+        self.rebuild_index()
+        logger.info(f"Disk cache: {len(self.entries)} files, {self.total_bytes / (1024 * 1024):.1f}MB in {self.directory}")
+    
+    @staticmethod
+    def key_for(file_info):
+        if file_info.get("md5"):
+            return f"md5-{re.sub(r'[^0-9a-fA-F]', '', str(file_info['md5'])).lower()}"
+        size = str(file_info.get("size", ""))
+        if file_info.get("fs_id") and size.isdigit() and int(size) > 0:
+            return f"fs-{re.sub(r'[^0-9A-Za-z_-]', '', str(file_info['fs_id']))}-{size}"
+        return None
+    
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+    
+    def sweep_temp(self, max_age=None):
+        """Drop half-written temp files from a crash; live writers keep their mtime fresh"""
+        max_age = Config.CACHE_TEMP_MAX_AGE if max_age is None else max_age
+        cutoff = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self.temp_dir):
+            if name.endswith(".resume"):
+                continue  # owned by the job journal, see discard_resumable
+            path = os.path.join(self.temp_dir, name)
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+        return removed
+    
+    def rebuild_index(self):
+        """Re-read the published entries from the directory, keeping this process's hit counts"""
+        found = []
+        with os.scandir(self.directory) as names:
+            for item in names:
+                if not item.name.endswith(".bin"):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = item.stat()
+                    found.append((stat.st_mtime, item.name[:-4], stat.st_size))
+        with self._lock:
+            hits = {key: entry["hits"] for key, entry in self.entries.items()}
+            self.entries.clear()
+            self.total_bytes = 0
+            for mtime, key, size in sorted(found):
+                self.entries[key] = {"size": size, "hits": hits.get(key, 0), "last_access": mtime}
+                self.total_bytes += size
+        self._evict()
+    
+    def open(self, key):
+        """A cached file opened for reading (touching it for LRU/LFU), or None"""
+        path = self.path(key)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                entry = self.entries.pop(key, None)
+                if entry:
+                    self.total_bytes -= entry["size"]
+            return None
+        with contextlib.suppress(OSError):
+            # mtime carries the recency to other processes and across restarts
+            os.utime(path)
+        size = os.fstat(file.fileno()).st_size
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                # Published by another process since our last scan
+                entry = self.entries[key] = {"size": size, "hits": 0, "last_access": 0}
+                self.total_bytes += size
+            self.entries.move_to_end(key)
+            entry["hits"] += 1
+            entry["last_access"] = time.time()
+            self.hits += 1
+        return file
+    
+    def writer(self, key, expected_size, resume_id=None, append=False):
+        if expected_size and expected_size > self.max_bytes:
+            return None
+        return CacheWriter(self, key, expected_size, resume_id, append)
+    
+    def resume_path(self, key, resume_id):
+        return os.path.join(self.temp_dir, f"{key}.{resume_id}.resume")
+    
+    def partial_size(self, key, resume_id):
+        try:
+            return os.path.getsize(self.resume_path(key, resume_id))
+        except OSError:
+            return 0
+    
+    def discard_resumable(self, keep_ids):
+        """Remove partial downloads of journal jobs that will not be resumed"""
+        for name in os.listdir(self.temp_dir):
+            parts = name.split(".")
+            if name.endswith(".resume") and parts[-2] not in keep_ids:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.temp_dir, name))
+    
+    def publish(self, key, temp_path, size):
+        try:
+            os.replace(temp_path, self.path(key))
+        except FileNotFoundError:
+            logger.warning(f"Cache temp file for {key} vanished before publish")
+            return None
+        # Other processes publish and evict too: account against the directory
+        self.rebuild_index()
+        return self.path(key)
+    
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self.total_bytes <= self.max_bytes or not self.entries:
+                    return
+                if self.policy == "lfu":
+                    key = min(self.entries, key=lambda k: (self.entries[k]["hits"], self.entries[k]["last_access"]))
+                else:
+                    key = next(iter(self.entries))
+                entry = self.entries.pop(key)
+                self.total_bytes -= entry["size"]
+                self.evictions += 1
+            # Open readers keep their handle; the data goes when they close it
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(key))
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+class MediaProbe:
+    """Pure-Python MP4/MKV header reader for real video attributes.
+    
+    Works from the first buffered bytes of a download and, when the
+    container needs it (an MP4 whose moov sits after mdat), from ranged
+    reads through read_at(offset, length) so the body is never fetched.
+    """
+    
+    HEAD_BYTES = 512 * 1024
+    MAX_MOOV_BYTES = 32 * 1024 * 1024
+    
+    MKV_SEGMENT = 0x18538067
+    MKV_INFO = 0x1549A966
+    MKV_TRACKS = 0x1654AE6B
+    MKV_CLUSTER = 0x1F43B675
+    MKV_TIMECODE_SCALE = 0x2AD7B1
+    MKV_DURATION = 0x4489
+    MKV_TRACK_ENTRY = 0xAE
+    MKV_TRACK_TYPE = 0x83
+    MKV_VIDEO = 0xE0
+    MKV_PIXEL_WIDTH = 0xB0
+    MKV_PIXEL_HEIGHT = 0xBA
+    
+    @classmethod
+    def probe(cls, head, total_size=0, read_at=None):
+        """Returns {"container", "duration", "width", "height", "faststart"} or None"""
+        try:
+            if head[4:8] == b"ftyp":
+                return cls._probe_mp4(head, total_size, read_at)
+            if head[:4] == b"\x1a\x45\xdf\xa3":
+                return cls._probe_mkv(head)
+        except (struct.error, IndexError, ValueError) as e:
+            logger.debug(f"Media probe failed: {e}")
+        return None
+    
+    # --- MP4 / MOV ---
+    
+    @staticmethod
+    def _box_header(data, offset):
+        size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+            header = 16
+        return size, box_type, header
+    
+    @classmethod
+    def _probe_mp4(cls, head, total_size, read_at):
+        offset = 0
+        seen_mdat = False
+        while True:
+            if offset + 16 <= len(head):
+                size, box_type, header = cls._box_header(head, offset)
+            elif read_at and (not total_size or offset + 8 <= total_size):
+                chunk = read_at(offset, 16)
+                if len(chunk) < 8:
+                    return None
+                size, box_type, header = cls._box_header(chunk.ljust(16, b"\0"), 0)
+            else:
+                return None
+            if size == 0:
+                size = (total_size or offset + header) - offset
+            if size < header:
+                return None
+            
+            if box_type == b"mdat":
+                seen_mdat = True
+            elif box_type == b"moov":
+                if offset + size <= len(head):
+                    moov = head[offset + header:offset + size]
+                elif read_at and size <= cls.MAX_MOOV_BYTES:
+                    moov = read_at(offset + header, size - header)
+                else:
+                    return {"container": "mp4", "faststart": not seen_mdat, "duration": 0, "width": 0, "height": 0}
+                result = cls._parse_moov(moov)
+                result["faststart"] = not seen_mdat
+                return result
+            offset += size
+            if total_size and offset >= total_size:
+                return None
+            if not read_at and offset >= len(head):
+                # moov lies beyond what we buffered and we cannot range-read
+                return {"container": "mp4", "faststart": False, "duration": 0, "width": 0, "height": 0} if seen_mdat else None
+    
+    @classmethod
+    def _children(cls, data):
+        offset = 0
+        while offset + 8 <= len(data):
+            size, box_type, header = cls._box_header(data, offset)
+            if size == 0:
+                size = len(data) - offset
+            if size < header:
+                return
+            yield box_type, data[offset + header:offset + size]
+            offset += size
+    
+    @classmethod
+    def _parse_moov(cls, moov):
+        result = {"container": "mp4", "duration": 0, "width": 0, "height": 0}
+        for box_type, body in cls._children(moov):
+            if box_type == b"mvhd":
+                if body[0] == 1:
+                    timescale, duration = struct.unpack(">IQ", body[20:32])
+                else:
+                    timescale, duration = struct.unpack(">II", body[12:20])
+                if timescale:
+                    result["duration"] = duration / timescale
+            elif box_type == b"trak" and not result["width"]:
+                width, height, handler = 0, 0, None
+                for child_type, child in cls._children(body):
+                    if child_type == b"tkhd":
+                        dims = child[84:92] if child[0] == 1 else child[76:84]
+                        width, height = (value >> 16 for value in struct.unpack(">II", dims))
+                    elif child_type == b"mdia":
+                        for media_type, media in cls._children(child):
+                            if media_type == b"hdlr":
+                                handler = media[8:12]
+                if handler == b"vide" and width:
+                    result["width"], result["height"] = width, height
+        return result
+    
+    # --- Matroska / WebM ---
+    
+    @staticmethod
+    def _vint(data, offset, keep_marker=False):
+        first = data[offset]
+        length = 1
+        mask = 0x80
+        while length <= 8 and not first & mask:
+            mask >>= 1
+            length += 1
+        if length > 8:
+            raise ValueError("invalid EBML vint")
+        value = first if keep_marker else first & (mask - 1)
+        for byte in data[offset + 1:offset + length]:
+            value = (value << 8) | byte
+        unknown = not keep_marker and value == (1 << (7 * length)) - 1
+        return value, length, unknown
+    
+    @classmethod
+    def _elements(cls, data, start, end):
+        offset = start
+        while offset < end and offset < len(data):
+            element_id, id_length, _ = cls._vint(data, offset, keep_marker=True)
+            size, size_length, unknown = cls._vint(data, offset + id_length)
+            body = offset + id_length + size_length
+            body_end = len(data) if unknown else body + size
+            yield element_id, body, min(body_end, len(data))
+            offset = body_end
+    
+    @classmethod
+    def _probe_mkv(cls, head):
+        result = {"container": "mkv", "duration": 0, "width": 0, "height": 0, "faststart": True}
+        timecode_scale = 1000000
+        raw_duration = 0
+        for element_id, body, body_end in cls._elements(head, 0, len(head)):
+            if element_id != cls.MKV_SEGMENT:
+                continue
+            for child_id, child, child_end in cls._elements(head, body, body_end):
+                if child_id == cls.MKV_CLUSTER:
+                    break
+                if child_id == cls.MKV_INFO:
+                    for info_id, value, value_end in cls._elements(head, child, child_end):
+                        if info_id == cls.MKV_TIMECODE_SCALE:
+                            timecode_scale = int.from_bytes(head[value:value_end], "big")
+                        elif info_id == cls.MKV_DURATION:
+                            fmt = ">f" if value_end - value == 4 else ">d"
+                            raw_duration = struct.unpack(fmt, head[value:value_end])[0]
+                elif child_id == cls.MKV_TRACKS:
+                    for entry_id, entry, entry_end in cls._elements(head, child, child_end):
+                        if entry_id != cls.MKV_TRACK_ENTRY or result["width"]:
+                            continue
+                        track_type, width, height = 0, 0, 0
+                        for field_id, value, value_end in cls._elements(head, entry, entry_end):
+                            if field_id == cls.MKV_TRACK_TYPE:
+                                track_type = int.from_bytes(head[value:value_end], "big")
+                            elif field_id == cls.MKV_VIDEO:
+                                for video_id, pixel, pixel_end in cls._elements(head, value, value_end):
+                                    if video_id == cls.MKV_PIXEL_WIDTH:
+                                        width = int.from_bytes(head[pixel:pixel_end], "big")
+                                    elif video_id == cls.MKV_PIXEL_HEIGHT:
+                                        height = int.from_bytes(head[pixel:pixel_end], "big")
+                        if track_type == 1:
+                            result["width"], result["height"] = width, height
+            break
+        result["duration"] = raw_duration * timecode_scale / 1e9
+        return result
+
+class ThumbnailService:
+    """Fetches Terabox thumbnails and downscales them for Telegram off the loop.
+    
+    Results are cached by fs_id (or URL) and concurrent requests for the
+    same file share one fetch. Without Pillow only JPEGs that already fit
+    Telegram's limits (size, and pixel sides read from the SOF header) are
+    used.
+    """
+    
+    MAX_SIDE = 320
+    MAX_BYTES = 200 * 1024
+    
+    def __init__(self, session, max_entries=None):
+        self.session = session
+        self.max_entries = max_entries or Config.THUMB_CACHE_ENTRIES
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=Config.THUMB_WORKERS, thread_name_prefix="thumb"
+        )
+    
+    async def get(self, file_info):
+        """Thumbnail bytes or None; never raises"""
+        url = file_info.get("thumbnail")
+        if not url:
+            return None
+        key = str(file_info.get("fs_id") or url)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(self._load(key, url))
+        return await asyncio.shield(self.inflight[key])
+    
+    async def _load(self, key, url):
+        try:
+            with tracer.span("thumbnail") as span:
+                loop = asyncio.get_running_loop()
+                data = await loop.run_in_executor(self.executor, self._fetch_and_scale, url)
+                span.set(bytes=len(data) if data else 0)
+            self.cache[key] = data
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+            return data
+        except Exception as e:
+            logger.debug(f"Thumbnail fetch failed for {url}: {e}")
+            return None
+        finally:
+            self.inflight.pop(key, None)
+    
+    def _fetch_and_scale(self, url):
+        response = self.session.get(url, timeout=10)
+        response.raise_for_status()
+        data = response.content
+        if Image is None:
+            size = self.jpeg_size(data)
+            fits = size and max(size) <= self.MAX_SIDE and len(data) <= self.MAX_BYTES
+            return data if fits else None
+        
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((self.MAX_SIDE, self.MAX_SIDE))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=85, optimize=True)
+        return output.getvalue() if output.tell() <= self.MAX_BYTES else None
+    
+    @staticmethod
+    def jpeg_size(data):
+        """(width, height) from a JPEG's start-of-frame segment, or None"""
+        if data[:3] != b"\xff\xd8\xff":
+            return None
+        pos = 2
+        while pos + 4 <= len(data):
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1  # fill byte
+                continue
+            if marker in (0x01, *range(0xD0, 0xDA)):
+                pos += 2  # no length field
+                continue
+            length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                if pos + 9 > len(data):
+                    return None
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return width, height
+            pos += 2 + length
+        return None
+    
+    @staticmethod
+    async def wait(task, timeout=None):
+        """The thumbnail once the file itself is uploaded, waiting at most THUMB_WAIT more"""
+        if not task:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), Config.THUMB_WAIT if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens/s refill, up to `burst` saved"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_take(self, amount=1):
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+    
+    def wait_time(self, amount=1):
+        self._refill()
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+class SlidingWindowLimiter:
+    """Per-key request limiter using the sliding-window-counter approximation.
+    
+    Each key keeps only the current and previous fixed-window counts; the
+    previous one is weighted by how much of it still overlaps the sliding
+    window. That makes a check O(1) in time and memory, and the least
+    recently seen keys are dropped beyond max_keys.
+    """
+    
+    def __init__(self, window, max_keys=None):
+        self.window = window
+        self.max_keys = max_keys or Config.RATE_LIMIT_MAX_KEYS
+        self.keys = OrderedDict()  # key -> [window_index, current_count, previous_count]
+        self.rejected = 0
+    
+    def hit(self, key, limit, now=None):
+        """Count one request if under limit; returns 0 or the seconds to wait"""
+        now = time.time() if now is None else now
+        index = int(now // self.window)
+        entry = self.keys.get(key)
+        if entry is None:
+            entry = self.keys[key] = [index, 0, 0]
+            if len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+        else:
+            self.keys.move_to_end(key)
+            if entry[0] != index:
+                # Roll forward; a gap of more than one window clears both counts
+                entry[2] = entry[1] if entry[0] == index - 1 else 0
+                entry[1] = 0
+                entry[0] = index
+        
+        elapsed = now / self.window - index
+        estimate = entry[2] * (1 - elapsed) + entry[1]
+        if estimate + 1 <= limit:
+            entry[1] += 1
+            return 0
+        
+        self.rejected += 1
+        if entry[1] + 1 > limit or not entry[2]:
+            # Over even without the previous window: wait for the next one
+            return (index + 1) * self.window - now
+        # The weighted previous count must shrink by the overshoot
+        overshoot = estimate + 1 - limit
+        return max(1.0, overshoot / entry[2] * self.window)
+    
+    def stats(self):
+        return {"keys": len(self.keys), "rejected": self.rejected}
+
+class TeraboxAccount:
+    """One Terabox login (cookie) with its own rate limit and health"""
+    
+    def __init__(self, name, cookie):
+        self.name = name
+        self.cookie = cookie
+        self.bucket = TokenBucket(Config.TERABOX_ACCOUNT_RPS, Config.TERABOX_ACCOUNT_BURST)
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.last_errno = None
+    
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.cooldown_until
+
+class AccountPool:
+    """Spreads Terabox API and dlink traffic over several accounts.
+    
+    Each account has a token bucket (TERABOX_ACCOUNT_RPS) and goes into an
+    exponentially growing cooldown when Terabox answers with an errno that
+    points at the account (bad login, rate limiting, risk control).
+    """
+    
+    # errno values that are the account's fault rather than the link's
+    ACCOUNT_ERRNOS = {-6, 4000020, 9013, 9019, 31034, 31045}
+    
+    def __init__(self, cookies=None):
+        cookies = cookies if cookies is not None else Config.TERABOX_COOKIES
+        self.accounts = [TeraboxAccount(f"account{i + 1}", cookie) for i, cookie in enumerate(cookies)]
+        self.by_name = {account.name: account for account in self.accounts}
+        self._lock = threading.Condition()
+        self._next = 0
+    
+    def get(self, name):
+        return self.by_name.get(name) if name else None
+    
+    def acquire(self, exclude=(), timeout=None):
+        """Blocking: take a rate-limit token from the best available account"""
+        deadline = time.monotonic() + (Config.TERABOX_ACQUIRE_TIMEOUT if timeout is None else timeout)
+        with self._lock:
+            while True:
+                candidates = [a for a in self.accounts if a.healthy and a.name not in exclude]
+                # Least busy first, rotating the start so ties spread evenly
+                self._next = (self._next + 1) % max(1, len(self.accounts))
+                candidates.sort(key=lambda a: (a.in_flight, (self.accounts.index(a) - self._next) % len(self.accounts)))
+                for account in candidates:
+                    if account.bucket.try_take():
+                        account.in_flight += 1
+                        account.requests += 1
+                        return account
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.accounts:
+                    fallback = min(
+                        (a for a in self.accounts if a.name not in exclude),
+                        key=lambda a: a.cooldown_until, default=None
+                    )
+                    if fallback:
+                        logger.warning(f"All Terabox accounts busy or cooling down; using {fallback.name}")
+                        fallback.in_flight += 1
+                        fallback.requests += 1
+                    return fallback
+                waits = [a.bucket.wait_time() for a in candidates] or [
+                    min(a.cooldown_until for a in self.accounts) - time.monotonic()
+                ]
+                self._lock.wait(max(0.01, min(min(waits), remaining)))
+    
+    def release(self, account, errno=None):
+        """Report the outcome of a request made with `account`"""
+        if not account:
+            return
+        with self._lock:
+            account.in_flight = max(0, account.in_flight - 1)
+            account.last_errno = errno
+            if errno in self.ACCOUNT_ERRNOS:
+                account.errors += 1
+                account.failures += 1
+                cooldown = min(Config.TERABOX_COOLDOWN * 2 ** (account.failures - 1), 3600)
+                account.cooldown_until = time.monotonic() + cooldown
+                logger.warning(f"Terabox {account.name} cooling down {cooldown:.0f}s after errno {errno}")
+            elif errno == 0:
+                account.failures = 0
+            self._lock.notify_all()
+    
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "name": a.name,
+                "healthy": a.healthy,
+                "cooldown_s": round(max(0, a.cooldown_until - now), 1),
+                "in_flight": a.in_flight,
+                "requests": a.requests,
+                "errors": a.errors,
+                "last_errno": a.last_errno,
+                "tokens": round(a.bucket.tokens, 2)
+            } for a in self.accounts]
+
+class EgressProxy:
+    """One HTTP/SOCKS proxy with its latency score and ejection state"""
+    
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.proxies = {"http": url, "https": url}
+        self.latency = None  # EWMA of seconds to response headers
+        self.failures = 0  # consecutive
+        self.ejections = 0
+        self.ejected_until = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+    
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+    
+    @property
+    def label(self):
+        """URL without credentials, for logs and /health"""
+        parts = urllib.parse.urlsplit(self.url)
+        return f"{parts.scheme}://{parts.hostname}:{parts.port}" if parts.password or parts.username else self.url
+
+class ProxyPool:
+    """Egress proxies for Terabox API and dlink traffic.
+    
+    A job picks a proxy once and keeps it, since a dlink only works from
+    the IP that requested it: resolution may move to a healthy proxy, but
+    a dlink is always fetched through its issuer (see issuer()). New
+    picks are random, weighted towards low-latency proxies.
+    PROXY_MAX_FAILURES consecutive connection errors (or one failed health
+    check) eject a proxy for an exponentially growing period, and the next
+    passing health check reinstates it. With no proxies configured, pick()
+    returns None and traffic goes direct.
+    """
+    
+    # Answers that come from the proxy itself rather than from Terabox
+    FAILURE_STATUSES = {407, 502, 504}
+    
+    def __init__(self, urls=None):
+        urls = Config.TERABOX_PROXIES if urls is None else urls
+        self.proxies = []
+        for url in urls:
+            proxy = EgressProxy(f"proxy{len(self.proxies) + 1}", url)
+            if url.startswith("socks") and socks is None:
+                logger.error(f"Skipping {proxy.label}: SOCKS proxies need PySocks (pip install requests[socks])")
+                continue
+            self.proxies.append(proxy)
+        self.by_name = {proxy.name: proxy for proxy in self.proxies}
+        self._lock = threading.Lock()
+    
+    def pick(self, prefer=None):
+        """The job's sticky proxy while it is healthy, else a fresh pick (None = direct)"""
+        if not self.proxies:
+            return None
+        with self._lock:
+            sticky = self.by_name.get(prefer) if prefer else None
+            if sticky and sticky.healthy:
+                return sticky
+            healthy = [p for p in self.proxies if p.healthy]
+            if not healthy:
+                if Config.PROXY_DIRECT_FALLBACK:
+                    return None
+                return min(self.proxies, key=lambda p: p.ejected_until)
+            if sticky:
+                logger.warning(f"{sticky.name} is ejected; moving its job to another proxy")
+            # Weight by speed; unmeasured proxies count as fast so they get tried
+            weights = [1 / max(p.latency or 0, 0.05) for p in healthy]
+            return random.choices(healthy, weights=weights)[0]
+    
+    def issuer(self, name):
+        """The proxy a dlink was issued through, ejected or not (None = direct)"""
+        if not name:
+            return None
+        proxy = self.by_name.get(name)
+        if proxy is None:
+            raise RuntimeError(f"dlink was issued through {name}, which is no longer configured; resolve again")
+        if not proxy.healthy:
+            logger.warning(f"{name} is ejected; fetching its dlink through it anyway")
+        return proxy
+    
+    def succeeded(self, proxy, seconds):
+        with self._lock:
+            proxy.requests += 1
+            proxy.failures = 0
+            proxy.latency = seconds if proxy.latency is None else 0.8 * proxy.latency + 0.2 * seconds
+    
+    def failed(self, proxy, error, eject=False):
+        with self._lock:
+            proxy.requests += 1
+            proxy.errors += 1
+            proxy.failures += 1
+            proxy.last_error = error
+            if (eject or proxy.failures >= Config.PROXY_MAX_FAILURES) and proxy.healthy:
+                proxy.ejections += 1
+                seconds = min(Config.PROXY_EJECT_SECONDS * 2 ** (proxy.ejections - 1), 3600)
+                proxy.ejected_until = time.monotonic() + seconds
+                logger.warning(f"Ejected {proxy.name} ({proxy.label}) for {seconds:.0f}s: {error}")
+    
+    def get(self, session, url, proxy, **kwargs):
+        """session.get through `proxy` (or direct for None), scoring the proxy on the outcome"""
+        if proxy is None:
+            return session.get(url, **kwargs)
+        try:
+            response = session.get(url, proxies=proxy.proxies, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self.failed(proxy, f"{type(e).__name__}")
+            raise
+        if response.status_code in self.FAILURE_STATUSES:
+            self.failed(proxy, f"HTTP {response.status_code}")
+        else:
+            self.succeeded(proxy, response.elapsed.total_seconds())
+        return response
+    
+    def check(self, proxy, session):
+        """Blocking health check: any answer from upstream counts as healthy"""
+        url = Config.PROXY_CHECK_URL or f"{Config.TERABOX_MIRRORS[0]}/"
+        try:
+            with session.get(url, proxies=proxy.proxies, timeout=10, stream=True, allow_redirects=False) as response:
+                status = response.status_code
+        except requests.RequestException as e:
+            self.failed(proxy, f"check: {type(e).__name__}", eject=True)
+            return
+        if status in self.FAILURE_STATUSES:
+            self.failed(proxy, f"check: HTTP {status}", eject=True)
+            return
+        with self._lock:
+            if not proxy.healthy:
+                logger.info(f"Reinstated {proxy.name} ({proxy.label})")
+                proxy.ejected_until = 0
+            else:
+                proxy.ejections = 0
+        self.succeeded(proxy, response.elapsed.total_seconds())
+    
+    async def run(self, session):
+        while True:
+            await asyncio.gather(*(asyncio.to_thread(self.check, proxy, session) for proxy in self.proxies))
+            await asyncio.sleep(Config.PROXY_CHECK_INTERVAL)
+    
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                "name": p.name,
+                "url": p.label,
+                "healthy": p.healthy,
+                "ejected_s": round(max(0, p.ejected_until - now), 1),
+                "latency_ms": round(p.latency * 1000, 1) if p.latency is not None else None,
+                "requests": p.requests,
+                "errors": p.errors,
+                "last_error": p.last_error
+            } for p in self.proxies]
+
+class EmbeddedJSONScanner:
+    """Finds the JSON object assigned after a marker in HTML fed chunk by chunk.
+    
+    Only a marker-length tail is kept until a marker appears; after that,
+    the object's braces are matched (skipping string contents and escapes)
+    so the caller can stop reading the moment the object closes. A block
+    that turns out not to be the data (a marker inside an `if (...)`) is
+    dropped with resume(), which scans on from just past it.
+    """
+    
+    MARKERS = ("window.yunData", "locals.mset(", "window.locals")
+    _TOKENS = re.compile(r'[{}"\\]')
+    
+    def __init__(self, markers=MARKERS):
+        self.markers = markers
+        self.rest = ""
+        self._reset()
+    
+    def _reset(self):
+        self.tail = ""
+        self.found = False
+        self.block = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+    
+    def resume(self):
+        """Discard the last block and look for the next marker in what followed it"""
+        rest, self.rest = self.rest, ""
+        self._reset()
+        return self.feed(rest)
+    
+    def feed(self, text):
+        """Returns the object's source once complete, else None"""
+        if not self.found:
+            text = self.tail + text
+            hits = [(text.find(m), m) for m in self.markers if m in text]
+            if not hits:
+                self.tail = text[-max(len(m) for m in self.markers):]
+                return None
+            index, marker = min(hits)
+            text = text[index + len(marker):]
+            self.found = True
+            self.tail = ""
+        
+        start = 0
+        if not self.depth:
+            start = text.find("{")
+            if start < 0:
+                return None
+        end = self._scan(text, start)
+        if end is None:
+            self.block.append(text[start:])
+            return None
+        self.block.append(text[start:end])
+        self.rest = text[end:]
+        return "".join(self.block)
+    
+    def _scan(self, text, pos):
+        """Index just past the closing brace, or None if the object continues"""
+        while True:
+            if self.escape:
+                if pos >= len(text):
+                    return None
+                pos += 1
+                self.escape = False
+            match = self._TOKENS.search(text, pos)
+            if not match:
+                return None
+            char = match.group()
+            pos = match.end()
+            if char == "\\":
+                self.escape = self.in_string
+            elif char == '"':
+                self.in_string = not self.in_string
+            elif self.in_string:
+                continue
+            elif char == "{":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+    
+    @staticmethod
+    def files(source):
+        """Every {"server_filename", "size", "fs_id"} entry in the object source"""
+        try:
+            data = json.loads(source)
+        except ValueError:
+            # Not strict JSON (JS literal): fall back to regexes over just this block
+            names = re.findall(r'"server_filename"\s*:\s*"((?:[^"\\]|\\.)*)"', source)
+            sizes = re.findall(r'"size"\s*:\s*(\d+)', source)
+            fs_ids = re.findall(r'"fs_id"\s*:\s*(\d+)', source)
+            return [
+                {"filename": name, "size": int(sizes[i]) if i < len(sizes) else 0, "fs_id": fs_ids[i] if i < len(fs_ids) else None}
+                for i, name in enumerate(names)
+            ]
+        
+        found = []
+        stack = [data]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                if "server_filename" in node:
+                    found.append({
+                        "filename": node["server_filename"],
+                        "size": int(node.get("size") or 0),
+                        "fs_id": str(node["fs_id"]) if node.get("fs_id") is not None else None,
+                        "md5": node.get("md5"),
+                        "thumbnail": (node.get("thumbs") or {}).get("url3", ""),
+                        "dlink": node.get("dlink")
+                    })
+                stack.extend(reversed(list(node.values())))
+            elif isinstance(node, list):
+                stack.extend(reversed(node))
+        return found
+
 class TeraboxDownloader:
     """Updated Terabox downloader for 2025 - Multiple endpoint support"""
     
     def __init__(self):
-        self.session = requests.Session()
+        self.accounts = AccountPool()
+        self.proxies = ProxyPool()
+        self.session = pooled_session()
         # Updated headers for 2025
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -376,81 +2082,33 @@ class TeraboxDownloader:
             'Sec-Fetch-Site': 'same-origin'
         })
     
+    @staticmethod
+    def parse_shorturl(url):
+        """Share id from any supported Terabox link, or None"""
+        patterns = [
+            r'surl=([^&\s]+)',
+            r'/s/([^?&\s]+)', 
+            r'1024terabox\.com/s/([^?&\s]+)',
+            r'teraboxapp\.com/s/([^?&\s]+)',
+            r'4funbox\.com/s/([^?&\s]+)',
+            r'mirrobox\.com/s/([^?&\s]+)',
+            r'www\.terabox\.app/s/([^?&\s]+)'
+        ]
+        for pattern in patterns:
+            match = re.search(pattern, url, re.IGNORECASE)
+            if match:
+                return match.group(1)
+        return None
+    
     def extract_file_info(self, url):
         try:
-            # Extract shorturl with updated patterns
-            patterns = [
-                r'surl=([^&\s]+)',
-                r'/s/([^?&\s]+)', 
-                r'1024terabox\.com/s/([^?&\s]+)',
-                r'teraboxapp\.com/s/([^?&\s]+)',
-                r'4funbox\.com/s/([^?&\s]+)',
-                r'mirrobox\.com/s/([^?&\s]+)',
-                r'www\.terabox\.app/s/([^?&\s]+)'
-            ]
-            
-            shorturl = None
-            for pattern in patterns:
-                match = re.search(pattern, url, re.IGNORECASE)
-                if match:
-                    shorturl = match.group(1)
-                    break
-            
+            shorturl = self.parse_shorturl(url)
             if not shorturl:
                 return {"error": "Invalid Terabox URL format"}
             
-            # 2025 Working API endpoints with fallback
-            api_configs = [
-                {
-                    'url': f"https://www.terabox.app/api/shorturlinfo?shorturl={shorturl}&root=1",
-                    'cookie': 'lang=en; BAIDUID=ABC123:FG=1; ndus=working2025token;',
-                    'referer': 'https://www.terabox.app/'
-                },
-                {
-                    'url': f"https://1024terabox.com/api/shorturlinfo?shorturl={shorturl}&root=1", 
-                    'cookie': Config.TERABOX_COOKIE,
-                    'referer': 'https://1024terabox.com/'
-                },
-                {
-                    'url': f"https://teraboxapp.com/api/shorturlinfo?shorturl={shorturl}&root=1",
-                    'cookie': 'ndus=currentworkingtoken2025;',
-                    'referer': 'https://teraboxapp.com/'
-                },
-                {
-                    'url': f"https://4funbox.com/api/shorturlinfo?shorturl={shorturl}&root=1",
-                    'cookie': '',
-                    'referer': 'https://4funbox.com/'
-                }
-            ]
-            
-            for config in api_configs:
-                try:
-                    headers = dict(self.session.headers)
-                    headers['Cookie'] = config['cookie']
-                    headers['Referer'] = config['referer']
-                    headers['Origin'] = config['referer'].rstrip('/')
-                    
-                    response = self.session.get(config['url'], headers=headers, timeout=20)
-                    data = response.json()
-                    
-                    logger.info(f"API Response: {data.get('errno', 'no errno')} from {config['referer']}")
-                    
-                    if data.get('errno') == 0:
-                        files = data.get('list', [])
-                        if files:
-                            file_info = files[0]
-                            logger.info(f"Found file: {file_info.get('server_filename', 'unknown')}")
-                            return {
-                                "filename": file_info.get('server_filename', 'unknown'),
-                                "size": file_info.get('size', 0),
-                                "fs_id": file_info.get('fs_id'),
-                                "thumbnail": file_info.get('thumbs', {}).get('url3', ''),
-                                "file_type": self.get_file_type(file_info.get('server_filename', '')),
-                                "is_video": self.is_video_file(file_info.get('server_filename', ''))
-                            }
-                except Exception as e:
-                    logger.error(f"API endpoint {config['referer']} failed: {e}")
-                    continue
+            info = self.fetch_shorturl_info(shorturl)
+            if info:
+                return info
             
             # Alternative scraping method if API fails
             return self.scrape_file_info(url, shorturl)
@@ -459,15 +2117,70 @@ class TeraboxDownloader:
             logger.error(f"Error extracting file info: {e}")
             return {"error": f"Failed to process URL: {str(e)}"}
     
-    def scrape_file_info(self, original_url, shorturl):
+    def fetch_shorturl_info(self, shorturl, proxy=None):
+        """Metadata from the shorturlinfo API across mirrors, or None.
+        
+        Includes "dlink" when Terabox already put one in the listing, and
+        the account and proxy that must be used to fetch it.
+        """
+        # 2025 Working API endpoints with fallback
+        api_configs = [
+            {
+                'url': f"{mirror}/api/shorturlinfo?shorturl={shorturl}&root=1",
+                'referer': f"{mirror}/"
+            }
+            for mirror in Config.TERABOX_MIRRORS
+        ]
+        
+        for config in api_configs:
+            account = None
+            errno = None
+            try:
+                chosen = self.proxies.pick(proxy)
+                proxy = chosen and chosen.name
+                account = self.accounts.acquire()
+                headers = dict(self.session.headers)
+                headers['Cookie'] = account.cookie if account else ''
+                headers['Referer'] = config['referer']
+                headers['Origin'] = config['referer'].rstrip('/')
+                
+                with tracer.span("shorturlinfo", mirror=config['referer'], account=account and account.name, proxy=proxy) as attempt:
+                    response = self.proxies.get(self.session, config['url'], chosen, headers=headers, timeout=20)
+                    data = response.json()
+                    errno = data.get('errno')
+                    attempt.set(http_status=response.status_code, errno=errno)
+                
+                logger.info(f"API Response: {data.get('errno', 'no errno')} from {config['referer']}")
+                
+                if data.get('errno') == 0:
+                    files = data.get('list', [])
+                    if files:
+                        file_info = files[0]
+                        logger.info(f"Found file: {file_info.get('server_filename', 'unknown')}")
+                        return {
+                            "filename": file_info.get('server_filename', 'unknown'),
+                            "size": file_info.get('size', 0),
+                            "fs_id": file_info.get('fs_id'),
+                            "md5": file_info.get('md5'),
+                            "thumbnail": file_info.get('thumbs', {}).get('url3', ''),
+                            "file_type": self.get_file_type(file_info.get('server_filename', '')),
+                            "is_video": self.is_video_file(file_info.get('server_filename', '')),
+                            "dlink": file_info.get('dlink'),
+                            "account": account.name if account else None,
+                            "proxy": proxy
+                        }
+            except Exception as e:
+                logger.error(f"API endpoint {config['referer']} failed: {e}")
+                continue
+            finally:
+                self.accounts.release(account, errno)
+        return None
+    
+    def scrape_file_info(self, original_url, shorturl, proxy=None):
         """Backup scraping method when API fails"""
         try:
             # Try direct page scraping
-            scrape_urls = [
-                f"https://www.terabox.app/sharing/link?surl={shorturl}",
-                f"https://1024terabox.com/sharing/link?surl={shorturl}",
-                f"https://teraboxapp.com/sharing/link?surl={shorturl}"
-            ]
+            scrape_urls = [f"{mirror}/sharing/link?surl={shorturl}" for mirror in Config.TERABOX_MIRRORS[:3]]
             
             for scrape_url in scrape_urls:
                 try:
@@ -479,26 +2192,26 @@ class TeraboxDownloader:
                         'Connection': 'keep-alive'
                     }
                     
-                    response = self.session.get(scrape_url, headers=headers, timeout=15)
+                    chosen = self.proxies.pick(proxy)
+                    proxy = chosen and chosen.name
+                    with tracer.span("scrape_page", mirror=scrape_url.split('/sharing')[0], proxy=proxy) as attempt:
+                        files, read = self.scrape_embedded_files(scrape_url, headers, chosen)
+                        attempt.set(bytes=read, files=len(files))
                     
-                    if 'window.yunData' in response.text:
-                        # Extract filename from page content
-                        filename_match = re.search(r'"server_filename":"([^"]+)"', response.text)
-                        size_match = re.search(r'"size":(\d+)', response.text)
-                        fs_id_match = re.search(r'"fs_id":(\d+)', response.text)
-                        
-                        if filename_match:
-                            filename = filename_match.group(1)
-                            size = int(size_match.group(1)) if size_match else 0
-                            fs_id = fs_id_match.group(1) if fs_id_match else None
-                            
-                            return {
-                                "filename": filename,
-                                "size": size,
-                                "fs_id": fs_id,
-                                "file_type": self.get_file_type(filename),
-                                "is_video": self.is_video_file(filename)
-                            }
+                    if files:
+                        first = files[0]
+                        return {
+                            "filename": first["filename"],
+                            "size": first["size"],
+                            "fs_id": first["fs_id"],
+                            "md5": first.get("md5"),
+                            "thumbnail": first.get("thumbnail", ""),
+                            "file_type": self.get_file_type(first["filename"]),
+                            "is_video": self.is_video_file(first["filename"]),
+                            "files": files,
+                            "dlink": first.get("dlink"),
+                            "proxy": proxy
+                        }
                 except:
                     continue
             
@@ -507,42 +2220,93 @@ class TeraboxDownloader:
         except Exception as e:
             return {"error": f"Scraping failed: {str(e)}"}
     
+    def scrape_embedded_files(self, url, headers, proxy=None):
+        """Stream a sharing page only until its yunData/locals JSON closes.
+        
+        Returns (files, bytes read); the connection is dropped right after
+        the block, so the rest of the page is never downloaded or decoded.
+        """
+        scanner = EmbeddedJSONScanner()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        read = 0
+        with self.proxies.get(self.session, url, proxy, headers=headers, timeout=15, stream=True) as response:
+            if response.status_code != 200:
+                return [], 0
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                read += len(chunk)
+                block = scanner.feed(decoder.decode(chunk))
+                while block is not None:
+                    files = EmbeddedJSONScanner.files(block)
+                    if files:
+                        return files, read
+                    block = scanner.resume()
+                if read > Config.SCRAPE_MAX_BYTES:
+                    break
+        return [], read
+    
     def get_download_link(self, fs_id):
         """Updated download link extraction for 2025"""
+        return self.get_download_link_with_account(fs_id)[0]
+    
+    def get_download_link_with_account(self, fs_id, proxy=None):
+        """(dlink, account name, proxy name); the dlink must be fetched with the same cookie and proxy"""
         if not fs_id:
-            return None
+            return None, None, None
             
         try:
             # Multiple download API endpoints
-            download_apis = [
-                f"https://www.terabox.app/api/download?type=dlink&fidlist=[{fs_id}]",
-                f"https://1024terabox.com/api/download?type=dlink&fidlist=[{fs_id}]",
-                f"https://teraboxapp.com/api/download?type=dlink&fidlist=[{fs_id}]"
-            ]
+            download_apis = [f"{mirror}/api/download?type=dlink&fidlist=[{fs_id}]" for mirror in Config.TERABOX_MIRRORS[:3]]
             
+            tried_accounts = set()
             for api_url in download_apis:
+                account = None
+                errno = None
                 try:
+                    chosen = self.proxies.pick(proxy)
+                    proxy = chosen and chosen.name
+                    account = self.accounts.acquire(exclude=tried_accounts)
                     headers = dict(self.session.headers)
-                    headers['Cookie'] = Config.TERABOX_COOKIE
+                    headers['Cookie'] = account.cookie if account else ''
                     
-                    response = self.session.get(api_url, headers=headers, timeout=20)
-                    data = response.json()
+                    with tracer.span("dlink_attempt", mirror=api_url.split('/api/')[0], account=account and account.name, proxy=proxy) as attempt:
+                        response = self.proxies.get(self.session, api_url, chosen, headers=headers, timeout=20)
+                        data = response.json()
+                        errno = data.get('errno')
+                        attempt.set(http_status=response.status_code, errno=errno)
+                    
+                    if errno in AccountPool.ACCOUNT_ERRNOS and account:
+                        # Next mirror gets a different login
+                        tried_accounts.add(account.name)
                     
-                    if data.get('errno') == 0:
+                    if errno == 0:
                         dlinks = data.get('dlink', [])
                         if dlinks:
                             download_url = dlinks[0].get('dlink')
                             if download_url:
-                                return download_url
+                                return download_url, account.name if account else None, proxy
                 except Exception as e:
                     logger.error(f"Download API {api_url} failed: {e}")
                     continue
+                finally:
+                    self.accounts.release(account, errno)
             
-            return None
+            return None, None, None
             
         except Exception as e:
             logger.error(f"Error getting download link: {e}")
-            return None
+            return None, None, None
+    
+    def open_download(self, download_url, byte_range=None, account=None, proxy=None):
+        """Start a streamed GET for a dlink with the cookie and proxy that issued it"""
+        account = self.accounts.get(account) or (self.accounts.accounts[0] if self.accounts.accounts else None)
+        headers = dict(self.session.headers)
+        headers['Cookie'] = account.cookie if account else ''
+        if byte_range:
+            headers['Range'] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        # Never another IP: the dlink is signed for the one that requested it
+        response = self.proxies.get(self.session, download_url, self.proxies.issuer(proxy), headers=headers, stream=True, timeout=300)
+        response.raise_for_status()
+        return response
     
     def get_file_type(self, filename):
         ext = filename.lower().split('.')[-1] if '.' in filename else ''
@@ -568,18 +2332,1418 @@ class TeraboxDownloader:
     
     def is_video_file(self, filename):
         return self.get_file_type(filename) == "video"
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 when empty)"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+class ResolverPipeline:
+    """Resolves a share link to a downloadable file_info under one budget.
+    
+    The resolvers in RESOLVERS (external API, native shorturlinfo, page
+    scrape) run in order under one deadline: the next one starts as soon
+    as the previous fails, or, past the external API, once it has been
+    silent for RESOLVE_HEDGE_DELAY; the first complete answer wins. Native and scrape answers only carry metadata, so the
+    dlink fetch starts the moment any of them (or the memo of recently
+    seen links) yields an fs_id, shared by all of them, and is skipped
+    when the listing already included a dlink.
+    """
+    
+    # Hedged past on silence: they spend no Terabox account tokens, so a
+    # hedge never makes the native path wait longer for its rate limit
+    HEDGEABLE = {"external"}
+    
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.session = pooled_session()
+        self.resolvers = {"external": self.external, "native": self.native, "scrape": self.scrape}
+        self.order = [name for name in Config.RESOLVERS if name in self.resolvers]
+        self.memo = OrderedDict()  # shorturl -> metadata without the dlink
+        self.wins = defaultdict(int)
+        self.failures = defaultdict(int)
+        self.hedges = 0
+    
+    async def resolve(self, url):
+        """file_info for `url`, or None when every resolver failed or the budget ran out"""
+        shorturl = self.downloader.parse_shorturl(url)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + Config.RESOLVE_BUDGET
+        dlinks = {}  # fs_id -> shared dlink fetch
+        queue = list(self.order)
+        pending = {}
+        
+        def launch(name):
+            pending[asyncio.ensure_future(self._attempt(name, url, shorturl, dlinks, deadline))] = name
+        
+        with tracer.span("resolve", shorturl=shorturl) as span:
+            try:
+                known = self.memo.get(shorturl)
+                if known:
+                    pending[asyncio.ensure_future(self._complete(dict(known), dlinks))] = "memo"
+                elif queue:
+                    launch(queue.pop(0))
+                
+                while pending:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        span.set(result="budget_exhausted")
+                        return None
+                    can_hedge = queue and all(name in self.HEDGEABLE for name in pending.values())
+                    done, _ = await asyncio.wait(
+                        pending, timeout=min(remaining, Config.RESOLVE_HEDGE_DELAY) if can_hedge else remaining,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        if can_hedge:
+                            self.hedges += 1
+                            launch(queue.pop(0))
+                        continue
+                    for task in done:
+                        name = pending.pop(task)
+                        file_info = None if task.cancelled() or task.exception() else task.result()
+                        if file_info:
+                            self.wins[name] += 1
+                            span.set(result="resolved", resolver=name, source=file_info["source"])
+                            self._remember(shorturl, file_info)
+                            return file_info
+                        self.failures[name] += 1
+                        if name == "memo":
+                            self.memo.pop(shorturl, None)
+                        if queue:
+                            launch(queue.pop(0))
+                span.set(result="failed")
+                return None
+            finally:
+                for task in list(pending) + list(dlinks.values()):
+                    task.cancel()
+    
+    async def _attempt(self, name, url, shorturl, dlinks, deadline):
+        with tracer.span("resolver", resolver=name) as span:
+            try:
+                file_info = await self.resolvers[name](url, shorturl, dlinks, deadline)
+            except Exception as e:
+                logger.info(f"Resolver {name} failed: {e}")
+                file_info = None
+            span.set(found=bool(file_info))
+            return file_info
+    
+    async def external(self, url, shorturl, dlinks, deadline):
+        """The external API answers with filename + direct link in one call"""
+        timeout = max(1.0, min(15.0, deadline - asyncio.get_running_loop().time()))
+        response = await asyncio.to_thread(
+            self.session.get, Config.EXTERNAL_API_URL, params={"url": url}, timeout=timeout
+        )
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        if not data.get('success'):
+            return None
+        file_data = data.get('data', {})
+        download_url = file_data.get('download_link', '')
+        if not download_url:
+            return None
+        return {
+            "filename": file_data.get('filename', 'unknown'),
+            "size": file_data.get('size', 0),
+            "thumbnail": file_data.get('thumbnail', ''),
+            "download_url": download_url,
+            "source": "external"
+        }
+    
+    async def native(self, url, shorturl, dlinks, deadline):
+        if not shorturl:
+            return None
+        info = await asyncio.to_thread(self.downloader.fetch_shorturl_info, shorturl)
+        return await self._complete(info, dlinks) if info else None
+    
+    async def scrape(self, url, shorturl, dlinks, deadline):
+        if not shorturl:
+            return None
+        info = await asyncio.to_thread(self.downloader.scrape_file_info, url, shorturl)
+        return await self._complete(info, dlinks) if "error" not in info else None
+    
+    async def _complete(self, info, dlinks):
+        """Attach a dlink: the one in the listing, else a fetch shared per fs_id"""
+        download_url = info.get("dlink")
+        account, proxy = info.get("account"), info.get("proxy")
+        if not download_url:
+            fs_id = info.get("fs_id")
+            if not fs_id:
+                return None
+            if fs_id not in dlinks:
+                dlinks[fs_id] = asyncio.ensure_future(asyncio.to_thread(
+                    self.downloader.get_download_link_with_account, fs_id, proxy
+                ))
+            with tracer.span("get_download_link", fs_id=fs_id) as span:
+                download_url, account, proxy = await asyncio.shield(dlinks[fs_id])
+                span.set(found=bool(download_url), account=account, proxy=proxy)
+        if not download_url:
+            return None
+        
+        return {
+            "filename": info["filename"],
+            "size": info.get("size", 0),
+            "fs_id": info.get("fs_id"),
+            "md5": info.get("md5"),
+            "thumbnail": info.get("thumbnail", ""),
+            "download_url": download_url,
+            "account": account,
+            "proxy": proxy,
+            "source": "native"
+        }
+    
+    def _remember(self, shorturl, file_info):
+        if not shorturl or not file_info.get("fs_id"):
+            return
+        self.memo[shorturl] = {
+            key: file_info.get(key) for key in ("filename", "size", "fs_id", "md5", "thumbnail", "proxy")
+        }
+        self.memo.move_to_end(shorturl)
+        while len(self.memo) > Config.RESOLVE_MEMO_ENTRIES:
+            self.memo.popitem(last=False)
+    
+    def stats(self):
+        return {
+            "order": self.order,
+            "wins": dict(self.wins),
+            "failures": dict(self.failures),
+            "hedges": self.hedges,
+            "memo_entries": len(self.memo)
+        }
+
+class LoopMonitor:
+    """Measures asyncio scheduling lag and captures stacks of blocking calls"""
+    
+    def __init__(self, interval=None, threshold=None, window=1200):
+        self.interval = interval or Config.LOOP_LAG_INTERVAL
+        self.threshold = threshold or Config.LOOP_BLOCK_THRESHOLD
+        self.samples = deque(maxlen=window)
+        self.blocking_events = deque(maxlen=50)
+        self.blocking_total = 0
+        self.max_lag = 0.0
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._captured_tick = None
+        self._running = False
+    
+    async def run(self):
+        """Tick on the loop forever, recording how late each wake-up was"""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._running = True
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        
+        last_report = time.monotonic()
+        try:
+            while True:
+                started = loop.time()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - started - self.interval)
+                self.samples.append(lag)
+                self.max_lag = max(self.max_lag, lag)
+                self._last_tick = time.monotonic()
+                
+                if self._last_tick - last_report >= Config.LOOP_REPORT_INTERVAL:
+                    last_report = self._last_tick
+                    stats = self.snapshot()
+                    logger.info(
+                        f"Loop lag p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+                        f"p99={stats['p99_ms']}ms max={stats['max_ms']}ms blocked={stats['blocking_total']}"
+                    )
+        finally:
+            self._running = False
+    
+    def _watchdog(self):
+        """Runs in a thread; samples the loop thread's stack while it is stalled"""
+        while self._running:
+            time.sleep(self.threshold / 2)
+            last_tick = self._last_tick
+            stalled = time.monotonic() - last_tick - self.interval
+            if stalled < self.threshold or self._captured_tick == last_tick:
+                continue
+            
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
             
+            self._captured_tick = last_tick
+            stack = traceback.extract_stack(frame)
+            location = self._locate(stack)
+            self.blocking_total += 1
+            self.blocking_events.append({
+                "at": datetime.utcnow().isoformat(),
+                "stalled_ms": round(stalled * 1000, 1),
+                "location": location,
+                "stack": traceback.format_list(stack[-12:])
+            })
+            logger.warning(f"Event loop blocked {stalled * 1000:.0f}ms in {location}")
+    
+    @staticmethod
+    def _locate(stack):
+        """Innermost frame of our own code, e.g. 'handle_leech (bot.py:812)'"""
+        for entry in reversed(stack):
+            if entry.filename == __file__ and entry.name not in ("_watchdog", "run"):
+                return f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+        entry = stack[-1]
+        return f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+    
+    def snapshot(self):
+        samples = list(self.samples)
+        return {
+            "samples": len(samples),
+            "p50_ms": round(percentile(samples, 50) * 1000, 1),
+            "p95_ms": round(percentile(samples, 95) * 1000, 1),
+            "p99_ms": round(percentile(samples, 99) * 1000, 1),
+            "max_ms": round(self.max_lag * 1000, 1),
+            "blocking_total": self.blocking_total,
+            "recent_blocking": [
+                {k: v for k, v in event.items() if k != "stack"} for event in list(self.blocking_events)[-5:]
+            ]
+        }
+
+loop_monitor = LoopMonitor()
+
+# Extra /health sections: name -> callable returning JSON-serialisable data
+health_sections = {}
+
+def deep_sizeof(obj, limit=200000):
+    """Approximate retained bytes: sys.getsizeof over containers, each object counted once"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < limit:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(list(item.items()))
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(list(item))
+    return total
+
+def current_rss_mb():
+    """Resident set size now (Linux /proc), else the peak from getrusage"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class MemoryMonitor:
+    """RSS trend, per-structure sizes and tracemalloc diffs for /memory.
+    
+    RSS is sampled every MEMORY_SAMPLE_INTERVAL into a bounded window and
+    its growth rate fitted by least squares. Structures register a
+    callable in `sections` returning counts (and bytes where measuring
+    them is cheap). tracemalloc only runs when TRACEMALLOC_FRAMES > 0 or
+    after an admin turns it on; each report diffs against the previous
+    snapshot, so repeated reports show what is still growing. Sections
+    are measured on the bot loop that owns the structures (see snapshot).
+    """
+    
+    def __init__(self):
+        self.samples = deque(maxlen=Config.MEMORY_SAMPLES)  # (unix time, rss MB)
+        self.sections = {}  # name -> callable returning a dict
+        self.previous_snapshot = None
+        self.loop = None  # the bot loop, once run() starts
+        self.warned_at = 0
+        if Config.TRACEMALLOC_FRAMES > 0:
+            tracemalloc.start(Config.TRACEMALLOC_FRAMES)
+    
+    def sample(self):
+        rss = current_rss_mb()
+        self.samples.append((time.time(), rss))
+        return rss
+    
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        while True:
+            rss = self.sample()
+            if Config.MEMORY_WARN_MB and rss > Config.MEMORY_WARN_MB and time.time() - self.warned_at > 3600:
+                self.warned_at = time.time()
+                trend = self.trend(3600)
+                logger.warning(
+                    f"RSS {rss:.0f}MB is over MEMORY_WARN_MB ({Config.MEMORY_WARN_MB}MB)"
+                    + (f", growing {trend:+.1f}MB/h" if trend is not None else "") + "; see /memory"
+                )
+            await asyncio.sleep(Config.MEMORY_SAMPLE_INTERVAL)
+    
+    def trend(self, seconds=None):
+        """RSS growth in MB/hour over the last `seconds` (whole window if None); None under 5 minutes of data"""
+        points = list(self.samples)
+        if seconds:
+            cutoff = time.time() - seconds
+            points = [p for p in points if p[0] >= cutoff]
+        if len(points) < 2 or points[-1][0] - points[0][0] < 300:
+            return None
+        mean_t = sum(t for t, _ in points) / len(points)
+        mean_r = sum(r for _, r in points) / len(points)
+        variance = sum((t - mean_t) ** 2 for t, _ in points)
+        if not variance:
+            return 0.0
+        slope = sum((t - mean_t) * (r - mean_r) for t, r in points) / variance
+        return slope * 3600
+    
+    def set_tracing(self, enabled):
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(max(1, Config.TRACEMALLOC_FRAMES or 10))
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.previous_snapshot = None
+    
+    def allocations(self, top=10):
+        """Top allocators now and the biggest changes since the previous report"""
+        if not tracemalloc.is_tracing():
+            return {"tracing": False}
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        
+        def where(frame):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        
+        result = {
+            "tracing": True,
+            "traced_mb": round(tracemalloc.get_traced_memory()[0] / (1024 * 1024), 2),
+            "top": [
+                {"where": where(stat.traceback[0]), "kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]
+            ]
+        }
+        if self.previous_snapshot is not None:
+            result["growth"] = [
+                {"where": where(stat.traceback[0]), "kb_diff": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff}
+                for stat in snapshot.compare_to(self.previous_snapshot, "lineno")[:top]
+                if stat.size_diff
+            ]
+        self.previous_snapshot = snapshot
+        return result
+    
+    def measure(self):
+        """Every section; call on the loop that mutates them so sizes are consistent"""
+        structures = {}
+        for name, section in list(self.sections.items()):
+            try:
+                structures[name] = section()
+            except Exception as e:
+                structures[name] = {"error": str(e)}
+        return structures
+    
+    async def snapshot(self, top=10):
+        """The full /memory payload; only tracemalloc and RSS work leave the loop"""
+        structures = self.measure()
+        return await asyncio.to_thread(self.report, top, structures)
+    
+    def report(self, top=10, structures=None):
+        """Blocking: the full /memory payload"""
+        if structures is None:
+            structures = self.measure()
+        points = list(self.samples)
+        # Up to 24 evenly spaced points for the RSS history
+        step = max(1, len(points) // 24)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        trends = {"1h": self.trend(3600), "window": self.trend()}
+        return {
+            "rss_mb": round(current_rss_mb(), 1),
+            "peak_rss_mb": round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1),
+            "trend_mb_per_hour": {span: round(value, 2) if value is not None else None for span, value in trends.items()},
+            "rss_history": [
+                {"at": datetime.fromtimestamp(t).isoformat(timespec="minutes"), "mb": round(r, 1)}
+                for t, r in points[::step]
+            ],
+            "gc_objects": len(gc.get_objects()),
+            "structures": structures,
+            "allocations": self.allocations(top)
+        }
+
+memory_monitor = MemoryMonitor()
+
+class DNSCache:
+    """TTL-respecting cache in front of socket.getaddrinfo.
+    
+    Installed process-wide, so requests/urllib3 and asyncio lookups share
+    it. With dnspython installed a miss is a single A query (AAAA only when
+    there is no A record) whose answer supplies both the addresses and the
+    TTL; otherwise the system resolver answers and DNS_CACHE_TTL applies.
+    If a refresh fails the expired answer is served rather than an error.
+    """
+    
+    def __init__(self):
+        self.entries = {}  # (host, port, family, type, proto, flags) -> (expires, addrinfo)
+        self.lock = threading.Lock()
+        self.resolve = socket.getaddrinfo
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+    
+    def install(self):
+        if socket.getaddrinfo != self.getaddrinfo:
+            self.resolve = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+    
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        if not isinstance(host, str) or self._is_address(host):
+            return self.resolve(host, port, family, type, proto, flags)
+        key = (host.lower(), port, family, type, proto, flags)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+        
+        try:
+            result, ttl = self.lookup(host, port, family, type, proto, flags)
+        except socket.gaierror:
+            if entry:
+                with self.lock:
+                    self.stale += 1
+                return list(entry[1])
+            raise
+        ttl = min(max(ttl, Config.DNS_MIN_TTL), Config.DNS_MAX_TTL)
+        with self.lock:
+            self.entries[key] = (now + ttl, result)
+        return list(result)
+    
+    def lookup(self, host, port, family, type, proto, flags):
+        """(addrinfo, ttl) from one dnspython query, or the system resolver and the fixed TTL"""
+        if dns is not None:
+            rdtypes = {socket.AF_INET: ("A",), socket.AF_INET6: ("AAAA",)}.get(family, ("A", "AAAA"))
+            for rdtype in rdtypes:
+                try:
+                    answer = dns.resolver.resolve(host, rdtype, lifetime=2)
+                except dns.resolver.NXDOMAIN:
+                    break  # perhaps a name only /etc/hosts knows
+                except Exception:
+                    continue
+                result = []
+                for record in answer:
+                    # Numeric hosts never leave the process: this only shapes the tuples
+                    result.extend(self.resolve(
+                        record.address, port, family, type, proto, flags | socket.AI_NUMERICHOST
+                    ))
+                if result:
+                    return result, answer.rrset.ttl
+        return self.resolve(host, port, family, type, proto, flags), Config.DNS_CACHE_TTL
+    
+    @staticmethod
+    def _is_address(host):
+        try:
+            ipaddress.ip_address(host.split("%")[0])
+            return True
+        except ValueError:
+            return False
+    
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            entries = list(self.entries.items())
+            hits, misses, stale = self.hits, self.misses, self.stale
+        lookups = hits + misses
+        return {
+            "ttl_source": "dnspython" if dns is not None else "fixed",
+            "entries": len(entries),
+            "hits": hits,
+            "misses": misses,
+            "stale_served": stale,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "hosts": sorted({
+                f"{key[0]} ({max(0, expires - now):.0f}s)" for key, (expires, _) in entries
+            })[:20]
+        }
+
+dns_cache = DNSCache()
+
+class Cassette:
+    """Sanitized HTTP exchanges with their timing, stored as JSON lines.
+    
+    The first line records the mirrors and API URLs the traffic was
+    captured against; every other line is one exchange. Credentials in
+    query strings (also inside URL-valued parameters), headers and text
+    bodies (JSON/JS fields and embedded URLs such as dlinks) are redacted
+    before anything is written; bodies are stored decoded, and beyond
+    CASSETTE_MAX_BODY keep only their length. On replay, exchanges with
+    the same method and sanitized URL are served in recorded order, and
+    the last one repeats once they run out.
+    """
+    
+    SENSITIVE_PARAMS = {
+        "api", "key", "token", "sign", "jstoken", "bdstoken", "access_token",
+        "uk", "shareid", "user", "logid", "devuid", "timestamp", "time", "rand"
+    }
+    SENSITIVE_HEADERS = {"cookie", "set-cookie", "authorization", "proxy-authorization", "public-api-token"}
+    TEXT_TYPES = ("json", "html", "javascript", "text", "xml")
+    # "name": "value", name = 'value', name: decodeURIComponent("value") and bare numbers
+    BODY_FIELD = re.compile(
+        r"""(["']?)\b(%s)\1(\s*[:=]\s*(?:[\w.]+\(\s*)?)(?:(["'])(?:\\.|(?!\4).)*\4|-?\d+)"""
+        % "|".join(sorted(SENSITIVE_PARAMS)),
+        re.IGNORECASE
+    )
+    BODY_URL = re.compile(r"""https?:(?:\\?/){2}[^\s"'<>]+""")
+    
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.queues = defaultdict(deque)  # key -> exchanges still to replay
+        self.last = {}  # key -> last exchange served
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self.file = None
+        if mode == "replay":
+            self.load()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+            if self.file.tell() == 0:
+                self._write({
+                    "cassette": 1,
+                    "recorded_at": datetime.now().isoformat(timespec="seconds"),
+                    "mirrors": Config.TERABOX_MIRRORS,
+                    "external_api_url": Config.EXTERNAL_API_URL,
+                    "shortlink_url": Config.SHORTLINK_URL
+                })
+    
+    @classmethod
+    def sanitize_url(cls, url):
+        parts = urllib.parse.urlsplit(url)
+        query = [
+            (name, "REDACTED" if name.lower() in cls.SENSITIVE_PARAMS
+             else cls.sanitize_url(value) if value.startswith(("http://", "https://")) else value)
+            for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        ]
+        # Rebuilding the netloc drops any user:password@
+        netloc = (parts.hostname or "") + (f":{parts.port}" if parts.port else "")
+        return urllib.parse.urlunsplit((parts.scheme, netloc, parts.path, urllib.parse.urlencode(query), ""))
+    
+    @classmethod
+    def sanitize_body(cls, body):
+        """Redact credential fields and URL query parameters in a text body"""
+        def url(match):
+            value = match.group(0)
+            escaped = "\\/" in value
+            value = value.replace("\\/", "/").replace("\\u0026", "&")
+            clean = cls.sanitize_url(value)
+            return clean.replace("/", "\\/") if escaped else clean
+        
+        # URLs first, so their own name=value pairs are not mistaken for fields
+        text = cls.BODY_URL.sub(url, body.decode("latin-1"))
+        text = cls.BODY_FIELD.sub(lambda m: f'{m.group(1)}{m.group(2)}{m.group(1)}{m.group(3)}"REDACTED"', text)
+        return text.encode("latin-1")
+    
+    @classmethod
+    def sanitize_headers(cls, headers):
+        return {
+            name: "REDACTED" if name.lower() in cls.SENSITIVE_HEADERS else value
+            for name, value in headers.items() if name.lower() != "transfer-encoding"
+        }
+    
+    def _write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+    
+    def record(self, exchange):
+        self._write(exchange)
+        self.recorded += 1
+    
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "cassette" in entry:
+                    self.meta = entry
+                else:
+                    self.queues[f"{entry['method']} {entry['url']}"].append(entry)
+    
+    def next(self, method, url):
+        """The exchange to replay for a request, or None if it was never recorded"""
+        key = f"{method} {self.sanitize_url(url)}"
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue:
+                self.last[key] = queue.popleft()
+            exchange = self.last.get(key)
+            if exchange is None:
+                self.misses += 1
+            else:
+                self.replayed += 1
+            return exchange
+    
+    def shorturls(self):
+        """Share ids the recording resolved, to drive a replay run"""
+        found = set()
+        for key in list(self.queues) + list(self.last):
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(key.split(" ", 1)[1]).query)
+            for value in query.get("shorturl", []) + query.get("surl", []):
+                found.add(value)
+            for value in query.get("url", []):
+                shorturl = TeraboxDownloader.parse_shorturl(value)
+                if shorturl:
+                    found.add(shorturl)
+        return sorted(found)
+    
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses
+        }
+
+class _RecordingBody:
+    """File-like over a live urllib3 response that keeps what was read and the time spent reading"""
+    
+    def __init__(self, raw, exchange, cassette):
+        self.raw = raw
+        self.exchange = exchange
+        self.cassette = cassette
+        self.body = bytearray()
+        self.size = 0
+        self.read_seconds = 0.0
+        self.eof = False
+        self.closed = False
+    
+    def read(self, amt=None):
+        if self.closed:
+            return b""
+        started = time.perf_counter()
+        data = self.raw.read(amt, decode_content=False)
+        self.read_seconds += time.perf_counter() - started
+        self.size += len(data)
+        room = Config.CASSETTE_MAX_BODY - len(self.body)
+        if room > 0:
+            self.body += data[:room]
+        if not data and amt != 0:
+            self.eof = True
+        return data
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.eof:
+            self.raw.release_conn()
+        else:
+            # Abandoned early (e.g. the page scanner found its block)
+            self.raw.close()
+        body, size = self._stored_body()
+        self.exchange.update(
+            body=base64.b64encode(body).decode(),
+            body_bytes=size,
+            body_ms=round(self.read_seconds * 1000, 1),
+            complete=self.eof
+        )
+        self.cassette.record(self.exchange)
+    
+    def _stored_body(self):
+        """(body, size) as written: decoded, and redacted when it is text"""
+        headers = self.exchange.get("headers", {})
+        lowered = {name.lower(): value for name, value in headers.items()}
+        encoding = lowered.get("content-encoding", "identity").strip().lower()
+        body = bytes(self.body)
+        whole = self.eof and len(body) == self.size
+        size = self.size
+        if encoding not in ("", "identity"):
+            try:
+                if encoding not in ("gzip", "x-gzip", "deflate"):
+                    raise zlib.error(f"cannot decode {encoding}")
+                body = zlib.decompressobj(32 + zlib.MAX_WBITS).decompress(body)
+            except zlib.error:
+                # Undecodable means unredactable: keep status and headers only
+                body, size, whole = b"", 0, True
+            size = len(body) if whole else max(size, len(body))
+            body = body[:Config.CASSETTE_MAX_BODY]
+        content_type = lowered.get("content-type", "text").lower()
+        if any(kind in content_type for kind in Cassette.TEXT_TYPES):
+            redacted = Cassette.sanitize_body(body)
+            if whole:
+                size = len(redacted)
+            body = redacted
+        # Stored bodies are identity with their own length
+        self.exchange["headers"] = {
+            name: value for name, value in headers.items()
+            if name.lower() not in ("content-encoding", "content-length")
+        }
+        return body, size
+
+class _ReplayBody:
+    """Serves a recorded body, paced over its recorded read time"""
+    
+    def __init__(self, body, size, seconds):
+        self.body = body
+        self.size = size
+        self.seconds = seconds
+        self.pos = 0
+        self.started = None
+        self.closed = False
+    
+    def read(self, amt=None):
+        if self.closed or self.pos >= self.size:
+            return b""
+        count = self.size - self.pos if amt is None else min(amt, self.size - self.pos)
+        # Bodies past CASSETTE_MAX_BODY were stored by length only
+        chunk = self.body[self.pos:self.pos + count]
+        chunk += b"\0" * (count - len(chunk))
+        self.pos += count
+        if self.seconds:
+            if self.started is None:
+                self.started = time.monotonic()
+            delay = self.started + self.seconds * self.pos / self.size - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return chunk
+    
+    def close(self):
+        self.closed = True
+
+class CassetteAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that records exchanges into a Cassette or replays them from it"""
+    
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+    
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if self.cassette.mode == "replay":
+            exchange = self.cassette.next(request.method, request.url)
+            if exchange is not None:
+                return self._replay(request, exchange)
+            if Config.CASSETTE_MISS != "passthrough":
+                raise requests.exceptions.ConnectionError(
+                    f"Not in cassette: {request.method} {Cassette.sanitize_url(request.url)}", request=request
+                )
+            return super().send(request, stream, timeout, verify, cert, proxies)
+        
+        exchange = {"method": request.method, "url": Cassette.sanitize_url(request.url)}
+        started = time.perf_counter()
+        try:
+            # Always streamed here; Session.send reads the body for stream=False
+            response = super().send(request, True, timeout, verify, cert, proxies)
+        except requests.RequestException as e:
+            exchange.update(error=type(e).__name__, elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
+            self.cassette.record(exchange)
+            raise
+        exchange.update(
+            status=response.status_code,
+            reason=response.reason,
+            headers=Cassette.sanitize_headers(response.headers),
+            elapsed_ms=round((time.perf_counter() - started) * 1000, 1)
+        )
+        headers = {k: v for k, v in response.headers.items() if k.lower() != "transfer-encoding"}
+        body = _RecordingBody(response.raw, exchange, self.cassette)
+        return self._build(request, response.status_code, response.reason, headers, body)
+    
+    def _replay(self, request, exchange):
+        scale = Config.CASSETTE_LATENCY_SCALE
+        time.sleep(exchange.get("elapsed_ms", 0) / 1000 * scale)
+        if "error" in exchange:
+            error = getattr(requests.exceptions, exchange["error"], requests.exceptions.ConnectionError)
+            raise error(f"Replayed {exchange['error']} for {exchange['url']}", request=request)
+        data = base64.b64decode(exchange.get("body", ""))
+        size = exchange.get("body_bytes", 0)
+        headers = exchange.get("headers", {})
+        if len(data) < size:
+            data, size, headers = self._truncated(data, size, headers)
+        body = _ReplayBody(data, size, exchange.get("body_ms", 0) / 1000 * scale)
+        return self._build(request, exchange["status"], exchange.get("reason"), headers, body)
+    
+    @staticmethod
+    def _truncated(data, size, headers):
+        """A body cut at CASSETTE_MAX_BODY: zero padding is only safe after decoding,
+        so compressed prefixes are decoded here and served as identity"""
+        encoding = next((v for k, v in headers.items() if k.lower() == "content-encoding"), "identity")
+        if encoding.strip().lower() in ("", "identity"):
+            return data, size, headers
+        headers = {k: v for k, v in headers.items() if k.lower() not in ("content-encoding", "content-length")}
+        if encoding.strip().lower() in ("gzip", "x-gzip", "deflate"):
+            try:
+                # 32 + MAX_WBITS accepts both gzip and zlib framing
+                decoded = zlib.decompressobj(32 + zlib.MAX_WBITS).decompress(data)
+                return decoded, max(size, len(decoded)), headers
+            except zlib.error:
+                pass
+        # An encoding we cannot decode here: status and headers only
+        return b"", 0, headers
+    
+    def _build(self, request, status, reason, headers, body):
+        raw = urllib3.HTTPResponse(
+            body=body, headers=headers, status=status, reason=reason,
+            preload_content=False, decode_content=True,
+            request_method=request.method, request_url=request.url
+        )
+        return self.build_response(request, raw)
+
+# Shared by every pooled session once CASSETTE_MODE is set
+_cassette = None
+
+def open_cassette():
+    global _cassette
+    if _cassette is None or (_cassette.path, _cassette.mode) != (Config.CASSETTE_PATH, Config.CASSETTE_MODE):
+        _cassette = Cassette(Config.CASSETTE_PATH, Config.CASSETTE_MODE)
+    return _cassette
+
+def pooled_session():
+    """requests.Session whose per-host pool fits the transfer and thumbnail threads"""
+    session = requests.Session()
+    pool = {"pool_connections": Config.PREWARM_MAX_HOSTS, "pool_maxsize": Config.HTTP_POOL_SIZE}
+    if Config.CASSETTE_MODE in ("record", "replay"):
+        adapter = CassetteAdapter(open_cassette(), **pool)
+    else:
+        adapter = requests.adapters.HTTPAdapter(**pool)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class ConnectionWarmer:
+    """Keeps connections to the Terabox mirrors, dlink CDNs and shortlink host open.
+    
+    At startup, and whenever an origin has been idle for PREWARM_IDLE
+    (servers close keep-alive connections after about a minute), a few
+    parallel HEADs refill the session pool so the next real request skips
+    DNS, TCP and TLS. Origins seen in responses, such as dlink CDN hosts,
+    are learned and dropped again after PREWARM_FORGET without traffic.
+    Response hooks run on request threads, so origins are only read or
+    changed under the lock.
+    """
+    
+    def __init__(self):
+        self.origins = {}  # origin -> {"session", "used", "warmed", "learned"}
+        self.sessions = []
+        self.warms = 0
+        self.failures = 0
+        self.last_round = None
+        self._lock = threading.Lock()
+    
+    def watch(self, session, urls):
+        if session not in self.sessions:
+            self.sessions.append(session)
+            session.hooks["response"].append(functools.partial(self._touch, session))
+        with self._lock:
+            for url in urls:
+                origin = self._origin(url)
+                if origin:
+                    self.origins.setdefault(origin, {"session": session, "used": 0, "warmed": 0, "learned": False})
+    
+    @staticmethod
+    def _origin(url):
+        parts = urllib.parse.urlsplit(url or "")
+        return f"{parts.scheme}://{parts.netloc}" if parts.scheme in ("http", "https") and parts.netloc else None
+    
+    def _touch(self, session, response, *args, **kwargs):
+        # Our own HEADs keep connections alive but are not traffic
+        if response.request.method == "HEAD":
+            return
+        origin = self._origin(response.url)
+        if not origin:
+            return
+        with self._lock:
+            entry = self.origins.get(origin)
+            if entry is None:
+                if sum(e["learned"] for e in self.origins.values()) >= Config.PREWARM_MAX_HOSTS:
+                    return
+                entry = self.origins[origin] = {"session": session, "used": 0, "warmed": 0, "learned": True}
+            entry["used"] = time.monotonic()
+    
+    def _warm_one(self, origin, session):
+        try:
+            session.head(f"{origin}/", timeout=Config.PREWARM_TIMEOUT, allow_redirects=False).close()
+            with self._lock:
+                self.warms += 1
+        except requests.RequestException as e:
+            with self._lock:
+                self.failures += 1
+            logger.debug(f"Pre-warming {origin} failed: {e}")
+    
+    async def warm(self, origins):
+        now = time.monotonic()
+        calls = []
+        with self._lock:
+            entries = [(origin, self.origins.get(origin)) for origin in origins]
+            for _, entry in entries:
+                if entry:
+                    entry["warmed"] = now
+        for origin, entry in entries:
+            if entry:
+                calls += [
+                    asyncio.to_thread(self._warm_one, origin, entry["session"]) for _ in range(Config.PREWARM_CONNECTIONS)
+                ]
+        await asyncio.gather(*calls)
+        self.last_round = time.time()
+    
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                for origin, entry in list(self.origins.items()):
+                    if entry["learned"] and now - entry["used"] > Config.PREWARM_FORGET:
+                        del self.origins[origin]
+                idle = [
+                    origin for origin, entry in self.origins.items()
+                    if now - max(entry["used"], entry["warmed"]) >= Config.PREWARM_IDLE
+                ]
+            if idle:
+                await self.warm(idle)
+            await asyncio.sleep(max(1.0, Config.PREWARM_IDLE / 3))
+    
+    @staticmethod
+    def pool_stats(session):
+        """Per-origin urllib3 pool: idle connections, connections opened, requests sent"""
+        pools = {}
+        for adapter in set(session.adapters.values()):
+            manager = adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                    "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                    "opened": pool.num_connections,
+                    "requests": pool.num_requests
+                }
+        return pools
+    
+    def stats(self):
+        now = time.monotonic()
+        pools = {}
+        for session in self.sessions:
+            pools.update(self.pool_stats(session))
+        with self._lock:
+            origins = {
+                origin: {
+                    "learned": entry["learned"],
+                    "idle_seconds": round(now - max(entry["used"], entry["warmed"]), 1) if entry["used"] or entry["warmed"] else None
+                }
+                for origin, entry in self.origins.items()
+            }
+            warms, failures = self.warms, self.failures
+        return {
+            "warms": warms,
+            "failures": failures,
+            "last_round": datetime.fromtimestamp(self.last_round).isoformat(timespec="seconds") if self.last_round else None,
+            "origins": origins,
+            "pools": pools
+        }
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single execution"""
+    
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+    
+    async def do(self, key, fn):
+        """Run fn() once per key; returns (result, shared).
+        
+        Callers arriving while a call for the same key is in flight wait for
+        it and get shared=True; a failure is raised to every caller.
+        """
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), True
+        
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting; don't log "exception never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.set_exception(RuntimeError("shared transfer was cancelled"))
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self.calls.pop(key, None)
+    
+    def stats(self):
+        return {"in_flight": len(self.calls), "coalesced": self.coalesced}
+
+class JobJournal:
+    """SQLite record of every leech job so restarts can resume them.
+    
+    Stages: queued -> resolving -> transferring -> done | manual | failed |
+    expired. The resolved file_info (with its dlink) is stored once known.
+    """
+    
+    FINISHED = ("done", "manual", "failed", "expired")
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS leech_jobs (
+            job_id TEXT PRIMARY KEY, user_id INTEGER, chat_id INTEGER, status_msg_id INTEGER,
+            url TEXT, shorturl TEXT, is_premium INTEGER, tier TEXT, stage TEXT, file_info TEXT,
+            bytes_done INTEGER, attempts INTEGER, created REAL, updated REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS leech_jobs_stage ON leech_jobs (stage, created)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS uploads (file_key TEXT PRIMARY KEY, receipt TEXT, created REAL)")
+    
+    def add(self, job):
+        job = dict(job, job_id=uuid.uuid4().hex, file_info=None, bytes_done=0, attempts=1, created=time.time())
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO leech_jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, 0, 1, ?, ?)",
+                (job["job_id"], job["user_id"], job["chat_id"], job["status_msg_id"], job["url"],
+                 job["shorturl"], int(job["is_premium"]), job["tier"], job["stage"], job["created"], job["created"])
+            )
+        return job
+    
+    def update(self, job_id, **fields):
+        if "file_info" in fields:
+            fields["file_info"] = json.dumps(fields["file_info"])
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE leech_jobs SET {columns}, updated = ? WHERE job_id = ?",
+                (*fields.values(), time.time(), job_id)
+            )
+    
+    def unfinished(self):
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM leech_jobs WHERE stage NOT IN ({', '.join('?' * len(self.FINISHED))}) ORDER BY created",
+                self.FINISHED
+            ).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["is_premium"] = bool(job["is_premium"])
+            job["file_info"] = json.loads(job["file_info"]) if job["file_info"] else None
+            jobs.append(job)
+        return jobs
+    
+    def remember_upload(self, file_key, receipt):
+        """Telegram references of a split upload, for re-sending without a transfer"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)", (file_key, json.dumps(receipt), time.time())
+            )
+    
+    def find_upload(self, file_key):
+        with self._lock:
+            row = self._conn.execute("SELECT receipt FROM uploads WHERE file_key = ?", (file_key,)).fetchone()
+        return json.loads(row["receipt"]) if row else None
+    
+    def forget_upload(self, file_key):
+        with self._lock:
+            self._conn.execute("DELETE FROM uploads WHERE file_key = ?", (file_key,))
+    
+    def prune(self, max_age):
+        """Drop finished jobs older than max_age seconds"""
+        with self._lock:
+            return self._conn.execute(
+                f"DELETE FROM leech_jobs WHERE stage IN ({', '.join('?' * len(self.FINISHED))}) AND updated < ?",
+                (*self.FINISHED, time.time() - max_age)
+            ).rowcount
+
+class Broadcaster:
+    """Sends one admin message to every user at Telegram's bulk rate.
+    
+    Recipients are snapshotted into a JSON checkpoint (BROADCAST_CHECKPOINT)
+    that is rewritten as sending progresses, so a restart resumes where the
+    previous instance stopped. A FloodWait pauses every sender; users who
+    blocked the bot or were deleted are marked inactive and skipped from
+    then on. Anything else only counts as failed for this broadcast.
+    """
+    
+    PRUNE_ERRORS = (
+        errors.UserIsBlockedError, errors.InputUserDeactivatedError, errors.UserDeactivatedError,
+        errors.UserDeactivatedBanError, errors.ChatWriteForbiddenError
+    )
+    
+    def __init__(self, client, storage, path=None):
+        self.client = client
+        self.storage = storage
+        self.path = path or Config.BROADCAST_CHECKPOINT
+        self.bucket = TokenBucket(Config.BROADCAST_RATE, Config.BROADCAST_RATE)
+        self.paused_until = 0.0
+        self.state = None
+        self.task = None
+        self._rate_lock = asyncio.Lock()
+    
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+    
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+    
+    def start(self, admin_chat, status_msg_id, text=None, source_msg_id=None):
+        """Snapshot the recipients and begin sending in the background"""
+        recipients = sorted(
+            int(user_id) for user_id, user in self.storage.users.items() if not user.get("inactive")
+        )
+        self.state = {
+            "id": uuid.uuid4().hex[:8], "admin_chat": admin_chat, "status_msg_id": status_msg_id,
+            "text": text, "source_msg_id": source_msg_id, "recipients": recipients,
+            "cursor": 0, "done_above": [], "sent": 0, "failed": 0, "pruned": 0, "elapsed": 0.0
+        }
+        self.save()
+        self.task = asyncio.create_task(self.run())
+    
+    def resume(self):
+        """Startup: continue a broadcast an earlier instance left unfinished"""
+        self.state = self.load()
+        if self.state and not self.state.get("cancelled") and self.state["cursor"] < len(self.state["recipients"]):
+            logger.info(f"📣 Resuming broadcast {self.state['id']} at {self.state['cursor']}/{len(self.state['recipients'])}")
+            self.task = asyncio.create_task(self.run())
+    
+    def cancel(self):
+        """Admin stop: unlike a shutdown, the broadcast is not resumed later"""
+        if self.running:
+            self.state["cancelled"] = True
+            self.task.cancel()
+    
+    async def _take(self):
+        """Wait for a global send slot (token bucket + FloodWait pause)"""
+        async with self._rate_lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                elif self.bucket.try_take():
+                    return
+                else:
+                    await asyncio.sleep(self.bucket.wait_time())
+    
+    async def _send_one(self, user_id, message):
+        """'sent', 'pruned' or 'failed'; FloodWait and server errors are retried"""
+        for attempt in range(4):
+            await self._take()
+            try:
+                await self.client.send_message(user_id, message)
+                return "sent"
+            except errors.FloodWaitError as e:
+                # Bot-wide limit: hold every sender, then retry this chat
+                self.paused_until = max(self.paused_until, time.monotonic() + e.seconds + 1)
+                logger.warning(f"Broadcast FloodWait {e.seconds}s")
+            except self.PRUNE_ERRORS as e:
+                user = self.storage.users.get(str(user_id))
+                if user is not None:
+                    user["inactive"] = type(e).__name__
+                return "pruned"
+            except errors.PeerIdInvalidError:
+                # Usually a peer this session has not cached yet, not a deleted user
+                return "failed"
+            except (errors.ServerError, errors.RPCError, ConnectionError, asyncio.TimeoutError) as e:
+                logger.debug(f"Broadcast to {user_id} failed ({e}); attempt {attempt + 1}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.warning(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+        return "failed"
+    
+    async def run(self):
+        state = self.state
+        recipients = state["recipients"]
+        message = state["text"]
+        if state["source_msg_id"]:
+            message = await self.client.get_messages(state["admin_chat"], ids=state["source_msg_id"])
+            if not message:
+                logger.error(f"Broadcast {state['id']}: source message is gone")
+                return
+        
+        done_above = set(state["done_above"])
+        in_flight = set()
+        unsent = set()  # interrupted mid-send; the cursor must not pass these
+        next_index = state["cursor"]
+        started = time.monotonic() - state["elapsed"]
+        sent_at_start = state["sent"] + state["failed"] + state["pruned"]
+        resumed_at = time.monotonic()
+        
+        def checkpoint():
+            # Everything below the lowest in-flight index is done
+            low = min(in_flight | unsent, default=next_index)
+            state["cursor"] = low
+            state["done_above"] = sorted(i for i in done_above if i >= low)
+            state["elapsed"] = time.monotonic() - started
+            self.save()
+        
+        async def worker():
+            nonlocal next_index
+            while next_index < len(recipients):
+                index = next_index
+                next_index += 1
+                if index in done_above:
+                    continue
+                in_flight.add(index)
+                try:
+                    result = await self._send_one(recipients[index], message)
+                except BaseException:
+                    unsent.add(index)
+                    raise
+                finally:
+                    in_flight.discard(index)
+                done_above.add(index)
+                state[result] += 1
+        
+        async def report(final=False):
+            processed = state["sent"] + state["failed"] + state["pruned"]
+            rate = (processed - sent_at_start) / max(time.monotonic() - resumed_at, 0.001)
+            remaining = len(recipients) - processed
+            eta = f"{remaining / rate / 60:.1f} min" if rate and not final else "-"
+            with contextlib.suppress(Exception):
+                await self.client.edit_message(
+                    state["admin_chat"], state["status_msg_id"],
+                    f"📣 **Broadcast {'finished' if final else 'in progress'}** `{state['id']}`\n\n"
+                    f"**Progress:** {processed}/{len(recipients)}\n"
+                    f"✅ **Sent:** {state['sent']}\n"
+                    f"🚫 **Pruned (blocked/deleted):** {state['pruned']}\n"
+                    f"❌ **Failed:** {state['failed']}\n"
+                    f"⚡ **Rate:** {rate:.1f} msg/s | **ETA:** {eta}"
+                )
+        
+        workers = [asyncio.create_task(worker()) for _ in range(Config.BROADCAST_CONCURRENCY)]
+        try:
+            while not all(w.done() for w in workers):
+                await asyncio.wait(workers, timeout=Config.PROGRESS_INTERVAL)
+                await asyncio.to_thread(checkpoint)
+                await report()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await asyncio.to_thread(checkpoint)
+        
+        await report(final=True)
+        logger.info(f"📣 Broadcast {state['id']} done: {state['sent']} sent, {state['pruned']} pruned, {state['failed']} failed")
+
 class TeraboxBot:
     """Main bot class with configurable shortlink integration"""
     
-    def __init__(self):
-        self.client = TelegramClient('bot', Config.API_ID, Config.API_HASH)
+    def __init__(self, client=None, transfer_only=False):
+        # transfer_only: just what deliver_file needs, for worker processes and
+        # fleet nodes; no storage, command state, stream proxy or temp-file sweep
+        self.client = client or TelegramClient('bot', Config.API_ID, Config.API_HASH)
+        self.download_shaper = BandwidthShaper(int(Config.DOWNLOAD_LIMIT_MBPS * 1024 * 1024))
+        self.upload_shaper = BandwidthShaper(int(Config.UPLOAD_LIMIT_MBPS * 1024 * 1024))
+        self.downloader = TeraboxDownloader()
+        self.cache = DiskCache(sweep=not transfer_only) if Config.CACHE_MAX_BYTES > 0 else None
+        self.thumbnails = ThumbnailService(self.downloader.session) if Config.THUMBNAILS else None
+        self.warmer = ConnectionWarmer()
+        self.warmer.watch(self.downloader.session, Config.TERABOX_MIRRORS)
+        self.journal = JobJournal(Config.JOURNAL_PATH) if Config.JOURNAL_PATH else None
+        self.uploads = {}  # split-upload receipts when there is no journal
+        if transfer_only:
+            return
+        
         self.storage = SimpleStorage()
         self.shortlink = ShortlinkAPI()
         self.payment_manager = PaymentManager(self.storage)
+        self.reconciler = PaymentReconciler(self.storage)
+        self.broadcaster = Broadcaster(self.client, self.storage)
+        health_sections["bandwidth"] = lambda: {
+            "download": self.download_shaper.stats(), "upload": self.upload_shaper.stats()
+        }
+        stream_proxy.attach(self)
+        health_sections["streams"] = stream_proxy.stats
+        self.leech_limiter = SlidingWindowLimiter(Config.LEECH_RATE_WINDOW)
+        self.command_limiter = SlidingWindowLimiter(Config.COMMAND_RATE_WINDOW)
+        health_sections["rate_limits"] = lambda: {
+            "leech": self.leech_limiter.stats(), "commands": self.command_limiter.stats()
+        }
         self.user_manager = UserManager(self.storage)
         self.token_manager = TokenManager(self.storage, self.shortlink)
-        self.downloader = TeraboxDownloader()
+        self.resolver = ResolverPipeline(self.downloader)
+        health_sections["resolvers"] = self.resolver.stats
+        self.transfer_pool = TransferPool(Config.TRANSFER_WORKERS) if Config.TRANSFER_WORKERS > 0 else None
+        self.job_queue = create_job_queue(Config.JOB_QUEUE_URL)
+        self.warmer.watch(self.shortlink.session, [self.shortlink.base_url])
+        if "external" in self.resolver.order:
+            self.warmer.watch(self.resolver.session, [Config.EXTERNAL_API_URL])
+        health_sections["network"] = lambda: {"dns": dns_cache.stats(), **self.warmer.stats()}
+        if _cassette:
+            health_sections["cassette"] = _cassette.stats
+        health_sections["accounts"] = self.downloader.accounts.stats
+        health_sections["proxies"] = self.downloader.proxies.stats
+        # Identical links sent while one is in flight share its transfer
+        self.flights = SingleFlight()
+        health_sections["flights"] = self.flights.stats
+        self.active_jobs = {}  # job_id -> (task, progress)
+        self.draining = False
+        self.register_memory_sections()
+    
+    def register_memory_sections(self):
+        """What /memory reports per structure; deep sizes only for the user-driven stores"""
+        storage = self.storage
+        
+        def users():
+            records = list(storage.users.values())
+            lists = {
+                name: [len(record.get(name) or ()) for record in records]
+                for name in ("tokens", "verified_tokens", "subscriptions")
+            }
+            return {
+                "count": len(records),
+                "bytes": deep_sizeof(storage.users),
+                **{f"{name}_total": sum(sizes) for name, sizes in lists.items()},
+                **{f"{name}_max": max(sizes, default=0) for name, sizes in lists.items()}
+            }
+        
+        memory_monitor.sections.update({
+            "users": users,
+            "payments": lambda: {"count": len(storage.payments), "bytes": deep_sizeof(storage.payments)},
+            "tokens": lambda: {"count": len(storage.tokens), "bytes": deep_sizeof(storage.tokens)},
+            "analytics": lambda: {
+                "days": len(storage.analytics.days),
+                "active_ids": sum(len(day["active"]) for day in list(storage.analytics.days.values())),
+                "premium_expiries": len(storage.analytics._expiry_heap)
+            },
+            "thumbnails": lambda: {
+                "entries": len(self.thumbnails.cache),
+                "bytes": sum(len(data) for data in list(self.thumbnails.cache.values()) if data)
+            } if self.thumbnails else None,
+            "disk_cache_index": lambda: {"entries": len(self.cache.entries)} if self.cache else None,
+            "transfers": lambda: {
+                "open_streams": len(TransferStream.live),
+                "buffered_bytes": sum(len(stream._prefix) for stream in list(TransferStream.live)),
+                "active_jobs": len(self.active_jobs),
+                "flights": len(self.flights.calls)
+            },
+            "rate_limit_keys": lambda: {
+                "leech": len(self.leech_limiter.keys), "commands": len(self.command_limiter.keys)
+            },
+            "resolver_memo": lambda: {"entries": len(self.resolver.memo)},
+            "stream_links": lambda: {"entries": len(stream_proxy.links)},
+            "dns_cache": lambda: {"entries": len(dns_cache.entries)},
+            "split_uploads": lambda: {"entries": len(self.uploads)}
+        })
     
     def is_admin(self, user_id):
         return user_id == Config.OWNER_ID or user_id in Config.ADMIN_IDS
@@ -593,9 +3757,30 @@ class TeraboxBot:
         self.client.add_event_handler(self.handle_verify, events.NewMessage(pattern='/verify'))
         self.client.add_event_handler(self.handle_stats, events.NewMessage(pattern='/stats'))
         self.client.add_event_handler(self.handle_confirm, events.NewMessage(pattern='/confirm'))
+        self.client.add_event_handler(self.handle_broadcast, events.NewMessage(pattern='/broadcast'))
+        self.client.add_event_handler(self.handle_adminstats, events.NewMessage(pattern='/adminstats'))
+        self.client.add_event_handler(self.handle_memory, events.NewMessage(pattern='/memory'))
+        self.client.add_event_handler(self.handle_statement, events.NewMessage(func=lambda e: e.message.document is not None))
         self.client.add_event_handler(self.handle_leech, events.NewMessage())
         self.client.add_event_handler(self.handle_callbacks, events.CallbackQuery())
         
+        self.loop_monitor_task = asyncio.create_task(loop_monitor.run())
+        self.memory_monitor_task = asyncio.create_task(memory_monitor.run())
+        if Config.PREWARM_CONNECTIONS > 0:
+            self.warmer_task = asyncio.create_task(self.warmer.run())
+        if self.downloader.proxies.proxies:
+            self.proxy_check_task = asyncio.create_task(self.downloader.proxies.run(self.downloader.session))
+        if self.transfer_pool:
+            self.transfer_pool.start()
+        if self.job_queue and Config.BOT_ROLE == "all":
+            self.fleet_worker_task = asyncio.create_task(FleetWorker(self.job_queue, self).run())
+        if self.journal:
+            self.resume_task = asyncio.create_task(self.resume_jobs())
+        self.broadcaster.resume()
+        with contextlib.suppress(NotImplementedError):
+            # Koyeb sends SIGTERM on redeploy; finish or checkpoint jobs first
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.drain()))
+        
         logger.info(f"🚀 Ultimate Terabox Bot started with {Config.SHORTLINK_URL}!")
         await self.client.run_until_disconnected()
     
@@ -616,9 +3801,9 @@ class TeraboxBot:
             if remaining > 0:
                 status = f"🆓 **Free User** ({remaining}/{Config.FREE_DOWNLOADS} downloads)"
             elif has_token:
-                status = f"✅ **Verified** (Unlimited downloads)"
+                status = "✅ **Verified** (Unlimited downloads)"
             else:
-                status = f"🔒 **Verification Required** (Free downloads used)"
+                status = "🔒 **Verification Required** (Free downloads used)"
         
         buttons = [
             [Button.inline("📊 My Stats", b"stats"), Button.inline("🔗 Verify Free", b"verify")],
@@ -651,8 +3836,28 @@ class TeraboxBot:
 📁 Send me a Terabox link to start downloading!"""
         
         await event.respond(start_text, buttons=buttons)
+    async def rate_limited(self, event, limiter, key, limit, what, hint=""):
+        """Count one request against limiter; tells the user and returns True when over"""
+        retry_after = limiter.hit(key, limit)
+        if not retry_after:
+            return False
+        
+        wait = f"{int(retry_after // 60)}m {int(retry_after % 60)}s" if retry_after >= 60 else f"{int(retry_after) + 1}s"
+        text = f"⏳ **Slow down!** You can send {limit} {what} every {self.format_window(limiter.window)}.\n**Try again in:** {wait}{hint}"
+        if isinstance(event, events.CallbackQuery.Event):
+            await event.answer(text.replace("**", ""), alert=True)
+        else:
+            await event.respond(text)
+        return True
+    
+    @staticmethod
+    def format_window(seconds):
+        return f"{seconds / 3600:g}h" if seconds >= 3600 else f"{seconds / 60:g} min" if seconds >= 60 else f"{seconds:g}s"
+    
     async def handle_verify(self, event):
         user_id = event.sender_id
+        if await self.rate_limited(event, self.command_limiter, ("verify", user_id), Config.COMMAND_RATE_LIMIT, "verification requests"):
+            return
         
         active_sub = self.user_manager.get_active_subscription(user_id)
         if active_sub:
@@ -711,7 +3916,6 @@ Your verification link is monetized with {shortlink_name}!
         
         await event.respond(verify_text, buttons=buttons)
     async def handle_buy(self, event):
-        user_id = event.sender_id
         command_parts = event.message.text.split()
         
         if len(command_parts) == 1:
@@ -761,6 +3965,8 @@ Your verification link is monetized with {shortlink_name}!
     
     async def process_payment_request(self, event, plan_key):
         user_id = event.sender_id
+        if await self.rate_limited(event, self.command_limiter, ("payment", user_id), Config.COMMAND_RATE_LIMIT, "payment requests"):
+            return
         
         active_sub = self.user_manager.get_active_subscription(user_id)
         if active_sub:
@@ -848,33 +4054,41 @@ Use `/confirm {payment_id}` after payment verification"""
         if payment_info["status"] != "pending":
             await event.respond(f"❌ **Payment already {payment_info['status']}!**")
             return
-        confirmed = self.payment_manager.verify_payment(payment_id)
+        confirmed = self.confirm_payment(payment_info)
         
         if confirmed:
-            customer_id = payment_info["user_id"]
-            hours = payment_info["hours"]
-            amount = payment_info["amount"]
-            
-            self.user_manager.add_premium_subscription(customer_id, hours, amount, payment_id)
-            
             await event.respond(
                 f"✅ **Payment Confirmed!**\\n\\n"
                 f"**Payment ID:** `{payment_id}`\\n"
                 f"**Plan:** {payment_info['plan_name']}\\n"
-                f"**Amount:** ₹{amount}\\n"
-                f"**Duration:** {hours} hours\\n\\n"
+                f"**Amount:** ₹{payment_info['amount']}\\n"
+                f"**Duration:** {payment_info['hours']} hours\\n\\n"
                 f"User has been granted premium access!"
             )
             
-            try:
-                customer_text = f"""🎉 **Premium Activated!**
+            await self.notify_customer(payment_info)
+        else:
+            await event.respond("❌ **Failed to confirm payment!** Please try again.")
+    
+    def confirm_payment(self, payment_info):
+        """Mark a pending payment completed and grant its premium hours"""
+        if not self.payment_manager.verify_payment(payment_info["payment_id"]):
+            return False
+        self.user_manager.add_premium_subscription(
+            payment_info["user_id"], payment_info["hours"], payment_info["amount"], payment_info["payment_id"]
+        )
+        return True
+    
+    async def notify_customer(self, payment_info):
+        try:
+            customer_text = f"""🎉 **Premium Activated!**
 
 Your payment has been confirmed:
 
 **Plan:** {payment_info["plan_name"]}
-**Duration:** {hours} hours
-**Amount Paid:** ₹{amount}
-**Payment ID:** `{payment_id}`
+**Duration:** {payment_info["hours"]} hours
+**Amount Paid:** ₹{payment_info["amount"]}
+**Payment ID:** `{payment_info["payment_id"]}`
 
 ✅ **Premium features now active:**
 • Unlimited downloads
@@ -884,13 +4098,178 @@ Your payment has been confirmed:
 • Faster download speeds
 
 Start downloading immediately! 🚀"""
-                
-                await self.client.send_message(customer_id, customer_text)
-            except Exception as e:
-                logger.error(f"Error notifying customer: {e}")
+            
+            await self.client.send_message(payment_info["user_id"], customer_text)
+            return True
+        except Exception as e:
+            logger.error(f"Error notifying customer: {e}")
+            return False
+    
+    async def handle_statement(self, event):
+        """Admin uploads a UPI statement CSV: confirm every payment it proves"""
+        document = event.message.document
+        filename = next((a.file_name for a in document.attributes if isinstance(a, DocumentAttributeFilename)), "")
+        if not filename.lower().endswith(".csv"):
+            return
+        if not self.is_admin(event.sender_id):
+            await event.respond("❌ **Access Denied!** Only admins can reconcile payments.")
+            return
+        
+        status_msg = await event.respond("🧾 **Reconciling UPI statement...**")
+        data = await event.message.download_media(file=bytes)
+        payments = list(self.storage.payments.values())
+        try:
+            report = await asyncio.to_thread(
+                self.reconciler.reconcile, data.decode("utf-8-sig", errors="replace"), payments
+            )
+        except (ValueError, csv.Error) as e:
+            await status_msg.edit(f"❌ **Could not read statement:** {e}")
+            return
+        
+        confirmed = []
+        for row, payment_info in report["matched"]:
+            if self.confirm_payment(payment_info):
+                payment_info["utr"] = row["reference"] or None
+                payment_info["confirmed_by"] = "reconciliation"
+                confirmed.append(payment_info)
+        
+        # Customer messages go out concurrently, bounded to stay under flood limits
+        semaphore = asyncio.Semaphore(Config.NOTIFY_CONCURRENCY)
+        
+        async def notify(payment_info):
+            async with semaphore:
+                return await self.notify_customer(payment_info)
+        
+        notified = await asyncio.gather(*[notify(p) for p in confirmed])
+        
+        lines = [
+            "🧾 **Reconciliation Complete**\\n",
+            f"✅ **Confirmed:** {len(confirmed)} (₹{sum(p['amount'] for p in confirmed)}, {sum(notified)} notified)",
+            f"⚠️ **Ambiguous:** {len(report['ambiguous'])}",
+            f"💸 **Amount mismatch:** {len(report['mismatched'])}",
+            f"❓ **Unmatched rows:** {len(report['unmatched'])}",
+            f"🔁 **Duplicates skipped:** {len(report['duplicates'])}"
+        ]
+        for row, candidates in report["ambiguous"][:10]:
+            ids = ", ".join(f"`{p['payment_id']}`" for p in candidates[:5])
+            lines.append(f"• line {row['line']} ₹{row['amount'] / 100:g}: {ids} - use /confirm")
+        for row, payment_info in report["mismatched"][:10]:
+            lines.append(
+                f"• line {row['line']} paid ₹{row['amount'] / 100:g} for `{payment_info['payment_id']}` (₹{payment_info['amount']})"
+            )
+        await status_msg.edit("\\n".join(lines))
+
+    async def handle_broadcast(self, event):
+        """/broadcast <text>, or reply /broadcast to a message to copy it; /broadcast cancel"""
+        if not self.is_admin(event.sender_id):
+            await event.respond("❌ **Access Denied!** Only admins can broadcast.")
+            return
+        
+        parts = event.message.text.split(maxsplit=1)
+        text = parts[1].strip() if len(parts) > 1 else ""
+        reply_id = event.message.reply_to_msg_id
+        
+        if text.lower() == "cancel":
+            if not self.broadcaster.running:
+                await event.respond("ℹ️ **No broadcast is running.**")
+                return
+            self.broadcaster.cancel()
+            await event.respond("🛑 **Broadcast cancelled.** Progress is saved.")
+            return
+        
+        if self.broadcaster.running:
+            await event.respond("⏳ **A broadcast is already running.** Use `/broadcast cancel` to stop it.")
+            return
+        
+        if not text and not reply_id:
+            await event.respond("❌ **Usage:** `/broadcast <message>` or reply to a message with `/broadcast`")
+            return
+        
+        status_msg = await event.respond("📣 **Starting broadcast...**")
+        self.broadcaster.start(event.chat_id, status_msg.id, text=None if reply_id else text, source_msg_id=reply_id)
+    
+    async def handle_adminstats(self, event):
+        """Bot-wide dashboard from the incremental Analytics rollups"""
+        if not self.is_admin(event.sender_id):
+            await event.respond("❌ **Access Denied!** Only admins can view bot statistics.")
+            return
+        
+        stats = self.storage.analytics.dashboard(days=7)
+        totals = stats["totals"]
+        today = stats["today"]
+        daily = "\n".join(
+            f"`{day['date'][5:]}` 📥 {day.get('downloads', 0):>4} | 👥 {day['active_users']:>4} | "
+            f"🆕 {day.get('new_users', 0):>3} | 💰 ₹{day.get('revenue', 0)}"
+            for day in reversed(stats["days"])
+        )
+        
+        await event.respond(f"""📈 **Bot Statistics**
+
+**Users:** {totals.get('new_users', 0)} total | 💎 {stats['active_premium']} premium now
+**Revenue:** ₹{totals.get('revenue', 0)} ({totals.get('payments_completed', 0)} payments)
+**Downloads:** {totals.get('downloads', 0)} ({totals.get('bytes', 0) / (1024 ** 3):.2f} GB)
+
+**Today:**
+• Downloads: {today.get('downloads', 0)} by {today['active_users']} active users
+• New users: {today.get('new_users', 0)}
+• Revenue: ₹{today.get('revenue', 0)}
+
+**Conversion:**
+• Verification links → verified: {stats['verification_conversion']}% ({totals.get('verifications', 0)}/{totals.get('verification_links', 0)})
+• Payment requests → paid: {stats['payment_conversion']}% ({totals.get('payments_completed', 0)}/{totals.get('payments_created', 0)})
+
+**Last 7 days:**
+{daily or 'No activity yet'}""")
+    
+    async def handle_memory(self, event):
+        """Admin memory report; `/memory trace on|off` toggles tracemalloc"""
+        if not self.is_admin(event.sender_id):
+            await event.respond("❌ **Access Denied!** Only admins can view memory usage.")
+            return
+        
+        args = event.message.text.split()[1:]
+        if args[:1] == ["trace"] and len(args) > 1:
+            memory_monitor.set_tracing(args[1] == "on")
+            await event.respond(f"🧠 tracemalloc is now **{'on' if tracemalloc.is_tracing() else 'off'}**.")
+            return
+        
+        report = await memory_monitor.snapshot(5)
+        structures = "\n".join(
+            f"• {name}: " + ", ".join(
+                f"{key}={value / 1024:.0f}KB" if key.endswith("bytes") else f"{key}={value}"
+                for key, value in section.items()
+            )
+            for name, section in report["structures"].items() if section
+        )
+        allocations = report["allocations"]
+        if allocations["tracing"]:
+            top = "\n".join(f"`{a['where']}` {a['kb']}KB ({a['count']})" for a in allocations["top"])
+            growth = "\n".join(
+                f"`{a['where']}` {a['kb_diff']:+}KB ({a['count_diff']:+})" for a in allocations.get("growth", [])
+            )
+            traced = f"""**Top allocators** ({allocations['traced_mb']}MB traced):
+{top}
+
+**Growth since last report:**
+{growth or 'First snapshot; run /memory again to diff'}"""
         else:
-            await event.respond("❌ **Failed to confirm payment!** Please try again.")
+            traced = "tracemalloc is off (`/memory trace on`)"
+        trend = {
+            span: f"{value:+}MB/h" if value is not None else "n/a"
+            for span, value in report["trend_mb_per_hour"].items()
+        }
+        
+        await event.respond(f"""🧠 **Memory**
+
+**RSS:** {report['rss_mb']}MB (peak {report['peak_rss_mb']}MB)
+**Trend:** {trend['1h']} last hour, {trend['window']} over {len(memory_monitor.samples)} samples
+**GC objects:** {report['gc_objects']}
 
+**Structures:**
+{structures}
+
+{traced}""")
+    
     async def handle_stats(self, event):
         user_id = event.sender_id
         user_info = self.user_manager.get_user_info(user_id)
@@ -916,7 +4295,7 @@ Start downloading immediately! 🚀"""
                 access_status = f"✅ Verified ({Config.TOKEN_VALIDITY_HOURS}h access)"
                 downloads_info = "Unlimited (verified)"
             else:
-                access_status = f"🔒 Verification needed"
+                access_status = "🔒 Verification needed"
                 downloads_info = "0 (need verification)"
         
         stats_text = f"""📊 **Your Statistics**
@@ -1014,7 +4393,7 @@ Use `/buy` to choose your plan!"""
         
         return any(re.search(pattern, text, re.IGNORECASE) for pattern in patterns)
 
-async def handle_leech(self, event):
+    async def handle_leech(self, event):
         if not event.message.text or event.message.text.startswith('/'):
             return
         
@@ -1039,73 +4418,111 @@ async def handle_leech(self, event):
         url = event.message.text.strip()
         active_sub = self.user_manager.get_active_subscription(user_id)
         is_premium = bool(active_sub)
+        tier = self.user_manager.get_tier(user_id, self.token_manager)
         
-        status_msg = await event.respond("🔍 **Processing Terabox link...**")
+        # Per user by tier, then per chat so one group can't take every slot
+        limit = Config.LEECH_RATE_LIMITS.get(tier, Config.LEECH_RATE_LIMITS.get("free", 3))
+        hint = "\n\n💎 **Premium** raises the limit - see /premium" if tier != "premium" else ""
+        if await self.rate_limited(event, self.leech_limiter, ("user", user_id), limit, f"links ({tier} tier)", hint):
+            return
+        if event.chat_id != user_id and await self.rate_limited(
+            event, self.leech_limiter, ("chat", event.chat_id), Config.CHAT_RATE_LIMIT, "links from this chat"
+        ):
+            return
         
-        try:
-            await status_msg.edit("📋 **Using external API service...**")
-            
-            shorturl = None
-            patterns = [r'surl=([^&\\s]+)', r'/s/([^?&\\s]+)']
-            for pattern in patterns:
-                match = re.search(pattern, url, re.IGNORECASE)
-                if match:
-                    shorturl = match.group(1)
-                    break
-            
-            if not shorturl:
-                await status_msg.edit("❌ **Invalid Terabox URL format**")
+        shorturl = None
+        patterns = [r'surl=([^&\\s]+)', r'/s/([^?&\\s]+)']
+        for pattern in patterns:
+            match = re.search(pattern, url, re.IGNORECASE)
+            if match:
+                shorturl = match.group(1)
+                break
+        
+        if not shorturl:
+            await event.respond("❌ **Invalid Terabox URL format**")
+            return
+        
+        job = {
+            "job_id": uuid.uuid4().hex, "user_id": user_id, "chat_id": event.chat_id, "url": url,
+            "shorturl": shorturl, "is_premium": is_premium, "tier": tier, "file_info": None
+        }
+        
+        if self.draining:
+            # Shutting down: journal it for the next instance instead of starting it
+            if not self.journal:
+                await event.respond("🔄 **Bot is restarting.** Please send the link again in a minute.")
                 return
-            
+            status_msg = await event.respond("🔄 **Bot is restarting.** Your link is queued and will start automatically.")
+            await asyncio.to_thread(self.journal.add, dict(job, status_msg_id=status_msg.id, stage="queued"))
+            return
+        
+        status_msg = await event.respond("🔍 **Processing Terabox link...**")
+        if self.journal:
+            job = await asyncio.to_thread(self.journal.add, dict(job, status_msg_id=status_msg.id, stage="resolving"))
+        await self.run_leech(job, status_msg.edit)
+    
+    async def run_leech(self, job, progress, resumed=False):
+        """Resolve and transfer one leech job, journaling each stage"""
+        job_id = job["job_id"]
+        shorturl = job["shorturl"]
+        self.active_jobs[job_id] = (asyncio.current_task(), progress)
+        
+        async def record(**fields):
+            if self.journal:
+                await asyncio.to_thread(self.journal.update, job_id, **fields)
+        
+        async def on_bytes(sent):
+            await record(bytes_done=sent)
+        
+        with tracer.span("leech", user_id=job["user_id"], tier=job["tier"], shorturl=shorturl, resumed=resumed) as span:
             try:
-                external_api = f"https://terabox-dl.qtcloud.workers.dev/api/get-info?url={url}"
-                response = requests.get(external_api, timeout=15)
+                await progress("📋 **Resolving link...**")
+                
+                async def resolve_and_transfer():
+                    if job.get("file_info"):
+                        # Resumed after the dlink was journaled: skip resolution
+                        try:
+                            receipt = await self.shared_transfer(
+                                job["chat_id"], job["file_info"], job["is_premium"], progress, on_bytes
+                            )
+                            return job["file_info"], receipt
+                        except Exception as e:
+                            logger.info(f"Journaled link for job {job_id} failed ({e}); resolving again")
+                    
+                    await record(stage="resolving")
+                    file_info = await self.resolver.resolve(job["url"])
+                    if not file_info:
+                        return None, None
+                    file_info["resume_id"] = job_id
+                    file_info["tier"] = job["tier"]
+                    await record(stage="transferring", file_info=file_info)
+                    if stream_proxy.enabled:
+                        await self.send_stream_link(job["chat_id"], file_info)
+                    receipt = await self.shared_transfer(job["chat_id"], file_info, job["is_premium"], progress, on_bytes)
+                    return file_info, receipt
                 
-                if response.status_code == 200:
-                    data = response.json()
+                try:
+                    if f"link:{shorturl}" in self.flights.calls:
+                        await progress("⏳ **This link is already being fetched for another user...**")
+                    (file_info, receipt), shared = await self.flights.do(f"link:{shorturl}", resolve_and_transfer)
                     
-                    if data.get('success'):
-                        file_data = data.get('data', {})
-                        filename = file_data.get('filename', 'unknown')
-                        download_url = file_data.get('download_link', '')
-                        file_size = file_data.get('size', 0)
+                    if file_info:
+                        if shared:
+                            receipt = await self.send_copy(job["chat_id"], file_info, receipt, job["is_premium"])
+                        sent_bytes = receipt["bytes"]
+                        self.user_manager.increment_download(job["user_id"], sent_bytes, file_info["filename"])
+                        span.set(result="completed", source=file_info["source"], bytes=sent_bytes, shared=shared)
+                        await record(stage="done", bytes_done=sent_bytes)
                         
-                        if download_url:
-                            await status_msg.edit(f"⬇️ **Downloading:** `{filename}`")
-                            
-                            file_response = requests.get(download_url, stream=True, timeout=300)
-                            file_response.raise_for_status()
-                            
-                            await status_msg.edit(f"⬆️ **Uploading:** `{filename}`")
-                            
-                            attributes = [DocumentAttributeFilename(filename)]
-                            if filename.lower().endswith(('.mp4', '.mkv', '.avi')):
-                                attributes.append(DocumentAttributeVideo(0, 0, 0, supports_streaming=True))
-                            
-                            caption = f"📁 **{filename}**\\n📊 **Size:** {file_size/(1024*1024):.1f}MB\\n{'💎 Premium' if is_premium else '🆓 Free'}"
-                            
-                            await self.client.send_file(
-                                event.chat_id,
-                                file_response.raw,
-                                attributes=attributes,
-                                caption=caption
-                            )
-                            
-                            if Config.SAVE_CHANNEL:
-                                try:
-                                    file_response2 = requests.get(download_url, stream=True)
-                                    await self.client.send_file(Config.SAVE_CHANNEL, file_response2.raw, attributes=attributes)
-                                except:
-                                    pass
-                            
-                            self.user_manager.increment_download(user_id, file_size, filename)
-                            
-                            await status_msg.edit("✅ **Download completed!**")
-                            return
-            except Exception as e:
-                logger.error(f"External API failed: {e}")
-            
-            await status_msg.edit(f"""📋 **Manual Download Required**
+                        await progress("✅ **Download completed!**")
+                        return
+                except Exception as e:
+                    logger.error(f"Direct download failed: {e}")
+                    span.set(direct_error=str(e))
+                
+                span.set(result="manual")
+                await record(stage="manual")
+                await progress(f"""📋 **Manual Download Required**
 
 **Your Terabox Link:** `{shorturl}`
 
@@ -1119,11 +4536,526 @@ async def handle_leech(self, event):
 **⚡ Coming Soon:** Direct download will be fixed in next update!
 
 **💎 Premium users:** Priority support for API fixes""")
+                
+            except Exception as e:
+                logger.error(f"Error processing file: {e}")
+                span.set(result="error")
+                await record(stage="failed")
+                await progress(f"❌ **Error:** {str(e)}")
+            finally:
+                self.active_jobs.pop(job_id, None)
+    
+    async def send_stream_link(self, chat_id, file_info):
+        """Offer a signed streaming link so the user can start before the upload ends"""
+        link = stream_proxy.create_link(file_info)
+        label = "▶️ Watch now" if self.downloader.is_video_file(file_info["filename"]) else "⬇️ Direct download"
+        try:
+            await self.client.send_message(
+                chat_id,
+                f"🔗 **{file_info['filename']}** can be streamed while it uploads.\n"
+                f"⏰ **Link valid for:** {self.format_window(Config.STREAM_LINK_TTL)}",
+                buttons=[[Button.url(label, link)]]
+            )
+        except Exception as e:
+            logger.error(f"Error sending stream link: {e}")
+    
+    async def resume_jobs(self):
+        """Startup: pick journaled jobs a previous instance left unfinished back up"""
+        jobs = await asyncio.to_thread(self.journal.unfinished)
+        await asyncio.to_thread(self.journal.prune, 86400)
+        resumable = set()
+        
+        for job in jobs:
+            progress = functools.partial(self.client.edit_message, job["chat_id"], job["status_msg_id"])
+            if time.time() - job["created"] > Config.JOB_RESUME_MAX_AGE or job["attempts"] >= Config.JOB_MAX_ATTEMPTS:
+                await asyncio.to_thread(self.journal.update, job["job_id"], stage="expired")
+                with contextlib.suppress(Exception):
+                    await progress("❌ **Download was interrupted by a restart.** Please send the link again.")
+                continue
             
+            resumable.add(job["job_id"])
+            await asyncio.to_thread(self.journal.update, job["job_id"], attempts=job["attempts"] + 1)
+            with contextlib.suppress(Exception):
+                await progress("♻️ **Resuming your download after a restart...**")
+            asyncio.create_task(self.run_leech(job, progress, resumed=True))
+        
+        if self.cache:
+            await asyncio.to_thread(self.cache.discard_resumable, resumable)
+        if jobs:
+            logger.info(f"♻️ Resumed {len(resumable)} of {len(jobs)} interrupted job(s)")
+    
+    async def drain(self):
+        """SIGTERM: stop admitting jobs, let running ones finish, checkpoint the rest"""
+        if self.draining:
+            return
+        self.draining = True
+        logger.info(f"🛑 Draining {len(self.active_jobs)} running job(s) before shutdown")
+        
+        tasks = [task for task, _ in self.active_jobs.values()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=Config.DRAIN_TIMEOUT)
+        
+        # Still running: cancel (the journal keeps them unfinished) and tell the user
+        for task, progress in list(self.active_jobs.values()):
+            task.cancel()
+            with contextlib.suppress(Exception):
+                await progress("⏸️ **Bot is restarting.** Your download will resume automatically.")
+        if self.active_jobs:
+            await asyncio.wait([task for task, _ in self.active_jobs.values()], timeout=5)
+        
+        if self.broadcaster.running:
+            # Its checkpoint is written on cancel; the next instance resumes it
+            self.broadcaster.task.cancel()
+            await asyncio.gather(self.broadcaster.task, return_exceptions=True)
+        if self.transfer_pool:
+            self.transfer_pool.stop()
+        await self.client.disconnect()
+    
+    def open_source(self, file_info, byte_range=None):
+        """Blocking: open a streamed response for a resolved file"""
+        if file_info["source"] == "native":
+            return self.downloader.open_download(
+                file_info["download_url"], byte_range, file_info.get("account"), file_info.get("proxy")
+            )
+        headers = {'Range': f"bytes={byte_range[0]}-{byte_range[1]}"} if byte_range else None
+        response = requests.get(file_info["download_url"], headers=headers, stream=True, timeout=300)
+        response.raise_for_status()
+        return response
+    
+    def read_range(self, file_info, offset, length):
+        """Blocking: fetch one byte range, or nothing if the server ignores Range"""
+        response = self.open_source(file_info, (offset, offset + length - 1))
+        try:
+            if response.status_code != 206:
+                return b""
+            return response.raw.read(length)
+        finally:
+            response.close()
+    
+    @staticmethod
+    def probe_cached_file(file, file_size):
+        def read_at(offset, length):
+            return os.pread(file.fileno(), length, offset)
+        return MediaProbe.probe(read_at(0, MediaProbe.HEAD_BYTES), file_size, read_at)
+    
+    async def video_attribute(self, file_info, file_size, stream=None, cached=None, ranged=False):
+        """DocumentAttributeVideo with real duration/size, or None for non-videos"""
+        if self.downloader.get_file_type(file_info["filename"]) != "video":
+            return None
+        with tracer.span("probe") as span:
+            if cached:
+                info = await asyncio.to_thread(self.probe_cached_file, cached, file_size)
+            else:
+                head = await stream.peek(MediaProbe.HEAD_BYTES)
+                read_at = functools.partial(self.read_range, file_info) if ranged else None
+                info = await asyncio.to_thread(MediaProbe.probe, head, file_size, read_at)
+            span.set(found=bool(info), **(info or {}))
+        if not info:
+            return DocumentAttributeVideo(0, 0, 0, supports_streaming=True)
+        if not info["faststart"]:
+            # moov after mdat: clients can't start playback before the end arrives
+            logger.info(f"{file_info['filename']} has a trailing moov; uploading without streaming flag")
+        return DocumentAttributeVideo(
+            info["duration"], info["width"], info["height"], supports_streaming=info["faststart"]
+        )
+    
+    async def shared_transfer(self, chat_id, file_info, is_premium, progress, on_bytes=None):
+        """transfer(), coalesced with any in-flight transfer of the same file"""
+        key = f"file:{file_info.get('fs_id') or file_info['download_url']}"
+        
+        async def run():
+            return await self.transfer(chat_id, file_info, is_premium, progress, on_bytes)
+        
+        if key in self.flights.calls:
+            await progress(f"⏳ **Already transferring** `{file_info['filename']}` **for another user...**")
+        receipt, shared = await self.flights.do(key, run)
+        if shared:
+            receipt = await self.send_copy(chat_id, file_info, receipt, is_premium)
+        return receipt
+    
+    async def send_copy(self, chat_id, file_info, receipt, is_premium, again=False):
+        """Re-send a file another chat already received, by reference (no transfer).
+        
+        The chat that received the original is skipped unless again is set.
+        """
+        if receipt["chat_id"] == chat_id and not again:
+            return receipt
+        if receipt.get("parts"):
+            with tracer.span("send_copy", from_chat=receipt["chat_id"], parts=len(receipt["parts"])):
+                originals = await self.client.get_messages(receipt["chat_id"], ids=receipt["parts"])
+                if not originals or any(not message or not message.media for message in originals):
+                    raise RuntimeError("shared upload is no longer available")
+                message_ids = await self.send_parts(
+                    chat_id, [message.media for message in originals], file_info["filename"], receipt["bytes"]
+                )
+            return dict(receipt, chat_id=chat_id, message_id=message_ids[0], parts=message_ids)
+        with tracer.span("send_copy", from_chat=receipt["chat_id"]):
+            original = await self.client.get_messages(receipt["chat_id"], ids=receipt["message_id"])
+            if not original or not original.media:
+                raise RuntimeError("shared upload is no longer available")
+            message = await self.client.send_file(
+                chat_id, original.media,
+                caption=self.file_caption(file_info["filename"], receipt["bytes"], is_premium)
+            )
+        return dict(receipt, chat_id=chat_id, message_id=message.id)
+    
+    @staticmethod
+    def file_caption(filename, file_size, is_premium):
+        return f"📁 **{filename}**\\n📊 **Size:** {file_size/(1024*1024):.1f}MB\\n{'💎 Premium' if is_premium else '🆓 Free'}"
+    
+    async def transfer(self, chat_id, file_info, is_premium, progress, on_bytes=None):
+        """Run deliver_file on the fleet, in a transfer process, or right here"""
+        if self.job_queue:
+            return await self.submit_fleet_job(chat_id, file_info, is_premium, progress)
+        if self.transfer_pool:
+            return await self.transfer_pool.submit(chat_id, file_info, is_premium, progress)
+        return await self.deliver_file(chat_id, file_info, is_premium, progress, on_bytes)
+    
+    async def submit_fleet_job(self, chat_id, file_info, is_premium, progress):
+        """Enqueue a transfer for any worker node and follow it until it ends"""
+        span = tracer.current()
+        job_id = await asyncio.to_thread(self.job_queue.enqueue, {
+            "chat_id": chat_id,
+            "file_info": file_info,
+            "is_premium": is_premium,
+            "trace": [span.trace_id, span.span_id] if span else None
+        })
+        await progress("⏳ **Queued for transfer...**")
+        shown = None
+        started = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(1)
+                job = await asyncio.to_thread(self.job_queue.get_job, job_id)
+                if not job:
+                    raise RuntimeError("transfer job disappeared")
+                waited = time.monotonic() - started
+                if job["status"] == "queued" and not job["attempts"] and waited > Config.FLEET_QUEUE_TIMEOUT:
+                    raise RuntimeError("no transfer node is available right now")
+                if waited > Config.FLEET_JOB_TIMEOUT:
+                    raise RuntimeError(f"transfer did not finish within {Config.FLEET_JOB_TIMEOUT:.0f}s")
+                if job["progress"] and job["progress"] != shown:
+                    shown = job["progress"]
+                    try:
+                        await progress(shown)
+                    except Exception as e:
+                        logger.debug(f"Progress update failed: {e}")
+                if job["status"] == "done":
+                    return job["result"]
+                if job["status"] == "failed":
+                    raise RuntimeError(job["error"] or "transfer failed")
+        finally:
+            await asyncio.to_thread(self.job_queue.forget, job_id)
+    
+    async def deliver_file(self, chat_id, file_info, is_premium, progress, on_bytes=None):
+        """Stream a resolved file to the user (and SAVE_CHANNEL).
+        
+        progress is an async callable taking the status text to show, and
+        on_bytes an optional async callable fed the bytes uploaded so far.
+        Returns a receipt {"bytes", "chat_id", "message_id"} that send_copy
+        can reuse.
+        """
+        # Split uploads are remembered; send the parts again by reference
+        file_key = DiskCache.key_for(file_info) or file_info.get("fs_id")
+        previous = await asyncio.to_thread(self.find_upload, file_key) if file_key else None
+        if previous:
+            try:
+                return await self.send_copy(chat_id, file_info, previous, is_premium, again=True)
+            except Exception as e:
+                logger.info(f"Stored parts of {file_info['filename']} unusable ({e}); transferring again")
+                await asyncio.to_thread(self.forget_upload, file_key)
+        
+        # Bandwidth is shaped by the tier of the user who started the transfer
+        tier = file_info.get("tier") or ("premium" if is_premium else "free")
+        flows = (self.download_shaper.open(tier), self.upload_shaper.open(tier))
+        try:
+            return await self._deliver_file(chat_id, file_info, is_premium, progress, on_bytes, flows)
+        finally:
+            for flow in flows:
+                flow.close()
+    
+    def find_upload(self, file_key):
+        return self.journal.find_upload(file_key) if self.journal else self.uploads.get(file_key)
+    
+    def remember_upload(self, file_key, receipt):
+        if self.journal:
+            self.journal.remember_upload(file_key, receipt)
+        else:
+            self.uploads[file_key] = receipt
+    
+    def forget_upload(self, file_key):
+        if self.journal:
+            self.journal.forget_upload(file_key)
+        else:
+            self.uploads.pop(file_key, None)
+    
+    def shaped_upload(self, file, flow):
+        """An open cache file as an upload source, paced only when uploads are shaped"""
+        return ShapedFile(file, (flow,) if self.upload_shaper.limit else ())
+    
+    async def _deliver_file(self, chat_id, file_info, is_premium, progress, on_bytes, flows):
+        # Held open for the whole delivery so no eviction can pull a hit away mid-send
+        cache_key = self.cache.key_for(file_info) if self.cache else None
+        cached = await asyncio.to_thread(self.cache.open, cache_key) if cache_key else None
+        try:
+            return await self._deliver_from(chat_id, file_info, is_premium, progress, on_bytes, flows, cache_key, cached)
+        finally:
+            if cached:
+                cached.close()
+    
+    async def _deliver_from(self, chat_id, file_info, is_premium, progress, on_bytes, flows, cache_key, cached):
+        download_flow, upload_flow = flows
+        filename = file_info["filename"]
+        # Runs alongside the download; the upload only uses it if it is ready in time
+        thumb_task = (
+            asyncio.ensure_future(self.thumbnails.get(file_info))
+            if self.thumbnails and file_info.get("thumbnail") else None
+        )
+        # Journaled jobs keep their partial download across restarts
+        resume_id = file_info.get("resume_id") if cache_key else None
+        partial = 0
+        response = None
+        
+        if cached:
+            file_size = os.fstat(cached.fileno()).st_size
+        else:
+            await progress(f"⬇️ **Downloading:** `{filename}`")
+            with tracer.span("download", source=file_info["source"]) as span:
+                partial = self.cache.partial_size(cache_key, resume_id) if resume_id else 0
+                # An empty range end asks for everything from the offset on
+                response = await asyncio.to_thread(self.open_source, file_info, (partial, "") if partial else None)
+                if partial and response.status_code != 206:
+                    partial = 0  # Range ignored: the body is the whole file again
+                file_size = int(response.headers.get('Content-Length') or 0) + partial
+                if not file_size and str(file_info.get("size", "")).isdigit():
+                    file_size = int(file_info["size"])
+                span.set(http_status=response.status_code, content_length=file_size, resumed_from=partial)
+        
+        if file_size > Config.SPLIT_PART_MB * 1024 * 1024:
+            if thumb_task:
+                thumb_task.cancel()
+            return await self._deliver_split(chat_id, file_info, progress, flows, file_size, response, cached, partial)
+        
+        await progress(f"⬆️ **Uploading:** `{filename}`")
+        last_update = time.monotonic()
+        
+        async def upload_progress(sent, total):
+            nonlocal last_update
+            if time.monotonic() - last_update < Config.PROGRESS_INTERVAL or not total:
+                return
+            last_update = time.monotonic()
+            try:
+                await progress(f"⬆️ **Uploading:** `{filename}` ({sent * 100 // total}%)")
+                if on_bytes:
+                    await on_bytes(sent)
+            except Exception as e:
+                logger.debug(f"Progress update failed: {e}")
+        
+        caption = self.file_caption(filename, file_size, is_premium)
+        
+        stream = None
+        sink = None
+        if response is not None:
+            # Tee the download into the cache while it streams to Telegram
+            sink = await asyncio.to_thread(
+                self.cache.writer, cache_key, file_size, resume_id, bool(partial)
+            ) if cache_key else None
+            head = open(self.cache.resume_path(cache_key, resume_id), "rb") if partial else None
+            stream = TransferStream(response, filename, sink=sink, head=head, head_size=partial, flows=flows)
+        
+        attributes = [DocumentAttributeFilename(filename)]
+        try:
+            video = await self.video_attribute(
+                file_info, file_size, stream=stream, cached=cached,
+                ranged=response is not None and response.headers.get('Accept-Ranges') == 'bytes'
+            )
         except Exception as e:
-            logger.error(f"Error processing file: {e}")
-            await status_msg.edit(f"❌ **Error:** {str(e)}")
+            logger.error(f"Video probe failed for {filename}: {e}")
+            video = DocumentAttributeVideo(0, 0, 0, supports_streaming=True)
+        if video:
+            attributes.append(video)
+        
+        source = stream or self.shaped_upload(cached, upload_flow)
+        try:
+            # Upload the body first; Telegram only needs the thumbnail in the
+            # final sendMedia call, so its fetch never delays the transfer
+            with tracer.span("upload", chat_id=chat_id, cache_hit=bool(cached)) as span:
+                file_handle = await self.client.upload_file(
+                    source,
+                    file_size=file_size or None,
+                    progress_callback=upload_progress
+                )
+                sent_bytes = stream.bytes_read if stream else file_size
+                span.set(bytes=sent_bytes)
+                if stream:
+                    span.set(download_wait_ms=round(stream.read_seconds * 1000, 1))
+            
+            thumb = await ThumbnailService.wait(thumb_task)
+            with tracer.span("send_media", thumb=bool(thumb)):
+                message = await self.client.send_file(
+                    chat_id,
+                    file_handle,
+                    attributes=attributes,
+                    caption=caption,
+                    mime_type=mimetypes.guess_type(filename)[0],
+                    thumb=thumb
+                )
+        except BaseException as e:
+            if sink:
+                # Cancelled by a shutdown drain: keep what arrived for the resumed job
+                sink.checkpoint() if isinstance(e, asyncio.CancelledError) else sink.abort()
+            raise
+        finally:
+            source.close()
+        reopened = None
+        if sink and await asyncio.to_thread(sink.commit) and Config.SAVE_CHANNEL:
+            cached = reopened = await asyncio.to_thread(self.cache.open, cache_key)
+        
+        if Config.SAVE_CHANNEL:
+            with tracer.span("save_channel", cache_hit=bool(cached)) as span:
+                try:
+                    thumb = await ThumbnailService.wait(thumb_task, timeout=0)
+                    if cached:
+                        await self.client.send_file(
+                            Config.SAVE_CHANNEL, self.shaped_upload(cached, upload_flow),
+                            attributes=attributes, file_size=file_size, thumb=thumb
+                        )
+                        span.set(bytes=file_size)
+                    else:
+                        response2 = await asyncio.to_thread(self.open_source, file_info)
+                        stream2 = TransferStream(response2, filename, flows=flows)
+                        try:
+                            await self.client.send_file(
+                                Config.SAVE_CHANNEL, stream2, attributes=attributes,
+                                file_size=file_size or None, thumb=thumb
+                            )
+                        finally:
+                            stream2.close()
+                        span.set(bytes=stream2.bytes_read)
+                except Exception as e:
+                    span.status = "error"
+                    span.error = str(e)
+                finally:
+                    if reopened:
+                        reopened.close()
+        
+        return {"bytes": sent_bytes, "chat_id": chat_id, "message_id": message.id}
+        
+    async def _deliver_split(self, chat_id, file_info, progress, flows, file_size, response, cached, partial):
+        """Upload an oversized file as numbered parts (name.001, name.002, ...) without staging it.
+        
+        With a cached copy or a Range-capable source every part gets its own
+        reader and SPLIT_CONCURRENCY parts upload at once; otherwise the one
+        stream is cut into consecutive parts.
+        """
+        filename = file_info["filename"]
+        part_size = int(Config.SPLIT_PART_MB * 1024 * 1024)
+        count = math.ceil(file_size / part_size)
+        names = [f"{filename}.{index + 1:03d}" for index in range(count)]
+        ranged = response is not None and (response.status_code == 206 or response.headers.get('Accept-Ranges') == 'bytes')
+        if response is not None and partial:
+            response.close()  # a resumed single-file download; parts reopen their own ranges
+            response = None
+        
+        uploaded = [0] * count
+        last_update = time.monotonic()
+        
+        async def part_progress(index, sent, total):
+            nonlocal last_update
+            uploaded[index] = sent
+            if time.monotonic() - last_update < Config.PROGRESS_INTERVAL:
+                return
+            last_update = time.monotonic()
+            try:
+                await progress(f"⬆️ **Uploading:** `{filename}` in {count} parts ({sum(uploaded) * 100 // file_size}%)")
+            except Exception as e:
+                logger.debug(f"Progress update failed: {e}")
+        
+        async def upload_part(index, source):
+            length = min(part_size, file_size - index * part_size)
+            with tracer.span("upload_part", part=index + 1, parts=count) as span:
+                handle = await self.client.upload_file(
+                    PartReader(source, length, names[index]),
+                    file_size=length,
+                    file_name=names[index],
+                    progress_callback=functools.partial(part_progress, index)
+                )
+                span.set(bytes=length)
+            return handle
+        
+        async def upload_range(index):
+            start = index * part_size
+            end = min(file_size, start + part_size) - 1
+            if cached:
+                source = ShapedFile(cached, flows[1:], offset=start)
+            elif index == 0 and response is not None:
+                source = TransferStream(response, names[index], flows=flows)
+            else:
+                part_response = await asyncio.to_thread(self.open_source, file_info, (start, end))
+                source = TransferStream(part_response, names[index], flows=flows)
+            try:
+                return await upload_part(index, source)
+            finally:
+                source.close()
+        
+        await progress(f"✂️ **{filename}** is {file_size / (1024 ** 3):.2f}GB - uploading in {count} parts")
+        with tracer.span("split_upload", parts=count, ranged=ranged, cache_hit=bool(cached)):
+            if cached or ranged or partial:
+                semaphore = asyncio.Semaphore(Config.SPLIT_CONCURRENCY)
+                
+                async def bounded(index):
+                    async with semaphore:
+                        return await upload_range(index)
+                
+                tasks = [asyncio.ensure_future(bounded(index)) for index in range(count)]
+                try:
+                    handles = await asyncio.gather(*tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    if response is not None:
+                        response.close()
+                    raise
+            else:
+                # The source can't seek: cut its single stream into consecutive parts
+                stream = TransferStream(response, filename, flows=flows)
+                try:
+                    handles = [await upload_part(index, stream) for index in range(count)]
+                finally:
+                    stream.close()
         
+        message_ids = await self.send_parts(chat_id, handles, filename, file_size)
+        receipt = {"bytes": file_size, "chat_id": chat_id, "message_id": message_ids[0], "parts": message_ids}
+        file_key = DiskCache.key_for(file_info) or file_info.get("fs_id")
+        if file_key:
+            await asyncio.to_thread(self.remember_upload, file_key, receipt)
+        return receipt
+    
+    async def send_parts(self, chat_id, files, filename, file_size):
+        """Send parts as ordered document albums (10 per album) plus joining instructions"""
+        count = len(files)
+        message_ids = []
+        for offset in range(0, count, 10):
+            batch = range(offset, min(count, offset + 10))
+            sent = await self.client.send_file(
+                chat_id, [files[index] for index in batch],
+                caption=[f"📦 **Part {index + 1}/{count}** of `{filename}`" for index in batch],
+                force_document=True
+            )
+            message_ids.extend(message.id for message in (sent if isinstance(sent, list) else [sent]))
+        
+        parts = "+".join(f'"{filename}.{index + 1:03d}"' for index in range(count))
+        await self.client.send_message(
+            chat_id,
+            f"📦 **{filename}** ({file_size / (1024 ** 3):.2f}GB) was sent in {count} parts.\n\n"
+            f"**Join them after downloading all parts:**\n"
+            f"• Android/Linux/macOS: `cat \"{filename}\".0* > \"{filename}\"`\n"
+            f"• Windows: `copy /b {parts} \"{filename}\"`\n"
+            f"• Or open `{filename}.001` in 7-Zip/ZArchiver and extract"
+        )
+        return message_ids
+    
     async def handle_callbacks(self, event):
         try:
             data = event.data.decode()
@@ -1142,10 +5074,8 @@ async def handle_leech(self, event):
                 plan_key = data.replace("buy_", "")
                 await self.process_payment_request(event, plan_key)
             elif data.startswith("paid_"):
-                payment_id = data.replace("paid_", "")
                 await event.answer("✅ Payment received! Admin will confirm soon.", show_alert=True)
             elif data.startswith("cancel_"):
-                payment_id = data.replace("cancel_", "")
                 await event.edit("❌ **Payment cancelled.**\\n\\nUse /buy to create a new payment request.")
                 
         except Exception as e:
@@ -1199,26 +5129,871 @@ Need help? Contact admin or use the bot commands above! 🚀"""
         
         await event.edit(help_text)
         
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+class TransferPool:
+    """Hands download/upload jobs to worker processes over a local queue.
+    
+    The Telethon dispatcher keeps resolving links and answering commands
+    while each worker runs its own event loop and Telegram session for
+    the heavy transfers, streaming progress and results back. Each worker
+    writes the job it took into a shared-memory slot before anything
+    else, so the supervisor knows what a crashed worker held even when
+    its "claimed" message never made it through the events pipe.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self.context = multiprocessing.get_context("spawn")
+        self.jobs = self.context.Queue()
+        self.events = self.context.Queue()
+        self.workers = {}
+        self.current = {}  # worker index -> shared slot holding its job_id
+        self.pending = {}
+        self.claimed = {}
+        self.loop = None
+    
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        for index in range(self.size):
+            self._spawn(index)
+        threading.Thread(target=self._read_events, name="transfer-events", daemon=True).start()
+        self.supervisor_task = asyncio.create_task(self._supervise())
+        logger.info(f"Started {self.size} transfer worker processes")
+    
+    def _spawn(self, index):
+        self.current[index] = self.context.Array("c", 32)
+        process = self.context.Process(
+            target=transfer_worker_main, args=(index, self.jobs, self.events, self.current[index]),
+            name=f"transfer-worker-{index}", daemon=True
+        )
+        process.start()
+        self.workers[index] = process
+    
+    async def submit(self, chat_id, file_info, is_premium, progress):
+        job_id = uuid.uuid4().hex
+        future = self.loop.create_future()
+        self.pending[job_id] = (future, progress)
+        span = tracer.current()
+        self.jobs.put({
+            "job_id": job_id,
+            "chat_id": chat_id,
+            "file_info": file_info,
+            "is_premium": is_premium,
+            "trace": (span.trace_id, span.span_id) if span else None
+        })
+        try:
+            return await asyncio.wait_for(future, Config.TRANSFER_JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"transfer did not finish within {Config.TRANSFER_JOB_TIMEOUT:.0f}s")
+        finally:
+            self.pending.pop(job_id, None)
+            self.claimed.pop(job_id, None)
+    
+    def _read_events(self):
+        """Runs in a thread: move worker messages onto the event loop"""
+        while True:
+            message = self.events.get()
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+    
+    def _dispatch(self, message):
+        kind, job_id, payload = message
+        entry = self.pending.get(job_id)
+        if not entry:
+            return
+        future, progress = entry
+        if kind == "claimed":
+            self.claimed[job_id] = payload
+        elif kind == "progress":
+            asyncio.ensure_future(self._safe_progress(progress, payload))
+        elif kind == "done" and not future.done():
+            future.set_result(payload)
+        elif kind == "failed" and not future.done():
+            future.set_exception(RuntimeError(payload))
+    
+    @staticmethod
+    async def _safe_progress(progress, text):
+        try:
+            await progress(text)
+        except Exception as e:
+            logger.debug(f"Progress update failed: {e}")
+    
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(5)
+            self.reap()
+    
+    def reap(self):
+        """Fail the jobs of crashed workers and replace the process"""
+        for index, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            logger.error(f"Transfer worker {index} exited with {process.exitcode}; restarting")
+            lost = {job_id for job_id, worker_index in self.claimed.items() if worker_index == index}
+            held = self.current[index].value.decode()
+            if held:
+                lost.add(held)
+            for job_id in lost:
+                self._dispatch(("failed", job_id, f"transfer worker {index} crashed"))
+            self._spawn(index)
+    
+    def stop(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+
+def transfer_worker_main(index, jobs, events, current):
+    """Entry point of a transfer worker process"""
+    global tracer
+    if Config.TRACE_FILE:
+        tracer = JobTracer(f"{Config.TRACE_FILE}.worker{index}")
+    asyncio.run(_transfer_worker(index, jobs, events, current))
+
+async def _transfer_worker(index, jobs, events, current):
+    client = TelegramClient(f"bot-worker-{index}", Config.API_ID, Config.API_HASH)
+    await client.start(bot_token=Config.BOT_TOKEN)
+    worker = TeraboxBot(client=client, transfer_only=True)
+    logger.info(f"Transfer worker {index} ready")
+    
+    while True:
+        def take():
+            job = jobs.get()
+            if job is not None:
+                # Same thread as the get: there is no await between taking and owning it
+                current.value = job["job_id"].encode()
+            return job
+        
+        job = await asyncio.to_thread(take)
+        if job is None:
+            break
+        job_id = job["job_id"]
+        events.put(("claimed", job_id, index))
+        
+        async def progress(text, job_id=job_id):
+            events.put(("progress", job_id, text))
+        
+        try:
+            with tracer.span("transfer_worker", remote_parent=job["trace"], worker=index):
+                receipt = await worker.deliver_file(job["chat_id"], job["file_info"], job["is_premium"], progress)
+            events.put(("done", job_id, receipt))
+        except Exception as e:
+            logger.error(f"Transfer worker {index} job failed: {e}")
+            events.put(("failed", job_id, str(e)))
+        current.value = b""
+    
+    await client.disconnect()
 
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is healthy!")
+class MemoryJobQueue:
+    """In-process lease queue; stand-in for SQLite/Redis and for single-node runs"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = {}
+        self.order = deque()
+        self.nodes = {}
+    
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self.jobs[job_id] = {
+                "job_id": job_id, "payload": payload, "status": "queued", "node": None,
+                "lease_until": 0, "attempts": 0, "progress": "", "result": None, "error": None
+            }
+            self.order.append(job_id)
+        return job_id
+    
+    def claim(self, node_id, lease_seconds):
+        with self._lock:
+            while self.order:
+                job = self.jobs.get(self.order.popleft())
+                if job and job["status"] == "queued":
+                    job.update(status="leased", node=node_id, lease_until=time.time() + lease_seconds)
+                    job["attempts"] += 1
+                    return dict(job)
+        return None
+    
+    def heartbeat(self, job_id, node_id, lease_seconds):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if not job or job["status"] != "leased" or job["node"] != node_id:
+                return False
+            job["lease_until"] = time.time() + lease_seconds
+            return True
+    
+    def set_progress(self, job_id, node_id, text):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job and job["node"] == node_id:
+                job["progress"] = text
+    
+    def finish(self, job_id, node_id, status, result=None, error=None):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if not job or job["node"] != node_id or job["status"] != "leased":
+                return False
+            job.update(status=status, result=result, error=error, lease_until=0)
+            return True
+    
+    def requeue_expired(self, max_attempts):
+        now = time.time()
+        requeued = 0
+        with self._lock:
+            for job in self.jobs.values():
+                if job["status"] == "leased" and job["lease_until"] < now:
+                    if job["attempts"] >= max_attempts:
+                        job.update(status="failed", error="lease expired too many times")
+                    else:
+                        job.update(status="queued", node=None)
+                        self.order.append(job["job_id"])
+                        requeued += 1
+        return requeued
+    
+    def get_job(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+    
+    def forget(self, job_id):
+        with self._lock:
+            self.jobs.pop(job_id, None)
     
-    def log_message(self, format, *args):
-        pass  # Disable logging
+    def register_node(self, node_id, info, ttl):
+        with self._lock:
+            self.nodes[node_id] = dict(info, expires=time.time() + ttl)
+    
+    def live_nodes(self):
+        now = time.time()
+        with self._lock:
+            return {node_id: info for node_id, info in self.nodes.items() if info["expires"] > now}
 
-def start_health_server():
-    server = HTTPServer(('0.0.0.0', 8080), HealthHandler)
-    server.serve_forever()
+class SQLiteJobQueue:
+    """Lease queue in a SQLite file shared by every node on the same volume"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY, payload TEXT, status TEXT, node TEXT,
+            lease_until REAL, attempts INTEGER, progress TEXT, result TEXT, error TEXT, created REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, info TEXT, expires REAL)")
+    
+    def _write(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+    
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        self._write(
+            "INSERT INTO jobs VALUES (?, ?, 'queued', NULL, 0, 0, '', NULL, NULL, ?)",
+            (job_id, json.dumps(payload), time.time())
+        )
+        return job_id
+    
+    def claim(self, node_id, lease_seconds):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'leased', node = ?, lease_until = ?, attempts = attempts + 1 WHERE job_id = ?",
+                        (node_id, time.time() + lease_seconds, row["job_id"])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        job = self._row(row)
+        job.update(status="leased", node=node_id, attempts=job["attempts"] + 1)
+        return job
+    
+    def heartbeat(self, job_id, node_id, lease_seconds):
+        return self._write(
+            "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND node = ? AND status = 'leased'",
+            (time.time() + lease_seconds, job_id, node_id)
+        ) == 1
+    
+    def set_progress(self, job_id, node_id, text):
+        self._write("UPDATE jobs SET progress = ? WHERE job_id = ? AND node = ?", (text, job_id, node_id))
+    
+    def finish(self, job_id, node_id, status, result=None, error=None):
+        return self._write(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = 0 "
+            "WHERE job_id = ? AND node = ? AND status = 'leased'",
+            (status, json.dumps(result), error, job_id, node_id)
+        ) == 1
+    
+    def requeue_expired(self, max_attempts):
+        now = time.time()
+        self._write(
+            "UPDATE jobs SET status = 'failed', error = 'lease expired too many times' "
+            "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, max_attempts)
+        )
+        return self._write(
+            "UPDATE jobs SET status = 'queued', node = NULL WHERE status = 'leased' AND lease_until < ?",
+            (now,)
+        )
+    
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+    
+    def forget(self, job_id):
+        self._write("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+    
+    def register_node(self, node_id, info, ttl):
+        self._write("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)", (node_id, json.dumps(info), time.time() + ttl))
+    
+    def live_nodes(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM nodes WHERE expires > ?", (time.time(),)).fetchall()
+        return {row["node_id"]: dict(json.loads(row["info"]), expires=row["expires"]) for row in rows}
+    
+    @staticmethod
+    def _row(row):
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+class RedisJobQueue:
+    """Lease queue in Redis for nodes on different hosts (needs the redis package).
+    
+    Claim, finish and lease expiry each run as one Lua script, so a job can
+    never be popped without a lease or finished by a node that lost it.
+    """
+    
+    # KEYS: queued list, leases zset; ARGV: node, lease deadline, key prefix
+    CLAIM = """
+    while true do
+        local job_id = redis.call('RPOP', KEYS[1])
+        if not job_id then return false end
+        local key = ARGV[3] .. ':' .. job_id
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+            redis.call('HSET', key, 'status', 'leased', 'node', ARGV[1])
+            redis.call('HINCRBY', key, 'attempts', 1)
+            return job_id
+        end
+    end
+    """
+    # KEYS: leases zset, job hash; ARGV: job_id, node, status, result, error
+    FINISH = """
+    if redis.call('HGET', KEYS[2], 'node') ~= ARGV[2] then return 0 end
+    if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then return 0 end
+    redis.call('HSET', KEYS[2], 'status', ARGV[3], 'result', ARGV[4], 'error', ARGV[5])
+    redis.call('EXPIRE', KEYS[2], 3600)
+    return 1
+    """
+    # KEYS: leases zset, queued list; ARGV: now, max attempts, key prefix
+    REQUEUE = """
+    local requeued = 0
+    for _, job_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1])) do
+        redis.call('ZREM', KEYS[1], job_id)
+        local key = ARGV[3] .. ':' .. job_id
+        if redis.call('EXISTS', key) == 0 then
+            -- forgotten while leased
+        elseif tonumber(redis.call('HGET', key, 'attempts')) >= tonumber(ARGV[2]) then
+            redis.call('HSET', key, 'status', 'failed', 'error', 'lease expired too many times')
+        else
+            redis.call('HSET', key, 'status', 'queued', 'node', '')
+            redis.call('RPUSH', KEYS[2], job_id)
+            requeued = requeued + 1
+        end
+    end
+    return requeued
+    """
+    
+    def __init__(self, url):
+        import redis
+        self.r = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = "terabox:jobs"
+        self._claim = self.r.register_script(self.CLAIM)
+        self._finish = self.r.register_script(self.FINISH)
+        self._requeue = self.r.register_script(self.REQUEUE)
+    
+    def _key(self, job_id):
+        return f"{self.prefix}:{job_id}"
+    
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        pipe = self.r.pipeline()
+        pipe.hset(self._key(job_id), mapping={
+            "job_id": job_id, "payload": json.dumps(payload), "status": "queued",
+            "node": "", "attempts": 0, "progress": ""
+        })
+        pipe.lpush(f"{self.prefix}:queued", job_id)
+        pipe.execute()
+        return job_id
+    
+    def claim(self, node_id, lease_seconds):
+        job_id = self._claim(
+            keys=[f"{self.prefix}:queued", f"{self.prefix}:leases"],
+            args=[node_id, time.time() + lease_seconds, self.prefix]
+        )
+        return self.get_job(job_id) if job_id else None
+    
+    def heartbeat(self, job_id, node_id, lease_seconds):
+        if self.r.hget(self._key(job_id), "node") != node_id:
+            return False
+        self.r.zadd(f"{self.prefix}:leases", {job_id: time.time() + lease_seconds}, xx=True)
+        return True
+    
+    def set_progress(self, job_id, node_id, text):
+        if self.r.hget(self._key(job_id), "node") == node_id:
+            self.r.hset(self._key(job_id), "progress", text)
+    
+    def finish(self, job_id, node_id, status, result=None, error=None):
+        # Ownership first, then the lease: a stale node never clears the new owner's lease
+        return self._finish(
+            keys=[f"{self.prefix}:leases", self._key(job_id)],
+            args=[job_id, node_id, status, json.dumps(result), error or ""]
+        ) == 1
+    
+    def requeue_expired(self, max_attempts):
+        return self._requeue(
+            keys=[f"{self.prefix}:leases", f"{self.prefix}:queued"],
+            args=[time.time(), max_attempts, self.prefix]
+        )
+    
+    def get_job(self, job_id):
+        job = self.r.hgetall(self._key(job_id))
+        if not job:
+            return None
+        job["payload"] = json.loads(job["payload"])
+        job["attempts"] = int(job.get("attempts") or 0)
+        job["result"] = json.loads(job["result"]) if job.get("result") else None
+        job["error"] = job.get("error") or None
+        return job
+    
+    def forget(self, job_id):
+        self.r.delete(self._key(job_id))
+    
+    def register_node(self, node_id, info, ttl):
+        self.r.set(f"{self.prefix}:node:{node_id}", json.dumps(info), ex=max(1, int(ttl)))
+    
+    def live_nodes(self):
+        nodes = {}
+        for key in self.r.scan_iter(f"{self.prefix}:node:*"):
+            info = self.r.get(key)
+            if info:
+                nodes[key.rsplit(":", 1)[1]] = json.loads(info)
+        return nodes
+
+def create_job_queue(url):
+    """memory://, sqlite:///jobs.db (relative), sqlite:////data/jobs.db (absolute) or redis://host:6379/0"""
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryJobQueue()
+    if url.startswith("sqlite:///"):
+        return SQLiteJobQueue(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisJobQueue(url)
+    raise ValueError(f"Unsupported JOB_QUEUE_URL: {url}")
+
+class FleetWorker:
+    """Claims leech jobs from the shared queue and transfers them on this node.
+    
+    Nodes advertise slots and bandwidth; a node that would give the next
+    job a smaller bandwidth share than the best idle peer holds back for
+    CLAIM_GRACE seconds so jobs drift toward the fattest pipes.
+    """
+    
+    def __init__(self, queue, bot):
+        self.queue = queue
+        self.bot = bot
+        self.node_id = Config.NODE_ID
+        self.slots = Config.NODE_SLOTS
+        self.bandwidth = Config.NODE_BANDWIDTH_MBPS
+        self.lease = Config.JOB_LEASE_SECONDS
+        self.active = {}
+        self.completed = 0
+        self.waiting_since = None
+    
+    def advertised(self):
+        return {"slots": self.slots, "active": len(self.active), "bandwidth_mbps": self.bandwidth}
+    
+    def should_defer(self, nodes):
+        """True while a peer would give the next job a clearly better bandwidth share"""
+        my_share = self.bandwidth / (len(self.active) + 1)
+        best_share = max(
+            (info["bandwidth_mbps"] / (info["active"] + 1) for node_id, info in nodes.items()
+             if node_id != self.node_id and info["active"] < info["slots"]),
+            default=0
+        )
+        if best_share <= my_share * 1.25:
+            self.waiting_since = None
+            return False
+        self.waiting_since = self.waiting_since or time.monotonic()
+        return time.monotonic() - self.waiting_since < Config.CLAIM_GRACE
+    
+    async def run(self):
+        logger.info(f"Fleet worker {self.node_id} online ({self.slots} slots, {self.bandwidth} Mbps)")
+        last_advert = 0
+        while True:
+            now = time.monotonic()
+            if now - last_advert >= self.lease / 3:
+                last_advert = now
+                await asyncio.to_thread(self.queue.register_node, self.node_id, self.advertised(), self.lease)
+                await asyncio.to_thread(self.queue.requeue_expired, Config.JOB_MAX_ATTEMPTS)
+            
+            if len(self.active) >= self.slots:
+                await asyncio.sleep(0.5)
+                continue
+            nodes = await asyncio.to_thread(self.queue.live_nodes)
+            if self.should_defer(nodes):
+                await asyncio.sleep(0.5)
+                continue
+            
+            job = await asyncio.to_thread(self.queue.claim, self.node_id, self.lease)
+            if not job:
+                await asyncio.sleep(1)
+                continue
+            self.waiting_since = None
+            self.active[job["job_id"]] = asyncio.create_task(self.process(job))
+            await asyncio.to_thread(self.queue.register_node, self.node_id, self.advertised(), self.lease)
+    
+    async def process(self, job):
+        job_id = job["job_id"]
+        payload = job["payload"]
+        heartbeat_task = asyncio.create_task(self._heartbeat(job_id))
+        
+        async def progress(text):
+            await asyncio.to_thread(self.queue.set_progress, job_id, self.node_id, text)
+        
+        try:
+            with tracer.span("fleet_job", remote_parent=payload.get("trace"), node=self.node_id, attempt=job["attempts"]):
+                receipt = await self.bot.deliver_file(
+                    payload["chat_id"], payload["file_info"], payload["is_premium"], progress
+                )
+            await asyncio.to_thread(self.queue.finish, job_id, self.node_id, "done", receipt)
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Fleet job {job_id} failed on {self.node_id}: {e}")
+            await asyncio.to_thread(self.queue.finish, job_id, self.node_id, "failed", None, str(e))
+        finally:
+            heartbeat_task.cancel()
+            self.active.pop(job_id, None)
+    
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            alive = await asyncio.to_thread(self.queue.heartbeat, job_id, self.node_id, self.lease)
+            if not alive:
+                # Lease was lost (e.g. a long stall) and the job went to another node
+                logger.warning(f"Lost lease on job {job_id}; cancelling local transfer")
+                task = self.active.get(job_id)
+                if task:
+                    task.cancel()
+                return
+
+async def run_fleet_node():
+    """BOT_ROLE=worker: a transfer-only node with no command handlers"""
+    client = TelegramClient(f"bot-node-{Config.NODE_ID}", Config.API_ID, Config.API_HASH)
+    await client.start(bot_token=Config.BOT_TOKEN)
+    worker_bot = TeraboxBot(client=client, transfer_only=True)
+    asyncio.create_task(loop_monitor.run())
+    asyncio.create_task(memory_monitor.run())
+    if Config.PREWARM_CONNECTIONS > 0:
+        asyncio.create_task(worker_bot.warmer.run())
+    if worker_bot.downloader.proxies.proxies:
+        asyncio.create_task(worker_bot.downloader.proxies.run(worker_bot.downloader.session))
+    await FleetWorker(create_job_queue(Config.JOB_QUEUE_URL), worker_bot).run()
+
+class StreamProxy:
+    """Signed, expiring HTTP links that stream a resolved file with Range support.
+    
+    Served by the health-check server, which runs its own asyncio loop in a
+    thread, so proxied bytes never touch the bot's event loop. A link names
+    an in-memory registry entry (the file_info) and carries its expiry, both
+    HMAC-signed; bytes come from the disk cache when present, otherwise from
+    the Terabox dlink with the client's Range passed upstream.
+    """
+    
+    CHUNK = 256 * 1024
+    
+    def __init__(self):
+        self.links = {}  # link_id -> (file_info, expires)
+        self.bot = None
+        self.active = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return bool(Config.STREAM_BASE_URL and self.bot)
+    
+    def attach(self, bot):
+        self.bot = bot
+    
+    @staticmethod
+    def sign(link_id, expires):
+        secret = (Config.STREAM_SECRET or hashlib.sha256(f"stream:{Config.BOT_TOKEN}".encode()).hexdigest()).encode()
+        return hmac.new(secret, f"{link_id}.{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+    
+    def create_link(self, file_info):
+        link_id = uuid.uuid4().hex[:16]
+        expires = int(time.time() + Config.STREAM_LINK_TTL)
+        with self._lock:
+            now = time.time()
+            for stale in [key for key, (_, until) in self.links.items() if until < now]:
+                del self.links[stale]
+            self.links[link_id] = (file_info, expires)
+        name = urllib.parse.quote(file_info["filename"])
+        return f"{Config.STREAM_BASE_URL.rstrip('/')}/stream/{link_id}.{expires}.{self.sign(link_id, expires)}/{name}"
+    
+    def lookup(self, token):
+        """file_info for a valid, unexpired token, else None"""
+        try:
+            link_id, expires, signature = token.split(".")
+            expires = int(expires)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature, self.sign(link_id, expires)) or expires < time.time():
+            return None
+        with self._lock:
+            entry = self.links.get(link_id)
+        return entry[0] if entry else None
+    
+    @staticmethod
+    def parse_range(header, total):
+        """(start, end) inclusive for a single "bytes=" range, None for the whole file, or "invalid" """
+        match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header or "")
+        if not header:
+            return None
+        if not match or not (match.group(1) or match.group(2)):
+            return "invalid"
+        if not match.group(1):
+            if not total:
+                return "invalid"
+            return max(0, total - int(match.group(2))), total - 1
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else (total - 1 if total else None)
+        if total and end is not None:
+            end = min(end, total - 1)
+        if (total and start >= total) or (end is not None and end < start):
+            return "invalid"
+        return start, end
+    
+    async def serve(self, method, token, headers, writer):
+        file_info = self.lookup(token)
+        if not file_info:
+            await http_respond(writer, 403, b"Link expired or invalid\n")
+            return
+        
+        cache_key = self.bot.cache.key_for(file_info) if self.bot.cache else None
+        cached = self.bot.cache.open(cache_key) if cache_key else None
+        try:
+            await self._respond(method, file_info, cached, headers, writer)
+        finally:
+            if cached:
+                cached.close()
+    
+    async def _respond(self, method, file_info, cached, headers, writer):
+        filename = file_info["filename"]
+        size = str(file_info.get("size", ""))
+        total = os.fstat(cached.fileno()).st_size if cached else int(size) if size.isdigit() else 0
+        
+        byte_range = self.parse_range(headers.get("range"), total)
+        if byte_range == "invalid":
+            await http_respond(writer, 416, b"", {"Content-Range": f"bytes */{total or '*'}"})
+            return
+        
+        response = None
+        if not cached:
+            # Pass the range upstream; an open end asks for the rest of the file
+            upstream_range = (byte_range[0], "" if byte_range[1] is None else byte_range[1]) if byte_range else None
+            try:
+                response = await asyncio.to_thread(self.bot.open_source, file_info, upstream_range)
+            except Exception as e:
+                logger.error(f"Stream upstream failed for {filename}: {e}")
+                await http_respond(writer, 502, b"Upstream unavailable\n")
+                return
+            content_range = response.headers.get("Content-Range", "")
+            if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+                total = int(content_range.rsplit("/", 1)[1])
+            elif response.status_code == 200 and response.headers.get("Content-Length"):
+                total = int(response.headers["Content-Length"])
+            served = re.match(r"bytes (\d+)-(\d+)/", content_range)
+            if byte_range and byte_range[1] is None and not total and served and response.status_code == 206:
+                byte_range = (byte_range[0], int(served.group(2)))
+        
+        start, end = byte_range if byte_range else (0, None)
+        if end is None and total:
+            end = total - 1
+        if byte_range and end is None:
+            # Nobody knows where the file ends, so no valid Content-Range can be
+            # sent: from the top (or when upstream ignored Range) answer a plain
+            # 200 with the whole body, otherwise refuse the range
+            if start and response is not None and response.status_code == 206:
+                response.close()
+                await http_respond(writer, 416, b"", {"Content-Range": "bytes */*"})
+                return
+            byte_range, start = None, 0
+        length = end - start + 1 if end is not None else None
+        
+        reply_headers = {
+            "Content-Type": mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            "Content-Disposition": f"inline; filename*=UTF-8''{urllib.parse.quote(filename)}",
+            "Accept-Ranges": "bytes"
+        }
+        if length is not None:
+            reply_headers["Content-Length"] = str(length)
+        if byte_range:
+            reply_headers["Content-Range"] = f"bytes {start}-{end}/{total or '*'}"
+        
+        with self._lock:
+            self.active += 1
+        try:
+            await http_respond(writer, 206 if byte_range else 200, None, reply_headers)
+            if method == "HEAD":
+                return
+            if cached:
+                await self._pipe_file(cached, start, length, writer)
+            else:
+                # Upstream ignored Range: skip to the requested offset ourselves
+                skip = start if response.status_code == 200 else 0
+                await self._pipe_response(response, skip, length, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # viewer closed the player or seeked elsewhere
+        finally:
+            with self._lock:
+                self.active -= 1
+            if response is not None:
+                response.close()
+    
+    async def _send(self, writer, chunk):
+        writer.write(chunk)
+        await writer.drain()
+        with self._lock:
+            self.bytes_sent += len(chunk)
+    
+    async def _pipe_file(self, file, start, length, writer):
+        position, remaining = start, length
+        while remaining is None or remaining > 0:
+            size = self.CHUNK if remaining is None else min(self.CHUNK, remaining)
+            chunk = await asyncio.to_thread(os.pread, file.fileno(), size, position)
+            if not chunk:
+                break
+            await self._send(writer, chunk)
+            position += len(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    
+    async def _pipe_response(self, response, skip, length, writer):
+        raw = response.raw
+        raw.decode_content = True
+        while skip > 0:
+            chunk = await asyncio.to_thread(raw.read, min(self.CHUNK, skip))
+            if not chunk:
+                return
+            skip -= len(chunk)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = await asyncio.to_thread(raw.read, self.CHUNK if remaining is None else min(self.CHUNK, remaining))
+            if not chunk:
+                break
+            await self._send(writer, chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    
+    def stats(self):
+        with self._lock:
+            return {"links": len(self.links), "active_streams": self.active, "bytes_sent": self.bytes_sent}
+
+stream_proxy = StreamProxy()
+
+HTTP_REASONS = {200: "OK", 206: "Partial Content", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+                416: "Range Not Satisfiable", 502: "Bad Gateway", 503: "Service Unavailable"}
 
-# Start health check server in background
-threading.Thread(target=start_health_server, daemon=True).start()
+async def http_respond(writer, status, body, headers=None):
+    """Write a status line and headers, plus body when given (None = caller streams it)"""
+    headers = dict(headers or {})
+    if body is not None:
+        headers.setdefault("Content-Length", str(len(body)))
+    headers["Connection"] = "close"
+    head = f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+    head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(head.encode("latin-1", errors="replace") + b"\r\n")
+    if body:
+        writer.write(body)
+    await writer.drain()
+
+async def handle_http(reader, writer):
+    """Health checks and /stream links; one request per connection"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=30)
+        lines = head.decode("latin-1").split("\r\n")
+        method, target = lines[0].split(" ")[:2]
+        headers = {
+            name.strip().lower(): value.strip()
+            for name, value in (line.split(":", 1) for line in lines[1:] if ":" in line)
+        }
+        path = urllib.parse.unquote(target.split("?")[0])
+        
+        if method not in ("GET", "HEAD"):
+            await http_respond(writer, 405, b"")
+        elif path == "/health":
+            payload = {"status": "ok", "loop": loop_monitor.snapshot()}
+            for name, section in list(health_sections.items()):
+                try:
+                    payload[name] = section()
+                except Exception as e:
+                    payload[name] = {"error": str(e)}
+            await http_respond(writer, 200, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+        elif path == "/memory":
+            # Header only: query strings end up in proxy and access logs
+            supplied = headers.get("authorization", "").removeprefix("Bearer ")
+            if not Config.ADMIN_HTTP_TOKEN:
+                await http_respond(writer, 404, b"Not found\n")
+            elif not hmac.compare_digest(supplied.encode(), Config.ADMIN_HTTP_TOKEN.encode()):
+                await http_respond(writer, 403, b"Forbidden\n")
+            elif not memory_monitor.loop:
+                await http_respond(writer, 503, b"Bot is not running yet\n")
+            else:
+                # This server has its own loop; the structures belong to the bot's
+                payload = await asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(memory_monitor.snapshot(), memory_monitor.loop)
+                )
+                await http_respond(writer, 200, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+        elif path.startswith("/stream/"):
+            if not stream_proxy.bot:
+                await http_respond(writer, 404, b"Streaming is not enabled\n")
+            else:
+                await stream_proxy.serve(method, path.split("/")[2], headers, writer)
+        else:
+            await http_respond(writer, 200, b"Bot is healthy!")
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+        with contextlib.suppress(Exception):
+            await writer.wait_closed()
+
+async def serve_http(host="0.0.0.0", port=8080):
+    server = await asyncio.start_server(handle_http, host, port)
+    async with server:
+        await server.serve_forever()
+
+def start_health_server():
+    # Own loop in its own thread: streaming never competes with the bot's loop
+    asyncio.run(serve_http())
 
 if __name__ == "__main__":
+    # Start health check server in background (not in transfer workers,
+    # which re-import this module)
+    threading.Thread(target=start_health_server, daemon=True).start()
+    
     # Load environment variables
     if os.path.exists("config.env"):
         with open("config.env") as f:
@@ -1239,6 +6014,17 @@ if __name__ == "__main__":
         logger.error("Please set these in Koyeb environment variables!")
         exit(1)
     
+    # Before any connection is opened (transfer workers re-import and skip this)
+    dns_cache.install()
+    
+    if Config.BOT_ROLE == "worker":
+        if not Config.JOB_QUEUE_URL or Config.JOB_QUEUE_URL.startswith("memory://"):
+            logger.error("❌ BOT_ROLE=worker needs a shared JOB_QUEUE_URL (sqlite:// or redis://)")
+            exit(1)
+        logger.info(f"🚚 Starting transfer node {Config.NODE_ID}...")
+        asyncio.run(run_fleet_node())
+        exit(0)
+    
     # Start the bot
     bot = TeraboxBot()
     try:
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Load generator and soak test for Ultimate Terabox Bot
+Drives a single TeraboxBot's handlers with a weighted mix of synthetic
+users against the offline stand-ins from benchmark.py.
+
+Ramp mode steps the offered message rate up until latency or errors
+break the SLO (the saturation point). Soak mode holds one rate for a
+long time and watches SimpleStorage and RSS for leaks.
+
+Usage:
+  python loadtest.py ramp --start-rate 5 --step-rate 5 --step-seconds 30
+  python loadtest.py soak --rate 10 --duration 7200 --report soak.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from collections import defaultdict
+
+import bot
+from benchmark import FakeEvent, FakeShortlink, FakeTelegramClient, FakeTerabox, configure_bot, peak_rss_mb
+
+# action -> relative weight; roughly what a busy group sends
+DEFAULT_MIX = {
+    "start": 20,
+    "stats": 8,
+    "verify": 15,
+    "buy": 5,
+    "buy_plan": 5,
+    "callback": 17,
+    "leech": 30
+}
+CALLBACK_DATA = [b"stats", b"help", b"verify", b"buy_2h", b"buy_6h", b"paid_ABCD1234"]
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def deep_size(obj, seen=None):
+    """Approximate retained bytes of nested dicts/lists (shared objects counted once)"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def storage_footprint(storage):
+    users = list(storage.users.values())
+    return {
+        "users": len(users),
+        "payments": len(storage.payments),
+        "tokens": sum(len(u.get("tokens", [])) for u in users),
+        "verified_tokens": sum(len(u.get("verified_tokens", [])) for u in users),
+        "subscriptions": sum(len(u.get("subscriptions", [])) for u in users),
+        "bytes": deep_size(storage.users) + deep_size(storage.payments) + deep_size(storage.tokens)
+    }
+
+
+def slope_per_hour(points):
+    """Least-squares slope of (seconds, value) points, scaled to per hour"""
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    denom = sum((x - mean_x) ** 2 for x, _ in points)
+    if not denom:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denom * 3600
+
+
+class LoadGenerator:
+    """Open-loop arrivals: messages are fired on schedule whether or not earlier ones finished"""
+
+    def __init__(self, tb, client, population, new_user_ratio, mix):
+        self.tb = tb
+        self.client = client
+        self.population = population
+        self.new_user_ratio = new_user_ratio
+        self.actions = list(mix)
+        self.weights = [mix[a] for a in self.actions]
+        self.next_new_user = 500000
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.in_flight = 0
+        self.active_leeches = 0
+        self.peak_in_flight = 0
+        self.peak_active_leeches = 0
+        self.tasks = set()
+
+    def pick_user(self):
+        if random.random() < self.new_user_ratio:
+            self.next_new_user += 1
+            return self.next_new_user
+        return 100000 + random.randrange(self.population)
+
+    def build_event(self, action, user_id):
+        if action == "start":
+            return self.tb.handle_start, FakeEvent(self.client, user_id, "/start")
+        if action == "stats":
+            return self.tb.handle_stats, FakeEvent(self.client, user_id, "/stats")
+        if action == "verify":
+            return self.tb.handle_verify, FakeEvent(self.client, user_id, "/verify")
+        if action == "buy":
+            return self.tb.handle_buy, FakeEvent(self.client, user_id, "/buy")
+        if action == "buy_plan":
+            return self.tb.handle_buy, FakeEvent(self.client, user_id, f"/buy {random.choice(list(bot.Config.PREMIUM_PLANS))}")
+        if action == "callback":
+            return self.tb.handle_callbacks, FakeEvent(self.client, user_id, data=random.choice(CALLBACK_DATA))
+        link = f"https://teraboxapp.com/s/1lt{random.randrange(10 ** 6)}"
+        return self.tb.handle_leech, FakeEvent(self.client, user_id, link)
+
+    async def fire(self, action):
+        user_id = self.pick_user()
+        if action == "leech" and random.random() < 0.5:
+            # Half of leechers completed the shortlink step earlier
+            tokens = self.tb.storage.get_user(user_id)["tokens"]
+            if tokens:
+                self.tb.token_manager.verify_token(user_id, tokens[-1]["token"])
+        handler, event = self.build_event(action, user_id)
+
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if action == "leech":
+            self.active_leeches += 1
+            self.peak_active_leeches = max(self.peak_active_leeches, self.active_leeches)
+        started = time.perf_counter()
+        try:
+            await handler(event)
+            final = event.responses[-1].text if event.responses else ""
+            if final.startswith("❌ **Error"):
+                self.errors[action] += 1
+        except Exception:
+            self.errors[action] += 1
+        finally:
+            self.latencies[action].append(time.perf_counter() - started)
+            self.in_flight -= 1
+            if action == "leech":
+                self.active_leeches -= 1
+
+    async def run_rate(self, rate, seconds):
+        """Offer `rate` messages/s for `seconds`; returns how many were sent"""
+        interval = 1.0 / rate
+        deadline = time.monotonic() + seconds
+        next_at = time.monotonic()
+        sent = 0
+        while time.monotonic() < deadline:
+            action = random.choices(self.actions, self.weights)[0]
+            task = asyncio.create_task(self.fire(action))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            sent += 1
+            next_at += interval
+            await asyncio.sleep(max(0, next_at - time.monotonic()))
+        return sent
+
+    def drain_window(self):
+        """Stats since the previous call"""
+        latencies, errors = self.latencies, self.errors
+        self.latencies, self.errors = defaultdict(list), defaultdict(int)
+        all_latencies = [v for values in latencies.values() for v in values]
+        return {
+            "completed": len(all_latencies),
+            "errors": sum(errors.values()),
+            "p50_ms": round(bot.percentile(all_latencies, 50) * 1000, 1),
+            "p95_ms": round(bot.percentile(all_latencies, 95) * 1000, 1),
+            "p99_ms": round(bot.percentile(all_latencies, 99) * 1000, 1),
+            "handlers": {
+                action: {
+                    "count": len(values),
+                    "errors": errors.get(action, 0),
+                    "p50_ms": round(bot.percentile(values, 50) * 1000, 1),
+                    "p95_ms": round(bot.percentile(values, 95) * 1000, 1)
+                }
+                for action, values in sorted(latencies.items())
+            }
+        }
+
+
+async def setup(args):
+    terabox = FakeTerabox(
+        file_size=int(args.file_mb * 1024 * 1024),
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate
+    ).start()
+    shortlink = FakeShortlink(latency=args.latency_ms / 1000).start()
+    configure_bot(terabox, shortlink)
+    bot.Config.FREE_DOWNLOADS = args.free_downloads
+    bot.Config.PAYMENT_CHANNEL = 0
+
+    client = FakeTelegramClient(upload_rate=int(args.upload_mbps * 1024 * 1024))
+    tb = bot.TeraboxBot(client=client)
+    generator = LoadGenerator(tb, client, args.users, args.new_user_ratio, DEFAULT_MIX)
+    return terabox, shortlink, tb, generator
+
+
+async def run_ramp(args, tb, generator, monitor):
+    steps = []
+    saturation = None
+    rate = args.start_rate
+    while rate <= args.max_rate:
+        sent = await generator.run_rate(rate, args.step_seconds)
+        # Give stragglers a moment so the window reflects this step
+        await asyncio.sleep(min(2, args.step_seconds / 5))
+        window = generator.drain_window()
+        step = {
+            "offered_rate": rate,
+            "sent": sent,
+            "achieved_rate": round(window["completed"] / args.step_seconds, 2),
+            "error_rate": round(window["errors"] / max(1, window["completed"]), 4),
+            "in_flight": generator.in_flight,
+            "peak_active_leeches": generator.peak_active_leeches,
+            "loop_lag_p99_ms": monitor.snapshot()["p99_ms"],
+            "rss_mb": round(current_rss_mb(), 1),
+            **window
+        }
+        steps.append(step)
+        print(f"rate={rate:>6} achieved={step['achieved_rate']:>7} p95={step['p95_ms']:>8}ms "
+              f"errors={step['error_rate']:.2%} in_flight={step['in_flight']}")
+
+        if (step["p95_ms"] > args.slo_p95_ms or step["error_rate"] > args.max_error_rate
+                or step["achieved_rate"] < 0.9 * rate):
+            saturation = {"offered_rate": rate, "reason": (
+                "latency" if step["p95_ms"] > args.slo_p95_ms else
+                "errors" if step["error_rate"] > args.max_error_rate else "throughput"
+            )}
+            break
+        rate += args.step_rate
+
+    return {
+        "mode": "ramp",
+        "saturation": saturation,
+        "last_good_rate": steps[-2]["offered_rate"] if saturation and len(steps) > 1 else (steps[-1]["offered_rate"] if steps else None),
+        "peak_in_flight": generator.peak_in_flight,
+        "peak_active_leeches": generator.peak_active_leeches,
+        "steps": steps
+    }
+
+
+async def run_soak(args, tb, generator, monitor):
+    samples = []
+    started = time.monotonic()
+    while time.monotonic() - started < args.duration:
+        await generator.run_rate(args.rate, min(args.sample_seconds, args.duration - (time.monotonic() - started)))
+        window = generator.drain_window()
+        footprint = storage_footprint(tb.storage)
+        sample = {
+            "t": round(time.monotonic() - started, 1),
+            "rss_mb": round(current_rss_mb(), 1),
+            "storage": footprint,
+            "loop_lag_p99_ms": monitor.snapshot()["p99_ms"],
+            "in_flight": generator.in_flight,
+            **window
+        }
+        samples.append(sample)
+        print(f"t={sample['t']:>7}s rss={sample['rss_mb']}MB users={footprint['users']} "
+              f"storage={footprint['bytes'] / 1024:.0f}KB p95={sample['p95_ms']}ms errors={sample['errors']}")
+
+    # Judge growth on the second half only, after caches and pools have warmed up
+    tail = samples[len(samples) // 2:]
+    rss_growth = slope_per_hour([(s["t"], s["rss_mb"]) for s in tail])
+    storage_growth = slope_per_hour([(s["t"], s["storage"]["bytes"] / (1024 * 1024)) for s in tail])
+    per_user_growth = slope_per_hour([
+        (s["t"], s["storage"]["bytes"] / max(1, s["storage"]["users"]))
+        for s in tail
+    ])
+    return {
+        "mode": "soak",
+        "rate": args.rate,
+        "duration_s": args.duration,
+        "rss_growth_mb_per_hour": round(rss_growth, 2),
+        "storage_growth_mb_per_hour": round(storage_growth, 2),
+        "bytes_per_user_growth_per_hour": round(per_user_growth, 1),
+        "leak_suspected": rss_growth > args.leak_mb_per_hour or per_user_growth > args.leak_bytes_per_user_hour,
+        "peak_in_flight": generator.peak_in_flight,
+        "peak_active_leeches": generator.peak_active_leeches,
+        "samples": samples
+    }
+
+
+async def main(args):
+    terabox, shortlink, tb, generator = await setup(args)
+    monitor = bot.LoopMonitor(interval=0.05, threshold=0.2)
+    monitor_task = asyncio.create_task(monitor.run())
+    try:
+        if args.mode == "ramp":
+            report = await run_ramp(args, tb, generator, monitor)
+        else:
+            report = await run_soak(args, tb, generator, monitor)
+        if generator.tasks:
+            await asyncio.wait(list(generator.tasks), timeout=30)
+    finally:
+        monitor_task.cancel()
+        await asyncio.to_thread(terabox.stop)
+        await asyncio.to_thread(shortlink.stop)
+
+    report["final_storage"] = storage_footprint(tb.storage)
+    report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    report["loop"] = monitor.snapshot()
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.report}")
+    if report["mode"] == "ramp":
+        print(f"Saturation: {report['saturation'] or 'not reached'}; last good rate: {report['last_good_rate']} msg/s")
+    else:
+        print(f"RSS growth {report['rss_growth_mb_per_hour']} MB/h, storage growth "
+              f"{report['storage_growth_mb_per_hour']} MB/h, leak suspected: {report['leak_suspected']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator / soak test for TeraboxBot")
+    parser.add_argument("mode", choices=["ramp", "soak"])
+    parser.add_argument("--users", type=int, default=1000, help="returning user population")
+    parser.add_argument("--new-user-ratio", type=float, default=0.1, help="share of messages from brand-new users")
+    parser.add_argument("--free-downloads", type=int, default=3)
+    parser.add_argument("--file-mb", type=float, default=1)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--upload-mbps", type=float, default=0)
+    # ramp
+    parser.add_argument("--start-rate", type=float, default=5, help="messages/s for the first step")
+    parser.add_argument("--step-rate", type=float, default=5)
+    parser.add_argument("--step-seconds", type=float, default=30)
+    parser.add_argument("--max-rate", type=float, default=500)
+    parser.add_argument("--slo-p95-ms", type=float, default=2000)
+    parser.add_argument("--max-error-rate", type=float, default=0.02)
+    # soak
+    parser.add_argument("--rate", type=float, default=10, help="messages/s held during soak")
+    parser.add_argument("--duration", type=float, default=3600, help="soak length in seconds")
+    parser.add_argument("--sample-seconds", type=float, default=60)
+    parser.add_argument("--leak-mb-per-hour", type=float, default=5)
+    parser.add_argument("--leak-bytes-per-user-hour", type=float, default=256,
+                        help="per-user storage growth that counts as unbounded")
+    parser.add_argument("--report", default="loadtest_report.json")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        bot.logger.setLevel(logging.WARNING)
+    asyncio.run(main(args))
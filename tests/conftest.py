@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Keep importing bot.py side-effect free: no trace file, journal or cache on disk
+os.environ.setdefault("TRACE_FILE", "")
+os.environ.setdefault("JOURNAL_PATH", "")
+os.environ.setdefault("CACHE_MAX_BYTES", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+from telethon import errors
+
+import bot
+
+
+class FakeClient:
+    """Records sends; per-user failures and an optional gate that stalls a user's send"""
+
+    def __init__(self, failures=None, stall=()):
+        self.failures = failures or {}
+        self.stall = set(stall)
+        self.sent = []
+        self.stalled = asyncio.Event()
+
+    async def send_message(self, user_id, message):
+        if user_id in self.stall:
+            self.stalled.set()
+            await asyncio.Event().wait()
+        error = self.failures.get(user_id)
+        if error:
+            raise error
+        self.sent.append(user_id)
+
+    async def edit_message(self, *args, **kwargs):
+        pass
+
+
+def make_broadcaster(tmp_path, client, users):
+    storage = bot.SimpleStorage()
+    for user_id in users:
+        storage.get_user(user_id)
+    broadcaster = bot.Broadcaster(client, storage, path=str(tmp_path / "broadcast.json"))
+    broadcaster.bucket = bot.TokenBucket(10000, 10000)
+    return broadcaster, storage
+
+
+def test_outcomes_are_counted_and_only_gone_users_pruned(tmp_path):
+    async def scenario():
+        client = FakeClient({
+            2: errors.UserIsBlockedError(None),
+            3: errors.PeerIdInvalidError(None),
+            4: RuntimeError("boom"),
+        })
+        broadcaster, storage = make_broadcaster(tmp_path, client, range(1, 7))
+        broadcaster.start(admin_chat=1, status_msg_id=1, text="hi")
+        await broadcaster.task
+        return client, broadcaster, storage
+
+    client, broadcaster, storage = asyncio.run(scenario())
+    assert sorted(client.sent) == [1, 5, 6]
+    state = broadcaster.load()
+    assert (state["sent"], state["pruned"], state["failed"]) == (3, 1, 2)
+    assert state["cursor"] == 6 and state["done_above"] == []
+    assert storage.users["2"]["inactive"] == "UserIsBlockedError"
+    assert "inactive" not in storage.users["3"]
+
+
+def test_cancelled_send_is_retried_on_resume(tmp_path):
+    bot.Config.BROADCAST_CONCURRENCY, concurrency = 3, bot.Config.BROADCAST_CONCURRENCY
+    try:
+        async def interrupted():
+            client = FakeClient(stall={2})
+            broadcaster, _ = make_broadcaster(tmp_path, client, range(1, 9))
+            broadcaster.start(admin_chat=1, status_msg_id=1, text="hi")
+            await client.stalled.wait()
+            while len(client.sent) < 7:
+                await asyncio.sleep(0)
+            # A shutdown, not an admin cancel: the task dies but the checkpoint stays resumable
+            broadcaster.task.cancel()
+            await asyncio.gather(broadcaster.task, return_exceptions=True)
+            return client
+
+        first = asyncio.run(interrupted())
+        with open(tmp_path / "broadcast.json") as f:
+            state = json.load(f)
+        assert state["cursor"] == 1
+        assert set(state["done_above"]) == set(range(2, 8))
+
+        async def resumed():
+            client = FakeClient()
+            broadcaster, _ = make_broadcaster(tmp_path, client, ())
+            broadcaster.resume()
+            await broadcaster.task
+            return client, broadcaster
+
+        second, broadcaster = asyncio.run(resumed())
+    finally:
+        bot.Config.BROADCAST_CONCURRENCY = concurrency
+    assert second.sent == [2]
+    assert sorted(first.sent + second.sent) == list(range(1, 9))
+    assert broadcaster.load()["sent"] == 8
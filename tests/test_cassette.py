@@ -0,0 +1,98 @@
+import base64
+import gzip
+import io
+import json
+
+import requests
+
+import bot
+
+
+def replay_session(tmp_path, *exchanges):
+    path = tmp_path / "cassette.jsonl"
+    with open(path, "w") as f:
+        f.write(json.dumps({"cassette": 1}) + "\n")
+        for exchange in exchanges:
+            f.write(json.dumps(exchange) + "\n")
+    session = requests.Session()
+    session.mount("https://", bot.CassetteAdapter(bot.Cassette(str(path), "replay")))
+    return session
+
+
+def exchange(body, body_bytes, headers):
+    return {
+        "method": "GET", "url": "https://example.com/page", "status": 200, "reason": "OK",
+        "headers": headers, "body": base64.b64encode(body).decode(), "body_bytes": body_bytes
+    }
+
+
+def test_truncated_gzip_body_replays_decoded(tmp_path):
+    page = b"<html>" + b"x" * 200000 + b"</html>"
+    encoded = gzip.compress(page)
+    session = replay_session(tmp_path, exchange(
+        encoded[:len(encoded) // 2], len(encoded), {"Content-Encoding": "gzip", "Content-Length": str(len(encoded))}
+    ))
+    response = session.get("https://example.com/page")
+    assert "Content-Encoding" not in response.headers
+    assert response.content.startswith(b"<html>xxx")
+    assert len(response.content) >= len(encoded)
+
+
+def test_complete_gzip_body_is_untouched(tmp_path):
+    encoded = gzip.compress(b"hello world")
+    session = replay_session(tmp_path, exchange(encoded, len(encoded), {"Content-Encoding": "gzip"}))
+    assert session.get("https://example.com/page").content == b"hello world"
+
+
+def test_truncated_identity_body_is_padded(tmp_path):
+    session = replay_session(tmp_path, exchange(b"abc", 6, {"Content-Type": "text/plain"}))
+    assert session.get("https://example.com/page").content == b"abc\0\0\0"
+
+
+class FakeRaw:
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, amt=None, decode_content=False):
+        return self.data.read(amt)
+
+    def release_conn(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def record(tmp_path, body, headers):
+    cassette = bot.Cassette(str(tmp_path / "rec.jsonl"), "record")
+    exchange = {"method": "GET", "url": "https://example.com/api", "status": 200, "headers": headers}
+    recording = bot._RecordingBody(FakeRaw(body), exchange, cassette)
+    while recording.read(7):
+        pass
+    recording.close()
+    return exchange, base64.b64decode(exchange["body"])
+
+
+def test_recorded_bodies_are_redacted(tmp_path):
+    page = json.dumps({
+        "errno": 0, "bdstoken": "SECRET123", "uk": 4401,
+        "list": [{"dlink": "https://d.terabox.com/file/x?fid=1&sign=SIG&time=5", "server_filename": "a.mp4"}]
+    }).replace("/", "\\/").encode()
+    exchange, stored = record(tmp_path, gzip.compress(page), {
+        "Content-Type": "application/json", "Content-Encoding": "gzip", "Content-Length": "999"
+    })
+    data = json.loads(stored)
+    assert data["bdstoken"] == "REDACTED" and data["uk"] == "REDACTED"
+    assert data["list"][0]["server_filename"] == "a.mp4"
+    assert "SIG" not in data["list"][0]["dlink"] and "fid=1" in data["list"][0]["dlink"]
+    assert exchange["body_bytes"] == len(stored)
+    assert exchange["headers"] == {"Content-Type": "application/json"}
+    with open(tmp_path / "rec.jsonl") as f:
+        assert "SECRET123" not in f.read()
+
+
+def test_html_token_assignments_are_redacted(tmp_path):
+    _, stored = record(tmp_path, b'<script>var jsToken = decodeURIComponent("%22TOKEN%22");</script>', {
+        "Content-Type": "text/html"
+    })
+    assert b"TOKEN%22" not in stored and b"jsToken" in stored
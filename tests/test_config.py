@@ -0,0 +1,15 @@
+import pytest
+
+import bot
+
+
+def test_tier_setting_skips_blank_items(monkeypatch):
+    monkeypatch.setenv("LEECH_RATE_LIMITS", " free=3, ,premium = 20,")
+    assert bot.tier_setting("LEECH_RATE_LIMITS", "free=1", int) == {"free": 3, "premium": 20}
+
+
+@pytest.mark.parametrize("value", ["free", "free=", "=3", "free=3=4", "free=lots"])
+def test_tier_setting_names_the_bad_item(monkeypatch, value):
+    monkeypatch.setenv("TIER_BANDWIDTH_SHARES", f"premium=6,{value}")
+    with pytest.raises(ValueError, match=r"TIER_BANDWIDTH_SHARES: .*'" + value):
+        bot.tier_setting("TIER_BANDWIDTH_SHARES", "free=1", float)
@@ -0,0 +1,37 @@
+import threading
+from types import SimpleNamespace
+
+import bot
+
+
+def response(url):
+    return SimpleNamespace(url=url, request=SimpleNamespace(method="GET"))
+
+
+def test_stats_while_request_threads_learn_origins(monkeypatch):
+    monkeypatch.setattr(bot.Config, "PREWARM_MAX_HOSTS", 100000)
+    warmer = bot.ConnectionWarmer()
+    session = object()
+    done = threading.Event()
+
+    def traffic(worker):
+        for n in range(1000):
+            warmer._touch(session, response(f"https://cdn{worker}-{n}.example/file"))
+        done.set()
+
+    threads = [threading.Thread(target=traffic, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    while not done.is_set():
+        warmer.stats()
+    for thread in threads:
+        thread.join()
+    assert len(warmer.stats()["origins"]) == 4000
+
+
+def test_learned_origins_are_capped(monkeypatch):
+    monkeypatch.setattr(bot.Config, "PREWARM_MAX_HOSTS", 2)
+    warmer = bot.ConnectionWarmer()
+    for n in range(5):
+        warmer._touch(object(), response(f"https://cdn{n}.example/file"))
+    assert list(warmer.stats()["origins"]) == ["https://cdn0.example", "https://cdn1.example"]
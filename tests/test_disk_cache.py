@@ -0,0 +1,105 @@
+import os
+import time
+
+from bot import DiskCache
+
+
+def age(path, seconds):
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+
+def test_commit_publishes_and_indexes(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1024)
+    writer = cache.writer("md5-aa", 5)
+    assert f".{os.getpid()}." in os.path.basename(writer.temp_path)
+    writer.write(b"hello")
+    path = writer.commit()
+    assert path == cache.path("md5-aa")
+    assert not os.path.exists(writer.temp_path)
+    with cache.open("md5-aa") as f:
+        assert f.name == path and f.read() == b"hello"
+    assert DiskCache(str(tmp_path), max_bytes=1024).stats()["files"] == 1
+
+
+def test_short_write_is_discarded(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1024)
+    writer = cache.writer("md5-bb", 10)
+    writer.write(b"short")
+    assert writer.commit() is None
+    assert os.listdir(cache.temp_dir) == []
+    assert cache.open("md5-bb") is None
+
+
+def test_sweep_spares_live_writers_and_resumables(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1024)
+    live = cache.writer("md5-cc", 4)
+    live.write(b"ab")
+    stale = cache.writer("md5-dd", 4)
+    stale.abort()
+    open(stale.temp_path, "wb").close()
+    age(stale.temp_path, 7200)
+    resume = cache.resume_path("md5-ee", "job1")
+    open(resume, "wb").close()
+    age(resume, 7200)
+
+    # Another process starting up: a worker never sweeps, the main bot only sweeps stale files
+    DiskCache(str(tmp_path), max_bytes=1024, sweep=False)
+    assert os.path.exists(stale.temp_path)
+    DiskCache(str(tmp_path), max_bytes=1024)
+    assert not os.path.exists(stale.temp_path)
+    assert os.path.exists(resume)
+
+    live.write(b"cd")
+    assert live.commit() == cache.path("md5-cc")
+
+
+def test_commit_survives_vanished_temp_file(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1024)
+    writer = cache.writer("md5-ff", 3)
+    writer.write(b"abc")
+    cache.sweep_temp(max_age=-1)
+    assert writer.commit() is None
+    assert cache.open("md5-ff") is None
+
+
+def test_eviction_respects_budget(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=8)
+    for key in ("md5-01", "md5-02", "md5-03"):
+        writer = cache.writer(key, 4)
+        writer.write(b"data")
+        writer.commit()
+    stats = cache.stats()
+    assert stats["bytes"] == 8 and stats["evictions"] == 1
+    assert cache.open("md5-01") is None
+
+
+def publish(cache, key, data):
+    writer = cache.writer(key, len(data))
+    writer.write(data)
+    return writer.commit()
+
+
+def test_budget_is_shared_between_processes(tmp_path):
+    # Two DiskCache instances stand in for the bot and a transfer worker
+    bot_cache = DiskCache(str(tmp_path), max_bytes=8)
+    worker_cache = DiskCache(str(tmp_path), max_bytes=8, sweep=False)
+    publish(bot_cache, "md5-01", b"data")
+    age(bot_cache.path("md5-01"), 60)
+    publish(worker_cache, "md5-02", b"data")
+    publish(bot_cache, "md5-03", b"data")
+    assert sorted(os.listdir(tmp_path)) == ["md5-02.bin", "md5-03.bin", "tmp"]
+    # A file the other process published is a hit, not a miss
+    with worker_cache.open("md5-03") as f:
+        assert f.read() == b"data"
+
+
+def test_open_handle_survives_eviction_elsewhere(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=4)
+    publish(cache, "md5-01", b"old!")
+    handle = cache.open("md5-01")
+    publish(DiskCache(str(tmp_path), max_bytes=4, sweep=False), "md5-02", b"new!")
+    assert not os.path.exists(cache.path("md5-01"))
+    assert os.pread(handle.fileno(), 4, 0) == b"old!"
+    handle.close()
+    assert cache.open("md5-01") is None
@@ -0,0 +1,82 @@
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class Resolver:
+    """Stands in for socket.getaddrinfo and counts the lookups that leave the process"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def __call__(self, host, port, family=0, type=0, proto=0, flags=0):
+        if not flags & socket.AI_NUMERICHOST:
+            self.calls.append(host)
+            if self.fail:
+                raise socket.gaierror("lookup failed")
+            host = "10.0.0.1"
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (host, port))]
+
+
+class Answer(list):
+    """dnspython's answer: iterable records plus the rrset TTL"""
+
+    def __init__(self, addresses, ttl):
+        super().__init__(SimpleNamespace(address=address) for address in addresses)
+        self.rrset = SimpleNamespace(ttl=ttl)
+
+
+def make_cache(resolver):
+    cache = bot.DNSCache()
+    cache.resolve = resolver
+    return cache
+
+
+def test_hits_are_served_from_cache(monkeypatch):
+    monkeypatch.setattr(bot, "dns", None)
+    resolver = Resolver()
+    cache = make_cache(resolver)
+    first = cache.getaddrinfo("example.com", 443)
+    assert cache.getaddrinfo("EXAMPLE.com", 443) == first
+    assert resolver.calls == ["example.com"]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["ttl_source"]) == (1, 1, "fixed")
+
+
+def test_expired_entry_is_served_when_refresh_fails(monkeypatch):
+    monkeypatch.setattr(bot, "dns", None)
+    resolver = Resolver()
+    cache = make_cache(resolver)
+    answer = cache.getaddrinfo("example.com", 443)
+    key = next(iter(cache.entries))
+    cache.entries[key] = (0, cache.entries[key][1])
+    resolver.fail = True
+    assert cache.getaddrinfo("example.com", 443) == answer
+    assert cache.stats()["stale_served"] == 1
+    with pytest.raises(socket.gaierror):
+        cache.getaddrinfo("other.example", 443)
+
+
+def test_dnspython_answer_is_the_only_query(monkeypatch):
+    queries = []
+
+    class NXDOMAIN(Exception):
+        pass
+
+    def resolve(host, rdtype, lifetime):
+        queries.append((host, rdtype))
+        return Answer(["192.0.2.7", "192.0.2.8"], 120)
+
+    monkeypatch.setattr(bot, "dns", SimpleNamespace(resolver=SimpleNamespace(resolve=resolve, NXDOMAIN=NXDOMAIN)))
+    resolver = Resolver()
+    cache = make_cache(resolver)
+    result = cache.getaddrinfo("example.com", 443)
+    assert [info[4][0] for info in result] == ["192.0.2.7", "192.0.2.8"]
+    assert queries == [("example.com", "A")]
+    assert resolver.calls == []
+    expires = next(iter(cache.entries.values()))[0]
+    assert expires - bot.time.monotonic() <= min(max(120, bot.Config.DNS_MIN_TTL), bot.Config.DNS_MAX_TTL)
@@ -0,0 +1,49 @@
+import json
+
+from bot import EmbeddedJSONScanner
+
+DATA = {"shareid": 1, "file_list": [
+    {"server_filename": 'we{ird} "name".mp4', "size": 1024, "fs_id": 77, "md5": "ab", "thumbs": {"url3": "t"}}
+]}
+PAGE = (
+    "<html><script>if (window.yunData) { init(); }</script>"
+    "<script>window.yunData = " + json.dumps(DATA) + ";</script>"
+    + "x" * 500 + "</html>"
+)
+
+
+def scan(chunks):
+    scanner = EmbeddedJSONScanner()
+    for chunk in chunks:
+        block = scanner.feed(chunk)
+        while block is not None:
+            files = EmbeddedJSONScanner.files(block)
+            if files:
+                return files
+            block = scanner.resume()
+    return []
+
+
+def test_decoy_marker_is_skipped_in_one_chunk():
+    files = scan([PAGE])
+    assert [f["filename"] for f in files] == ['we{ird} "name".mp4']
+    assert files[0]["size"] == 1024 and files[0]["fs_id"] == "77"
+
+
+def test_every_chunk_split_finds_the_same_files():
+    expected = scan([PAGE])
+    for size in (1, 2, 3, 7, 13, 64):
+        chunks = [PAGE[i:i + size] for i in range(0, len(PAGE), size)]
+        assert scan(chunks) == expected, size
+    for cut in range(len(PAGE)):
+        assert scan([PAGE[:cut], PAGE[cut:]]) == expected, cut
+
+
+def test_block_ends_exactly_at_the_closing_brace():
+    scanner = EmbeddedJSONScanner()
+    block = scanner.feed("locals.mset(" + json.dumps(DATA) + ");trailing")
+    assert json.loads(block) == DATA
+
+
+def test_page_without_files_yields_nothing():
+    assert scan(["<script>if (window.yunData) { a(); } window.locals = {\"x\": 1}</script>"]) == []
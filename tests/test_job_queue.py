@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def queue(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return bot.MemoryJobQueue()
+    if request.param == "sqlite":
+        return bot.SQLiteJobQueue(str(tmp_path / "jobs.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    redis = pytest.importorskip("redis")
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.Redis, "from_url",
+        lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+    )
+    return bot.RedisJobQueue("redis://fake/0")
+
+
+def test_claim_finish_round_trip(queue):
+    first = queue.enqueue({"n": 1})
+    second = queue.enqueue({"n": 2})
+
+    job = queue.claim("a", 60)
+    assert job["job_id"] == first and job["payload"] == {"n": 1}
+    assert job["status"] == "leased" and job["node"] == "a" and job["attempts"] == 1
+    assert queue.claim("b", 60)["job_id"] == second
+    assert queue.claim("c", 60) is None
+
+    assert queue.heartbeat(first, "a", 60)
+    assert queue.finish(first, "a", "done", {"ok": True})
+    assert not queue.finish(first, "a", "done", {"ok": True})
+    done = queue.get_job(first)
+    assert done["status"] == "done" and done["result"] == {"ok": True}
+
+
+def test_expired_lease_moves_to_another_node(queue):
+    job_id = queue.enqueue({"n": 1})
+    queue.claim("a", -1)
+    assert queue.requeue_expired(max_attempts=3) == 1
+
+    job = queue.claim("b", 60)
+    assert job["job_id"] == job_id and job["attempts"] == 2
+    # The node that lost the lease can neither extend nor finish it
+    assert not queue.heartbeat(job_id, "a", 60)
+    assert not queue.finish(job_id, "a", "failed", None, "late")
+    assert queue.requeue_expired(max_attempts=3) == 0
+    assert queue.finish(job_id, "b", "done", {"ok": True})
+    assert queue.get_job(job_id)["status"] == "done"
+
+
+def test_lease_expiry_gives_up_after_max_attempts(queue):
+    job_id = queue.enqueue({"n": 1})
+    queue.claim("a", -1)
+    assert queue.requeue_expired(max_attempts=1) == 0
+    job = queue.get_job(job_id)
+    assert job["status"] == "failed" and job["error"] == "lease expired too many times"
+    assert queue.claim("b", 60) is None
+
+
+def test_forgotten_job_is_not_claimed(queue):
+    forgotten = queue.enqueue({"n": 1})
+    kept = queue.enqueue({"n": 2})
+    queue.forget(forgotten)
+    assert queue.claim("a", 60)["job_id"] == kept
+    assert queue.claim("a", 60) is None
+
+
+def test_front_end_gives_up_when_no_node_claims(monkeypatch):
+    monkeypatch.setattr(bot.Config, "FLEET_QUEUE_TIMEOUT", 0)
+    front = bot.TeraboxBot.__new__(bot.TeraboxBot)
+    front.job_queue = bot.MemoryJobQueue()
+
+    async def progress(text):
+        pass
+
+    with pytest.raises(RuntimeError, match="no transfer node"):
+        asyncio.run(front.submit_fleet_job(1, {"filename": "a"}, False, progress))
+    assert not front.job_queue.jobs
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import threading
+
+import bot
+
+
+async def fetch(port, target, headers=""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: x\r\n{headers}\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), body
+
+
+def test_memory_report_needs_the_header_and_runs_on_the_bot_loop(monkeypatch):
+    monkeypatch.setattr(bot.Config, "ADMIN_HTTP_TOKEN", "s3cret")
+    monitor = bot.MemoryMonitor()
+    monkeypatch.setattr(bot, "memory_monitor", monitor)
+    measured_on = []
+    monitor.sections["probe"] = lambda: measured_on.append(threading.get_ident()) or {"count": 1}
+
+    async def bot_loop(ready, stop):
+        monitor.loop = asyncio.get_running_loop()
+        ready.set()
+        await asyncio.to_thread(stop.wait)
+
+    ready, stop = threading.Event(), threading.Event()
+    thread = threading.Thread(target=lambda: asyncio.run(bot_loop(ready, stop)))
+    thread.start()
+    ready.wait(5)
+
+    async def scenario():
+        server = await asyncio.start_server(bot.handle_http, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return (
+                await fetch(port, "/memory?token=s3cret"),
+                await fetch(port, "/memory", "Authorization: Bearer wrong\r\n"),
+                await fetch(port, "/memory", "Authorization: Bearer s3cret\r\n"),
+            )
+        finally:
+            server.close()
+
+    try:
+        query, wrong, good = asyncio.run(scenario())
+    finally:
+        stop.set()
+        thread.join(5)
+    assert query[0] == 403 and wrong[0] == 403
+    assert good[0] == 200
+    assert json.loads(good[1])["structures"]["probe"] == {"count": 1}
+    assert measured_on == [thread.ident]
@@ -0,0 +1,19 @@
+import pytest
+
+import bot
+
+
+def test_dlink_stays_on_its_issuer_even_when_ejected():
+    pool = bot.ProxyPool(["http://10.0.0.1:3128", "http://10.0.0.2:3128"])
+    issuer = pool.by_name["proxy1"]
+    pool.failed(issuer, "ConnectionError", eject=True)
+    assert not issuer.healthy
+    assert pool.pick("proxy1").name == "proxy2"  # a fresh resolution may move
+    assert pool.issuer("proxy1") is issuer  # the dlink may not
+    assert pool.issuer(None) is None
+
+
+def test_unknown_issuer_asks_for_a_new_resolution():
+    pool = bot.ProxyPool(["http://10.0.0.1:3128"])
+    with pytest.raises(RuntimeError, match="resolve again"):
+        pool.issuer("proxy9")
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import bot
+
+
+def make_payment(storage, payment_id, amount=49, minutes_ago=5, status="pending"):
+    created = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    payment = {
+        "payment_id": payment_id,
+        "user_id": 1000 + len(storage.payments),
+        "plan_name": "Test",
+        "amount": amount,
+        "hours": 2,
+        "status": status,
+        "created_at": created.isoformat(),
+        "expires_at": (created + timedelta(minutes=30)).isoformat()
+    }
+    storage.save_payment(payment_id, payment)
+    return payment
+
+
+def local_time(minutes_ago=0):
+    when = datetime.utcnow() + timedelta(minutes=bot.Config.RECONCILE_UTC_OFFSET - minutes_ago)
+    return when.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def statement(*rows):
+    return "Date,Amount,Remarks,UTR\n" + "\n".join(",".join(row) for row in rows) + "\n"
+
+
+def test_note_match_and_duplicate_reference():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "ABCD1234")
+    report = bot.PaymentReconciler(storage).reconcile(statement(
+        (local_time(), "49", "Premium-ABCD1234", "U1"),
+        (local_time(), "49", "Premium-ABCD1234", "U1"),
+    ))
+    assert [p["payment_id"] for _, p in report["matched"]] == ["ABCD1234"]
+    assert len(report["duplicates"]) == 1
+
+
+def test_short_payment_is_mismatched():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "ABCD1234", amount=99)
+    report = bot.PaymentReconciler(storage).reconcile(statement((local_time(), "49", "Premium-ABCD1234", "U1")))
+    assert not report["matched"]
+    assert len(report["mismatched"]) == 1
+
+
+def test_amount_match_needs_a_single_candidate_in_window():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "AAAA0001", amount=49)
+    make_payment(storage, "AAAA0002", amount=99)
+    make_payment(storage, "AAAA0003", amount=99)
+    make_payment(storage, "AAAA0004", amount=149, minutes_ago=3 * 24 * 60)
+    report = bot.PaymentReconciler(storage).reconcile(statement(
+        (local_time(), "49", "paid", "U1"),
+        (local_time(), "99", "paid", "U2"),
+        (local_time(), "149", "paid", "U3"),
+    ))
+    assert [p["payment_id"] for _, p in report["matched"]] == ["AAAA0001"]
+    assert len(report["ambiguous"]) == 1
+    assert len(report["unmatched"]) == 1  # the only 149 payment expired days ago
+
+
+def test_row_without_usable_time_is_never_matched_on_amount():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "AAAA0001", amount=49, minutes_ago=3 * 24 * 60)
+    report = bot.PaymentReconciler(storage).reconcile(statement(("not a date", "49", "paid", "U1")))
+    assert not report["matched"]
+    assert [p["payment_id"] for p in report["ambiguous"][0][1]] == ["AAAA0001"]
+
+
+def test_completed_payments_are_ignored_and_snapshot_is_used():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "ABCD1234", status="completed")
+    snapshot = list(storage.payments.values())
+    make_payment(storage, "BEEF0001")  # arrives while the thread runs
+    report = bot.PaymentReconciler(storage).reconcile(statement(
+        (local_time(), "49", "Premium-ABCD1234", "U1"),
+        (local_time(), "49", "Premium-BEEF0001", "U2"),
+    ), snapshot)
+    assert not report["matched"]
+
+
+def test_note_for_completed_payment_never_falls_back_to_amount():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "ABCD1234", status="completed")
+    make_payment(storage, "BEEF0001")
+    report = bot.PaymentReconciler(storage).reconcile(statement((local_time(), "49", "Premium-ABCD1234", "U1")))
+    assert not report["matched"]
+    assert len(report["duplicates"]) == 1
+    assert storage.get_payment("BEEF0001")["status"] == "pending"
+
+
+def test_verify_payment_is_compare_and_set():
+    storage = bot.SimpleStorage()
+    make_payment(storage, "ABCD1234")
+    manager = bot.PaymentManager(storage)
+    assert manager.verify_payment("ABCD1234")
+    assert not manager.verify_payment("ABCD1234")
+    assert storage.get_payment("ABCD1234")["status"] == "completed"
@@ -0,0 +1,72 @@
+import asyncio
+import io
+
+import bot
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.raw = io.BytesIO(body)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBot:
+    cache = None
+
+    def __init__(self, response):
+        self.response = response
+        self.ranges = []
+
+    def open_source(self, file_info, byte_range=None):
+        self.ranges.append(byte_range)
+        return self.response
+
+
+class Writer:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, chunk):
+        self.data += chunk
+
+    async def drain(self):
+        pass
+
+
+def serve(response, range_header):
+    proxy = bot.StreamProxy()
+    fake = FakeBot(response)
+    proxy.attach(fake)
+    token = proxy.create_link({"filename": "clip.mp4"}).split("/")[-2]
+    writer = Writer()
+    asyncio.run(proxy.serve("GET", token, {"range": range_header}, writer))
+    head, _, body = writer.data.partition(b"\r\n\r\n")
+    lines = head.decode().split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:])
+    return int(lines[0].split(" ")[1]), headers, body, fake
+
+
+def test_open_range_of_unknown_size_from_the_top_is_a_plain_200():
+    status, headers, body, fake = serve(FakeResponse(200, b"abcdef"), "bytes=0-")
+    assert fake.ranges == [(0, "")]
+    assert status == 200 and "Content-Range" not in headers
+    assert body == b"abcdef"
+
+
+def test_open_range_of_unknown_size_uses_upstream_range():
+    response = FakeResponse(206, b"cdef", {"Content-Range": "bytes 2-5/*"})
+    status, headers, body, _ = serve(response, "bytes=2-")
+    assert status == 206 and headers["Content-Range"] == "bytes 2-5/*"
+    assert headers["Content-Length"] == "4" and body == b"cdef"
+
+
+def test_open_range_with_no_known_end_is_refused():
+    response = FakeResponse(206, b"cdef")
+    status, headers, body, _ = serve(response, "bytes=2-")
+    assert status == 416 and headers["Content-Range"] == "bytes */*"
+    assert response.closed
@@ -0,0 +1,29 @@
+import struct
+from types import SimpleNamespace
+
+import bot
+
+
+def jpeg(width, height, pad=0):
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+    sof0 = b"\xff\xc0" + struct.pack(">HBHHB", 11, 8, height, width, 1) + b"\x01\x11\x00"
+    return b"\xff\xd8" + app0 + sof0 + b"\x00" * pad + b"\xff\xd9"
+
+
+def service(data):
+    response = SimpleNamespace(content=data, raise_for_status=lambda: None)
+    return bot.ThumbnailService(SimpleNamespace(get=lambda url, timeout: response))
+
+
+def test_jpeg_size_reads_the_frame_header():
+    assert bot.ThumbnailService.jpeg_size(jpeg(640, 360)) == (640, 360)
+    assert bot.ThumbnailService.jpeg_size(b"\x89PNG\r\n\x1a\n") is None
+    assert bot.ThumbnailService.jpeg_size(jpeg(640, 360)[:12]) is None
+
+
+def test_without_pillow_only_small_jpegs_pass(monkeypatch):
+    monkeypatch.setattr(bot, "Image", None)
+    small = jpeg(320, 180)
+    assert service(small)._fetch_and_scale("u") == small
+    assert service(jpeg(850, 480))._fetch_and_scale("u") is None
+    assert service(jpeg(320, 180, pad=300 * 1024))._fetch_and_scale("u") is None
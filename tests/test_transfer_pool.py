@@ -0,0 +1,47 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def make_pool(monkeypatch):
+    pool = bot.TransferPool(1)
+    spawned = []
+    monkeypatch.setattr(pool, "_spawn", spawned.append)
+    pool.current[0] = pool.context.Array("c", 32)
+    pool.workers[0] = SimpleNamespace(is_alive=lambda: False, exitcode=-9)
+    return pool, spawned
+
+
+def test_crashed_worker_fails_the_job_it_held_without_a_claim(monkeypatch):
+    pool, spawned = make_pool(monkeypatch)
+
+    async def scenario():
+        pool.loop = asyncio.get_running_loop()
+        task = asyncio.create_task(pool.submit(1, {}, False, None))
+        await asyncio.sleep(0)
+        job = pool.jobs.get(timeout=5)
+        # Taken by worker 0, which died before its "claimed" message arrived
+        pool.current[0].value = job["job_id"].encode()
+        pool.reap()
+        with pytest.raises(RuntimeError, match="crashed"):
+            await task
+
+    asyncio.run(scenario())
+    assert spawned == [0]
+    assert not pool.pending
+
+
+def test_submit_gives_up_after_the_job_timeout(monkeypatch):
+    pool, _ = make_pool(monkeypatch)
+    monkeypatch.setattr(bot.Config, "TRANSFER_JOB_TIMEOUT", 0.05)
+
+    async def scenario():
+        pool.loop = asyncio.get_running_loop()
+        with pytest.raises(RuntimeError, match="did not finish"):
+            await pool.submit(1, {}, False, None)
+
+    asyncio.run(scenario())
+    assert not pool.pending
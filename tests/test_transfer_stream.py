@@ -0,0 +1,34 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import bot
+
+
+class Flow:
+    def __init__(self):
+        self.consumed = 0
+
+    async def consume(self, count):
+        self.consumed += count
+
+
+def test_peeked_bytes_are_charged_to_flows():
+    data = bytes(range(256)) * 64
+    flow = Flow()
+    response = SimpleNamespace(raw=io.BytesIO(data), close=lambda: None)
+    stream = bot.TransferStream(response, flows=(flow,))
+
+    async def drain():
+        head = await stream.peek(1000)
+        chunks = []
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                return head, b"".join(chunks)
+            chunks.append(chunk)
+
+    head, body = asyncio.run(drain())
+    assert head == data[:1000]
+    assert body == data
+    assert flow.consumed == stream.bytes_read == len(data)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Trace Report for Ultimate Terabox Bot
+Reads the JSON-lines spans written by bot.py (TRACE_FILE) and prints
+per-stage latency percentiles.
+
+Usage: python trace_report.py [traces.jsonl] [--stage leech]
+"""
+
+import glob
+import json
+import math
+import sys
+from collections import defaultdict
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def load_spans(path):
+    """Read the live file plus its rotated backups (traces.jsonl.1, .2, ...)"""
+    spans = []
+    for file_path in sorted(glob.glob(f"{path}.*"), reverse=True) + [path]:
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        spans.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            continue
+    return spans
+
+
+def stage_key(span):
+    """Group endpoint attempts by mirror so slow mirrors stand out"""
+    mirror = span.get("attrs", {}).get("mirror")
+    return f"{span['name']} [{mirror}]" if mirror else span["name"]
+
+
+def report(spans, only_stage=None):
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    byte_totals = defaultdict(int)
+
+    for span in spans:
+        key = stage_key(span)
+        if only_stage and span["name"] != only_stage:
+            continue
+        durations[key].append(span.get("duration_ms", 0))
+        if span.get("status") == "error":
+            errors[key] += 1
+        byte_totals[key] += span.get("attrs", {}).get("bytes") or 0
+
+    traces = {span["trace_id"] for span in spans}
+    print(f"{len(spans)} spans across {len(traces)} traces\n")
+
+    header = f"{'stage':<48} {'count':>6} {'err':>5} {'p50ms':>9} {'p90ms':>9} {'p99ms':>9} {'maxms':>9} {'MB/s':>7}"
+    print(header)
+    print("-" * len(header))
+    for key in sorted(durations, key=lambda k: -percentile(durations[k], 50)):
+        values = durations[key]
+        total_seconds = sum(values) / 1000
+        mbps = byte_totals[key] / (1024 * 1024) / total_seconds if byte_totals[key] and total_seconds else 0
+        print(
+            f"{key[:48]:<48} {len(values):>6} {errors[key]:>5} "
+            f"{percentile(values, 50):>9.1f} {percentile(values, 90):>9.1f} "
+            f"{percentile(values, 99):>9.1f} {max(values):>9.1f} {mbps:>7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    stage = None
+    if "--stage" in args:
+        index = args.index("--stage")
+        stage = args[index + 1] if index + 1 < len(args) else None
+        args = args[:index] + args[index + 2:]
+
+    path = args[0] if args else "traces.jsonl"
+    spans = load_spans(path)
+    if not spans:
+        print(f"No spans found in {path}")
+        sys.exit(1)
+    report(spans, stage)